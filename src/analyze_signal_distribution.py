@@ -2,6 +2,8 @@ import pandas as pd
 import numpy as np
 import os
 from tqdm import tqdm
+from factor_store import read_factor_frames
+from trading_calendar import TradingCalendar
 
 # Top 50 Active Stocks (Same as backtest)
 TARGET_STOCKS = [
@@ -14,21 +16,10 @@ TARGET_STOCKS = [
 
 REVENUE_DB = 'data/revenue_announcements.parquet'
 
-def get_price_idx(bps_df, target_date):
-    """Finds index of date or closest previous trading day"""
-    target_dt = pd.to_datetime(target_date)
-    bps_df['date_dt'] = pd.to_datetime(bps_df['date'])
-    
-    # Strict match first
-    match = bps_df[bps_df['date_dt'] == target_dt]
-    if not match.empty:
-        return match.index[0]
-    
-    # Backward search (if announced on Sunday, look at Friday)
-    prev_dates = bps_df[bps_df['date_dt'] < target_dt]
-    if not prev_dates.empty:
-        return prev_dates.index[-1]
-    return None
+def get_price_idx(bps_df, target_date, calendar=None):
+    """Finds index of date or closest previous trading day (if announced on Sunday, look at Friday)"""
+    calendar = calendar or TradingCalendar(bps_df['date'])
+    return calendar.index_on_or_before(target_date)
 
 def analyze_timing():
     print("--- Analyzing Smart BPS Front-Running Timing Distribution ---")
@@ -48,21 +39,23 @@ def analyze_timing():
     timing_stats = {i: [] for i in range(-LOOKBACK, 1)}
     
     valid_events = 0
+    # One factor-store scan for every target stock
+    bps_frames = read_factor_frames(['smart_bps'], TARGET_STOCKS)
     
     for stock_id in tqdm(TARGET_STOCKS, desc="Scanning Stocks"):
-        bps_path = f'data/smart_bps_result_{stock_id}.csv'
-        if not os.path.exists(bps_path):
+        if stock_id not in bps_frames:
             continue
             
-        bps_df = pd.read_csv(bps_path)
+        bps_df = bps_frames[stock_id]
         # Ensure BPS is numeric
         bps_df['smart_bps'] = pd.to_numeric(bps_df['smart_bps'], errors='coerce').fillna(0)
         
+        calendar = TradingCalendar(bps_df['date'])
         stock_events = rev_df[rev_df['stock_id'] == stock_id]
         
         for _, event in stock_events.iterrows():
             ann_date = event['announcement_date']
-            exit_idx = get_price_idx(bps_df, ann_date)
+            exit_idx = get_price_idx(bps_df, ann_date, calendar)
             
             if exit_idx is None or exit_idx < LOOKBACK:
                 continue
@@ -1,5 +1,8 @@
 import pandas as pd
 import os
+from factor_store import read_factor_frames
+from trading_calendar import TradingCalendar
+from bps_state import has_panel, load_panel
 
 # Target Trades
 TRADES = [
@@ -29,6 +32,8 @@ def analyze_trade_details():
         print("Market index not found. Alpha calculation will be skipped.")
         market_df = None
     
+    bps_frames = read_factor_frames(['smart_bps'], [t['stock_id'] for t in TRADES])
+    
     for trade in TRADES:
         stock_id = trade['stock_id']
         ann_date = trade['ann_date']
@@ -42,13 +47,11 @@ def analyze_trade_details():
         stock_prices['stock_ret'] = stock_prices['close'].pct_change()
         
         # 2. Load Smart BPS Data
-        bps_path = f'data/smart_bps_result_{stock_id}.csv'
-        if not os.path.exists(bps_path):
-            print(f"Data file not found: {bps_path}")
+        if stock_id not in bps_frames:
+            print(f"No Smart BPS in the factor store for {stock_id}")
             continue
             
-        bps_df = pd.read_csv(bps_path)
-        bps_df['date'] = pd.to_datetime(bps_df['date'])
+        bps_df = bps_frames[stock_id]
         
         # 3. Merge (Left Join on Price Data)
         merged_df = pd.merge(stock_prices, bps_df[['date', 'smart_bps']], on='date', how='left')
@@ -65,10 +68,11 @@ def analyze_trade_details():
         # 4. Find the target window
         target_dt = pd.to_datetime(ann_date)
         
-        try:
-            idx = merged_df[merged_df['date'] == target_dt].index[0]
-        except IndexError:
-            idx = merged_df[merged_df['date'] < target_dt].index[-1]
+        idx = TradingCalendar(merged_df['date']).index_on_or_before(target_dt)
+        if idx is None:
+            print(f"No trading day on or before {ann_date}")
+            continue
+        if merged_df.iloc[idx]['date'] != target_dt:
             print(f"(Note: Announcement {ann_date} was non-trading, using {merged_df.iloc[idx]['date'].date()})")
 
         # Calculate Cumulative Alpha starting from T-10
@@ -103,5 +107,18 @@ def analyze_trade_details():
             
             print(f"{date_str:<12} {price:<8.2f} {ret:<8.2f} {mkt:<8.2f} {alpha:<8.2f} {bps_display:<10} {note}")
 
+        # 5. Winners behind the signal, from the stored broker panel (no re-simulation)
+        if not has_panel(stock_id, 'smart_bps'):
+            print(f"\nNo broker panel for {stock_id} (run Smart BPS with BPS_PANEL=1 to record winners)")
+            continue
+        winners = load_panel(stock_id, window['date'].iloc[0], window['date'].iloc[-1], factor='smart_bps')
+        winners = winners[winners['rank'] > 0].sort_values(['date', 'rank'])
+
+        print(f"\n{'Date':<12} {'Rank':<5} {'Broker':<8} {'PnL':<14} {'Net Buy':<10} {'Position':<10} {'Avg Cost'}")
+        print("-" * 75)
+        for _, row in winners.iterrows():
+            print(f"{row['date'].strftime('%Y-%m-%d'):<12} {row['rank']:<5} {row['securities_trader_id']:<8} "
+                  f"{row['score']:<14,.0f} {row['net_buy_qty']:<10,.0f} {row['qty']:<10,.0f} {row['avg_cost']:.2f}")
+
 if __name__ == "__main__":
     analyze_trade_details()
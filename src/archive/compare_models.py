@@ -4,7 +4,8 @@ import os
 from sklearn.cluster import DBSCAN, KMeans
 from sklearn.preprocessing import StandardScaler
 from broker_clustering import load_data, extract_features
-from bps_strategy import load_price_data, calculate_bps
+from bps_strategy import load_price_data
+from bps_engine import calculate_bps_subsets
 
 # Configuration
 TARGET_STOCKS = ['3706', '3450', '1536', '3013', '6140', '6215']
@@ -53,13 +54,15 @@ def run_comparison():
             (active_brokers['overnight_ratio'] > 0.3)
         ]['securities_trader_id'].tolist()
         
-        # 4. Calculate BPS for both
-        def calc_bps_return(broker_ids):
-            if not broker_ids:
+        # 4. Calculate BPS for both (one pass over the transactions for every broker set)
+        broker_sets = {'kmeans': kmeans_brokers, 'dbscan': dbscan_brokers}
+        bps_sets = calculate_bps_subsets(df_raw, price_df, broker_sets)
+
+        def calc_bps_return(name):
+            if not broker_sets[name]:
                 return 0.0
             
-            subset = df_raw[df_raw['securities_trader_id'].isin(broker_ids)]
-            bps_res = calculate_bps(subset, price_df)
+            bps_res = bps_sets[name]
             signal = bps_res.set_index('date')['bps_factor']
             
             # Merge with future return
@@ -76,8 +79,8 @@ def run_comparison():
                 return 0.0
             return active_days['future_return_5d'].mean()
 
-        km_ret = calc_bps_return(kmeans_brokers)
-        db_ret = calc_bps_return(dbscan_brokers)
+        km_ret = calc_bps_return('kmeans')
+        db_ret = calc_bps_return('dbscan')
         
         overlap_count = len(set(kmeans_brokers) & set(dbscan_brokers))
         
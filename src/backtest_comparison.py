@@ -4,6 +4,8 @@ import numpy as np
 from tqdm import tqdm
 from bps_strategy import load_price_data, load_data, calculate_bps
 from smart_bps import run_smart_bps # To ensure smart_bps files exist
+from factor_store import read_factor_frames
+from trading_calendar import TradingCalendar
 
 # Configuration
 TARGET_STOCKS = [
@@ -13,18 +15,14 @@ TARGET_STOCKS = [
 REVENUE_DB = 'data/revenue_announcements.parquet'
 STOP_LOSS_PCT = 0.07
 
-def get_price_on_date(price_df, target_date):
-    """Aligns dates similar to backtest_strategy.py"""
-    target_dt = pd.to_datetime(target_date)
-    
-    # Search backwards 5 days
-    for i in range(6):
-        d = target_dt - pd.Timedelta(days=i)
-        d_str = d.strftime('%Y-%m-%d')
-        row = price_df[price_df['date'] == d_str]
-        if not row.empty:
-            return row.iloc[0]['close'], d_str, row.index[0]
-    return None, None, None
+def get_price_on_date(price_df, target_date, calendar=None):
+    """Aligns dates similar to backtest_strategy.py (target day or up to 5 days back)."""
+    calendar = calendar or TradingCalendar(price_df['date'])
+    idx = calendar.index_on_or_before(target_date, max_gap_days=5)
+    if idx is None:
+        return None, None, None
+    row = price_df.iloc[idx]
+    return row['close'], row['date'], idx
 
 def run_ab_test():
     print(f"--- A/B Test: Smart BPS vs Original BPS (2025 H1) ---")
@@ -40,23 +38,25 @@ def run_ab_test():
     results_smart = []
     results_original = []
     
+    # Smart + Original BPS for every target stock in one factor-store read
+    bps_frames = read_factor_frames(['smart_bps', 'original_bps'], TARGET_STOCKS)
+    
     for stock_id in tqdm(TARGET_STOCKS, desc="Comparing"):
-        # 1. Ensure Smart BPS file exists (if not, run it)
-        smart_path = f'data/smart_bps_result_{stock_id}.csv'
-        if not os.path.exists(smart_path):
+        # 1. Ensure Smart BPS exists (if not, run it)
+        if stock_id not in bps_frames:
             # In a real rigorous test, we should run this. 
             # But assume previous steps generated them. If missing, skip.
             continue
             
-        # Load combined result (Smart BPS file contains Original BPS column too!)
-        df = pd.read_csv(smart_path)
-        df['date'] = pd.to_datetime(df['date']).dt.strftime('%Y-%m-%d')
+        df = bps_frames[stock_id]
+        df['date'] = df['date'].dt.strftime('%Y-%m-%d')
         
         # Load Price Data for Stop Loss checking
         price_df = load_price_data(stock_id)
         if price_df.empty: continue
         price_df['date'] = pd.to_datetime(price_df['date']).dt.strftime('%Y-%m-%d')
-        price_df = price_df.sort_values('date').reset_index(drop=True)
+        price_df = price_df.drop_duplicates('date').sort_values('date').reset_index(drop=True)
+        calendar = TradingCalendar(price_df['date'])
         
         # Events
         stock_events = rev_df[rev_df['stock_id'] == stock_id].sort_values('announcement_date')
@@ -65,7 +65,7 @@ def run_ab_test():
             ann_date = event['announcement_date']
             
             # Align Exit Date
-            exit_price, _, exit_idx = get_price_on_date(price_df, ann_date)
+            exit_price, _, exit_idx = get_price_on_date(price_df, ann_date, calendar)
             if exit_idx is None or exit_idx < 5: continue
             
             entry_idx = exit_idx - 5
@@ -3,6 +3,8 @@ import os
 import numpy as np
 from tqdm import tqdm
 from bps_strategy import load_price_data 
+from factor_store import read_factor_frames
+from trading_calendar import TradingCalendar
 
 # Configuration
 # Top 50 Active Stocks
@@ -18,31 +20,19 @@ MARKET_INDEX_DB = 'data/market_index.parquet'
 STOP_LOSS_PCT = 0.07  # 7% Stop Loss
 VALUE_THRESHOLD = 10_000_000 # Entry Signal: Smart Buy Value > 10 Million NTD
 
-def get_price_on_date(bps_df, target_date):
+def get_price_on_date(bps_df, target_date, calendar=None):
     """
     Tries to find the price on target_date. 
     If not found, searches backwards for up to 5 days.
     Returns (price, valid_date, index) or (None, None, None).
+    calendar: TradingCalendar over bps_df['date'] (one row per day), built if not given.
     """
-    target_date_str = str(target_date)
-    
-    # Try exact match first
-    row = bps_df[bps_df['date'] == target_date_str]
-    if not row.empty:
-        return row.iloc[0]['price'], target_date_str, row.index[0]
-        
-    # Search backwards
-    bps_dates = pd.to_datetime(bps_df['date'])
-    target_dt = pd.to_datetime(target_date)
-    
-    for i in range(1, 6):
-        prev_date = target_dt - pd.Timedelta(days=i)
-        prev_date_str = prev_date.strftime('%Y-%m-%d')
-        row = bps_df[bps_df['date'] == prev_date_str]
-        if not row.empty:
-            return row.iloc[0]['price'], prev_date_str, row.index[0]
-            
-    return None, None, None
+    calendar = calendar or TradingCalendar(bps_df['date'])
+    idx = calendar.index_on_or_before(target_date, max_gap_days=5)
+    if idx is None:
+        return None, None, None
+    row = bps_df.iloc[idx]
+    return row['price'], row['date'], idx
 
 def run_backtest():
     print("Starting Backtest: Smart BPS Revenue Ambush Strategy (2024-2025 Full Market).")
@@ -65,25 +55,26 @@ def run_backtest():
     print("Loading Real Market Index (TAIEX)...")
     if not os.path.exists(MARKET_INDEX_DB):
         print("Market Index DB not found. Alpha will be 0.")
-        market_returns = {}
+        market_calendar = TradingCalendar([])
+        market_returns = np.array([])
     else:
-        market_df = pd.read_parquet(MARKET_INDEX_DB)
-        # Create a dictionary for fast lookup: date_str -> daily_return
-        # Ensure date format matches bps_df (YYYY-MM-DD string)
-        market_df['date_str'] = market_df['date'].dt.strftime('%Y-%m-%d')
-        market_returns = pd.Series(market_df.market_ret.values, index=market_df.date_str).to_dict()
+        market_df = pd.read_parquet(MARKET_INDEX_DB).drop_duplicates('date').sort_values('date')
+        # Market calendar: positions index the daily return array
+        market_calendar = TradingCalendar(market_df['date'])
+        market_returns = market_df['market_ret'].to_numpy()
         print(f"Market data loaded: {len(market_returns)} days.")
     
     trades = []
+    # Smart BPS + reference price for all target stocks in one factor-store read
+    bps_frames = read_factor_frames(['smart_bps', 'price'], TARGET_STOCKS)
     
     for stock_id in tqdm(TARGET_STOCKS, desc="Backtesting Stocks"):
-        bps_path = f'data/smart_bps_result_{stock_id}.csv'
-        if not os.path.exists(bps_path):
+        if stock_id not in bps_frames:
             continue
             
-        bps_df = pd.read_csv(bps_path)
-        bps_df['date'] = bps_df['date'].astype(str)
-        bps_df = bps_df.sort_values('date')
+        bps_df = bps_frames[stock_id]
+        calendar = TradingCalendar(bps_df['date'])
+        bps_df['date'] = bps_df['date'].dt.strftime('%Y-%m-%d')
         
         stock_events = rev_df[rev_df['stock_id'] == stock_id].sort_values('announcement_date')
         
@@ -91,7 +82,7 @@ def run_backtest():
             ann_date = event['announcement_date']
             
             # 1. Align Dates (Find Exit Date Index)
-            exit_price, valid_exit_date, exit_idx = get_price_on_date(bps_df, ann_date)
+            exit_price, valid_exit_date, exit_idx = get_price_on_date(bps_df, ann_date, calendar)
             
             if exit_idx is None: continue
             if exit_idx < 5: continue
@@ -144,14 +135,9 @@ def run_backtest():
             entry_date_obj = pd.to_datetime(entry_date_str)
             exit_date_obj = pd.to_datetime(exit_date_str)
             
-            market_compound_ret = 1.0
-            curr_d = entry_date_obj + pd.Timedelta(days=1)
-            
-            while curr_d <= exit_date_obj:
-                d_str = curr_d.strftime('%Y-%m-%d')
-                if d_str in market_returns:
-                    market_compound_ret *= (1 + market_returns[d_str])
-                curr_d += pd.Timedelta(days=1)
+            # Market trading days in (entry, exit]
+            lo, hi = market_calendar.range(entry_date_obj + pd.Timedelta(days=1), exit_date_obj)
+            market_compound_ret = np.prod(1 + market_returns[lo:hi])
             
             market_ret_period = market_compound_ret - 1.0
             alpha = return_pct - market_ret_period
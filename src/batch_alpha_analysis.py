@@ -1,7 +1,7 @@
 import pandas as pd
 import os
-import glob
 from datetime import datetime
+from factor_store import read_factor_frames
 
 def run_batch_alpha_analysis():
     print("--- 🚀 Refined Batch Alpha Analysis (Target: Jan 2025 Announcements) ---")
@@ -22,9 +22,9 @@ def run_batch_alpha_analysis():
         print("Market index not found.")
         return
 
-    # 2. Identify Target Stocks (Based on available Smart BPS results)
-    bps_files = glob.glob('data/smart_bps_result_*.csv')
-    stock_ids = [f.split('_')[-1].split('.')[0] for f in bps_files]
+    # 2. Identify Target Stocks (Based on available Smart BPS results, loaded in one scan)
+    bps_frames = read_factor_frames(['smart_bps'])
+    stock_ids = list(bps_frames)
     
     # 3. Load Target Month Announcements (Jan 2025)
     ann_df = pd.read_csv('data/announcement.csv')
@@ -58,9 +58,7 @@ def run_batch_alpha_analysis():
         stock_prices['stock_ret'] = stock_prices['close'].pct_change()
         
         # Load BPS
-        bps_path = f'data/smart_bps_result_{stock_id}.csv'
-        bps_df = pd.read_csv(bps_path)
-        bps_df['date'] = pd.to_datetime(bps_df['date'])
+        bps_df = bps_frames[stock_id]
         
         # Merge
         merged = pd.merge(stock_prices, bps_df[['date', 'smart_bps']], on='date', how='left')
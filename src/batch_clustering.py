@@ -3,6 +3,7 @@ import glob
 import os
 from tqdm import tqdm
 from broker_clustering import extract_features, perform_clustering
+from branch_data import load_branch, iter_branch_by_stock, PARTITIONED_DIR
 
 # Configuration
 DATA_DIR = 'data/'
@@ -12,34 +13,16 @@ TARGET_STOCKS = [
     '3013', '2365', '1815', '8096', '2408', '1514', '6215', '2486', '4510', '6140'
 ]
 
-def load_data(stock_id):
+def load_data(stock_id, df=None):
     """Loads transactions from consolidated StockBranch.parquet and filters for the specific stock."""
     file_path = os.path.join(DATA_DIR, 'StockBranch.parquet')
-    if not os.path.exists(file_path):
+    if df is None and not os.path.exists(file_path) and not os.path.isdir(PARTITIONED_DIR):
         print(f"File not found: {file_path}")
         return pd.DataFrame()
 
     try:
-        # Use pyarrow filters
-        df = pd.read_parquet(file_path, filters=[('CommodityId', '==', str(stock_id))])
-        
-        if df.empty:
-            return pd.DataFrame()
-
-        # Standardize column names
-        df = df.rename(columns={
-            'Date': 'date',
-            'CommodityId': 'stock_id',
-            'SecuritiesTraderId': 'securities_trader_id',
-            'Price': 'price',
-            'Buy': 'buy',
-            'Sell': 'sell'
-        })
-        
-        # Ensure date is string
-        df['date'] = df['date'].astype(str)
-        
-        return df
+        # Per-stock layout when available, pyarrow filters otherwise; compact dtypes
+        return load_branch(stock_id, df=df)
     except Exception as e:
         print(f"Error loading StockBranch.parquet for {stock_id}: {e}")
         return pd.DataFrame()
@@ -69,9 +52,9 @@ def run_batch_clustering():
     
     results = []
     
-    # Using tqdm for progress tracking
-    for stock in tqdm(TARGET_STOCKS, desc="Analyzing Stocks"):
-        df = load_data(stock)
+    # Single scan of StockBranch for all targets; tqdm for progress tracking
+    for stock, df_raw in tqdm(iter_branch_by_stock(TARGET_STOCKS), total=len(TARGET_STOCKS), desc="Analyzing Stocks"):
+        df = load_data(stock, df_raw)
         
         if df.empty:
             continue
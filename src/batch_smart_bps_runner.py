@@ -1,4 +1,3 @@
-import pandas as pd
 import os
 import sys
 
@@ -6,6 +5,9 @@ import sys
 sys.path.append(os.getcwd())
 
 from src.smart_bps import run_smart_bps
+from src.branch_data import iter_branch_by_stock
+from src.factor_store import has_factors
+from src.liquidity_rank import get_top_stocks
 
 def batch_process_top_stocks():
     print("--- 🏭 Batch Processing Smart BPS for Top 50 Stocks ---")
@@ -14,28 +16,27 @@ def batch_process_top_stocks():
     if not os.path.exists(stock_history_path):
         print("Price history file not found.")
         return
-        
-    df_prices = pd.read_parquet(stock_history_path)
-    df_prices['date'] = pd.to_datetime(df_prices['date'])
-    
-    valid_prices = df_prices[df_prices['date'].between('2025-01-01', '2025-08-31')]
-    top_stocks = valid_prices.groupby('stock_id')['volume_value_1k'].sum().sort_values(ascending=False).head(50).index.tolist()
+
+    # Universe as of the latest ingested day (rolling 120-day traded value, no look-ahead)
+    top_stocks = get_top_stocks(n=50, metric='value_120')
     
     print(f"Top 50 Stocks identified. Starting processing...")
     
     success_count = 0
-    for i, stock_id in enumerate(top_stocks):
+    pending = []
+    for stock_id in top_stocks:
         stock_id = str(stock_id)
-        print(f"\n[{i+1}/50] Processing {stock_id}...")
-        
-        output_path = f'data/smart_bps_result_{stock_id}.csv'
-        if os.path.exists(output_path):
+        if has_factors(stock_id, ['smart_bps']):
             print(f"Result for {stock_id} already exists. Skipping.")
             success_count += 1
             continue
-            
+        pending.append(stock_id)
+
+    # Single scan of StockBranch; clustering and BPS share each stock's frame
+    for i, (stock_id, df_raw) in enumerate(iter_branch_by_stock(pending)):
+        print(f"\n[{i+1}/{len(pending)}] Processing {stock_id}...")
         try:
-            run_smart_bps(stock_id)
+            run_smart_bps(stock_id, df_raw)
             success_count += 1
         except Exception as e:
             print(f"❌ Error processing {stock_id}: {e}")
@@ -0,0 +1,661 @@
+import pandas as pd
+import numpy as np
+from broker_flow import is_flow, build_flow, day_totals, flow_broker_codes
+from id_codes import broker_codes
+from price_store import PriceStore
+import bps_jit
+
+# Configuration
+TOP_N = 5 # Winners whose net buy makes up the factor
+RANK_METRIC = 'total_pnl' # Winners are ranked by realized + unrealized PnL
+# Broker rankings a BPS variant can use (see BrokerBook.scores)
+RANK_METRICS = ('total_pnl', 'realized_pnl', 'pnl_per_turnover')
+RANK_BAND = 0.1 # TopNRanking re-selects its candidates when the price rises this far above the last rebuild
+RANK_MIN_BROKERS = 4096 # Smaller books are ranked in full every day: one vectorized pass is cheaper than the upkeep
+
+def _top_n_sorted(pnl, n):
+    """Reference ranking: the DataFrame sort_values path calculate_bps uses (same tie and NaN order)."""
+    order = pd.DataFrame({'total_pnl': pnl}).sort_values('total_pnl', ascending=False).index.to_numpy()
+    mask = np.zeros(len(pnl), dtype=bool)
+    mask[order[:n]] = True
+    return mask
+
+def top_n_mask(pnl, n=TOP_N):
+    """
+    Boolean mask of the n brokers with the highest PnL. np.partition finds the n-th
+    value; only when that value is tied across the cut (or PnL has NaNs) does it fall
+    back to the full sort, so the chosen set always equals calculate_bps's.
+    """
+    if len(pnl) <= n:
+        return np.ones(len(pnl), dtype=bool)
+    kth = np.partition(pnl, len(pnl) - n)[len(pnl) - n]
+    above = pnl > kth
+    at = pnl == kth
+    if np.isnan(kth) or above.sum() + at.sum() != n:
+        return _top_n_sorted(pnl, n)
+    return above | at
+
+def top_n_masks(scores, top_ns):
+    """{n: top_n_mask(scores, n)} for several n from one partial sort of the best max(top_ns) + 1 scores."""
+    finite = not np.isnan(scores).any()
+    k = min(len(scores), max(top_ns) + 1)
+    top = np.argpartition(-scores, k - 1)[:k] if finite and k < len(scores) else np.arange(len(scores))
+    order = top[np.argsort(-scores[top], kind='stable')]
+    ranked = scores[order]
+    masks = {}
+    for n in top_ns:
+        if n >= len(scores):
+            masks[n] = np.ones(len(scores), dtype=bool)
+        elif finite and ranked[n - 1] > ranked[n]:
+            masks[n] = np.zeros(len(scores), dtype=bool)
+            masks[n][order[:n]] = True
+        else: # Tie at the cut (or NaN): exact calculate_bps order
+            masks[n] = top_n_mask(scores, n)
+    return masks
+
+class BrokerBook:
+    """
+    Per-broker position state as parallel float64 arrays (qty, avg_cost, realized_pnl,
+    and turnover: cumulative traded notional) indexed by position, in the order brokers
+    were first seen: the same order as the broker_state dict of calculate_bps, so
+    rankings break ties identically. codes holds each position's int32 broker code.
+    """
+    def __init__(self, codes=None, qty=None, avg_cost=None, realized_pnl=None, turnover=None):
+        self.codes = np.asarray([] if codes is None else codes, dtype='int32')
+        zeros = np.zeros(len(self.codes))
+        self.qty = zeros.copy() if qty is None else np.array(qty, dtype='float64')
+        self.avg_cost = zeros.copy() if avg_cost is None else np.array(avg_cost, dtype='float64')
+        self.realized_pnl = zeros.copy() if realized_pnl is None else np.array(realized_pnl, dtype='float64')
+        self.turnover = zeros.copy() if turnover is None else np.array(turnover, dtype='float64')
+        self._index = pd.Index(self.codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def copy(self, n=None):
+        """Independent copy of the first n brokers (default: all)."""
+        n = len(self.codes) if n is None else n
+        return BrokerBook(self.codes[:n], self.qty[:n], self.avg_cost[:n], self.realized_pnl[:n], self.turnover[:n])
+
+    def subset(self, codes):
+        """The brokers in codes, in book order: the book a replay over only their rows would hold."""
+        keep = np.isin(self.codes, np.asarray(codes, dtype='int32'))
+        return BrokerBook(self.codes[keep], self.qty[keep], self.avg_cost[keep], self.realized_pnl[keep], self.turnover[keep])
+
+    def positions(self, codes):
+        """Position of every code; brokers not yet in the book are appended (flat state) in order of first appearance."""
+        codes = np.asarray(codes, dtype='int32')
+        pos = self._index.get_indexer(codes)
+        new = pos < 0
+        if new.any():
+            fresh = pd.unique(codes[new])
+            zeros = np.zeros(len(fresh))
+            self.codes = np.concatenate([self.codes, fresh])
+            self.qty = np.concatenate([self.qty, zeros])
+            self.avg_cost = np.concatenate([self.avg_cost, zeros])
+            self.realized_pnl = np.concatenate([self.realized_pnl, zeros])
+            self.turnover = np.concatenate([self.turnover, zeros])
+            self._index = pd.Index(self.codes)
+            pos[new] = self._index.get_indexer(codes[new])
+        return pos
+
+    def apply(self, pos, net_qty, avg_price, notional=None):
+        """One day's net buys at their VWAPs for brokers pos (unique): average-cost buys, realized PnL on sells."""
+        if notional is not None:
+            self.turnover[pos] += notional
+        qty, cost = self.qty[pos], self.avg_cost[pos]
+        buy = net_qty > 0
+        if buy.any():
+            q, n = qty[buy], net_qty[buy]
+            self.avg_cost[pos[buy]] = (q * cost[buy] + n * avg_price[buy]) / (q + n)
+            self.qty[pos[buy]] = q + n
+        sell = (net_qty < 0) & (qty > 0)
+        if sell.any():
+            q, s = qty[sell], np.abs(net_qty[sell])
+            self.realized_pnl[pos[sell]] += (avg_price[sell] - cost[sell]) * np.minimum(s, q)
+            self.qty[pos[sell]] = np.maximum(0, q - s)
+
+    def total_pnl(self, price, n=None):
+        """Realized + unrealized PnL at price for the first n brokers (default: all)."""
+        n = len(self.qty) if n is None else n
+        return self.realized_pnl[:n] + (price - self.avg_cost[:n]) * self.qty[:n]
+
+    def scores(self, metric, price, n=None):
+        """
+        Ranking score of the first n brokers: total_pnl, realized_pnl, or pnl_per_turnover
+        (total PnL per unit of traded notional; 0 for brokers without turnover).
+        """
+        n = len(self.qty) if n is None else n
+        if metric == 'total_pnl':
+            return self.total_pnl(price, n)
+        if metric == 'realized_pnl':
+            return self.realized_pnl[:n].copy()
+        if metric == 'pnl_per_turnover':
+            turnover = self.turnover[:n]
+            return np.where(turnover > 0, self.total_pnl(price, n) / np.where(turnover > 0, turnover, 1), 0.0)
+        raise ValueError(f"Unknown rank metric: {metric} (expected one of {RANK_METRICS})")
+
+class TopNRanking:
+    """
+    Maintained total-PnL leaderboard of a BrokerBook. A broker's PnL is increasing in the
+    price (qty >= 0), so a rebuild marks every broker at a price ceiling (price * (1 +
+    band)) and keeps as candidates only those that could still reach the top n below it;
+    every other broker's PnL stays under `bound` until it trades. Each day then ranks the
+    candidates plus the brokers that traded since (touch), and accepts the result when
+    the n-th candidate PnL is above `bound` with no tie at the cut. A higher price, a tie,
+    NaN PnL, or too many touched brokers triggers a rebuild over the whole book, which
+    also gives that day's exact answer, so every mask equals top_n_mask on all brokers.
+    Books under min_brokers skip the candidates and are ranked in full.
+    """
+    def __init__(self, book, top_n=TOP_N, band=RANK_BAND, min_brokers=RANK_MIN_BROKERS):
+        self.book = book
+        self.top_n = top_n
+        self.band = band
+        self.min_brokers = min_brokers
+        self.candidates = np.zeros(0, dtype='int64')
+        self.is_candidate = np.zeros(0, dtype=bool)
+        self.ceiling = -np.inf # No candidates
+        self.floor = self.bound = np.inf
+        self.limit = 0
+
+    def touch(self, pos):
+        """
+        Point update after brokers pos (unique) changed state: each one that can still
+        reach the floor below the price ceiling becomes a candidate, any other raises bound.
+        """
+        if not self.ceiling > -np.inf: # No candidates yet: the next top() rebuilds
+            return
+        if len(self.is_candidate) < len(self.book):
+            self.is_candidate = np.r_[self.is_candidate, np.zeros(len(self.book) - len(self.is_candidate), dtype=bool)]
+        pos = pos[~self.is_candidate[pos]]
+        upper = self.book.realized_pnl[pos] + (self.ceiling - self.book.avg_cost[pos]) * self.book.qty[pos]
+        rising = ~(upper < self.floor)
+        self.bound = np.max(upper, where=~rising, initial=self.bound)
+        fresh = pos[rising]
+        if len(fresh):
+            self.is_candidate[fresh] = True
+            self.candidates = np.concatenate([self.candidates, fresh])
+
+    def _rebuild(self, price, n):
+        """Exact mask from every broker; re-selects the candidates below a new price ceiling."""
+        pnl = self.book.total_pnl(price, n)
+        mask = top_n_mask(pnl, self.top_n)
+        self.ceiling = -np.inf
+        if not price > 0 or n < self.min_brokers:
+            return mask
+        ceiling = price * (1 + self.band)
+        upper = self.book.total_pnl(ceiling, n)
+        if np.isnan(upper).any():
+            return mask
+        lower = self.book.total_pnl(price * (1 - self.band), n)
+        floor = np.partition(lower, n - self.top_n)[n - self.top_n]
+        keep = upper >= floor
+        self.candidates = np.flatnonzero(keep)
+        self.is_candidate = np.zeros(len(self.book), dtype=bool)
+        self.is_candidate[self.candidates] = True
+        self.ceiling, self.floor = ceiling, floor
+        self.bound = np.max(upper, where=~keep, initial=-np.inf)
+        self.limit = 2 * len(self.candidates) + 64
+        return mask
+
+    def top(self, price, n):
+        """Mask of the top_n brokers among the first n at price (same set as top_n_mask)."""
+        if n <= self.top_n:
+            return np.ones(n, dtype=bool)
+        cand = self.candidates
+        if not price <= self.ceiling or len(cand) < self.top_n or len(cand) > self.limit:
+            return self._rebuild(price, n)
+
+        pnl = self.book.realized_pnl[cand] + (price - self.book.avg_cost[cand]) * self.book.qty[cand]
+        kth = np.partition(pnl, len(cand) - self.top_n)[len(cand) - self.top_n]
+        top = pnl >= kth
+        if not kth > self.bound or np.count_nonzero(top) != self.top_n:
+            return self._rebuild(price, n)
+        mask = np.zeros(n, dtype=bool)
+        mask[cand[top]] = True
+        return mask
+
+def month_ends(dates):
+    """Mask of the dates (sorted) that are the last one of their calendar month, the final date excluded."""
+    periods = pd.DatetimeIndex(dates).to_period('M')
+    return np.r_[periods[1:] != periods[:-1], False]
+
+def _index_flow(flow, book):
+    """Book positions of the flow rows, day bounds, and the number of brokers in the book before each day (+ after the last)."""
+    dates = flow['date'].drop_duplicates().to_numpy()
+    day_bounds = np.searchsorted(flow['date'].to_numpy(), dates, side='left').tolist() + [len(flow)]
+    n_before = len(book)
+    pos = book.positions(flow_broker_codes(flow))
+    # Brokers in state before each day: the book as passed in + new brokers first seen on an earlier row
+    seen = np.r_[0, np.maximum.accumulate(pos) + 1] if len(pos) else np.zeros(1, dtype='int64')
+    return dates, day_bounds, pos, np.maximum(n_before, seen[day_bounds])
+
+def replay(flow, book=None, snapshots=None):
+    """
+    Advances book (default: no state) through every day of flow without ranking: broker
+    state depends only on each broker's own trades, so checkpoints need no prices.
+    snapshots, when given, collects (date, book copy) after every month-end day.
+    """
+    book = BrokerBook() if book is None else book
+    if flow.empty:
+        return book
+    dates, day_bounds, pos, n_known = _index_flow(flow, book)
+    net_qtys = flow['net_buy_qty'].to_numpy(dtype='float64')
+    avg_prices = flow['avg_price'].to_numpy(dtype='float64')
+    notionals = flow['notional'].to_numpy(dtype='float64')
+    is_month_end = month_ends(dates)
+
+    for day_idx in range(len(dates)):
+        lo, hi = day_bounds[day_idx], day_bounds[day_idx + 1]
+        book.apply(pos[lo:hi], net_qtys[lo:hi], avg_prices[lo:hi], notionals[lo:hi])
+        if snapshots is not None and is_month_end[day_idx]:
+            snapshots.append((pd.Timestamp(dates[day_idx]), book.copy(n_known[day_idx + 1])))
+    return book
+
+def _panel_rows(book, date, price, day_pos, day_net, win_pos):
+    """
+    One day of the broker panel, before that day's apply: every broker that trades or is
+    a winner, its winner rank (1 = highest PnL, 0 = not a winner) and its ranking PnL.
+    """
+    rows = np.union1d(day_pos, win_pos)
+    score = book.realized_pnl[rows] + (price - book.avg_cost[rows]) * book.qty[rows]
+    rank = np.zeros(len(rows), dtype='int8')
+    win = np.searchsorted(rows, win_pos)
+    rank[win[np.argsort(-score[win], kind='stable')]] = np.arange(1, len(win) + 1)
+    net = np.zeros(len(rows))
+    net[np.searchsorted(rows, day_pos)] = day_net
+    return {'date': date, 'pos': rows, 'broker_code': book.codes[rows], 'rank': rank, 'score': score, 'net_buy_qty': net}
+
+def panel_frame(days):
+    """
+    Broker panel rows collected by run_bps as one frame: state after each day's trades
+    (qty, avg_cost, realized / unrealized PnL at the day's price, turnover) per row.
+    """
+    columns = ['date', 'broker_code', 'rank', 'score', 'net_buy_qty', 'qty', 'avg_cost', 'realized_pnl', 'unrealized_pnl', 'turnover']
+    if not days:
+        return pd.DataFrame(columns=columns)
+    frame = pd.DataFrame({
+        'date': np.repeat([d['date'] for d in days], [len(d['pos']) for d in days]),
+        'broker_code': np.concatenate([d['broker_code'] for d in days]),
+        'rank': np.concatenate([d['rank'] for d in days]),
+        'score': np.concatenate([d['score'] for d in days]),
+        'net_buy_qty': np.concatenate([d['net_buy_qty'] for d in days])
+    })
+    for col in ('qty', 'avg_cost', 'realized_pnl', 'unrealized_pnl', 'turnover'):
+        frame[col] = np.concatenate([d[col] for d in days])
+    return frame[columns]
+
+def _run_compiled(dates, day_bounds, pos, n_known, prices, net_qtys, avg_prices, notionals, book, top_n):
+    """
+    run_bps days through the compiled kernel (bps_jit.advance), which updates book in
+    place; the days it leaves to the reference ranking (tie at the cut, NaN PnL) are
+    ranked with top_n_mask and applied here before the kernel resumes.
+    """
+    day_bounds = np.asarray(day_bounds, dtype='int64')
+    pos, n_known = pos.astype('int64'), n_known.astype('int64')
+    winners = np.zeros(len(book), dtype=bool)
+    bps = np.zeros(len(dates))
+    args = (day_bounds, pos, net_qtys, avg_prices, notionals, prices, n_known, top_n,
+            book.qty, book.avg_cost, book.realized_pnl, book.turnover, winners, bps)
+
+    day = bps_jit.advance(0, *args)
+    while day < len(dates):
+        lo, hi = day_bounds[day], day_bounds[day + 1]
+        n = n_known[day]
+        winners[:n] = top_n_mask(book.total_pnl(prices[day], n), top_n)
+        bps[day] = net_qtys[lo:hi][winners[pos[lo:hi]]].sum()
+        winners[:n] = False
+        book.apply(pos[lo:hi], net_qtys[lo:hi], avg_prices[lo:hi], notionals[lo:hi])
+        day = bps_jit.advance(day + 1, *args)
+
+    return pd.DataFrame({
+        'date': pd.DatetimeIndex(dates).strftime('%Y-%m-%d'),
+        'price': prices,
+        # Days without known brokers score an int 0, as in run_bps
+        'bps_factor': bps if (n_known[:len(dates)] > 0).any() else bps.astype('int64')
+    })
+
+def run_bps(flow, price_df, book=None, top_n=TOP_N, snapshots=None, panel=None):
+    """
+    Runs the BPS simulation over a date-sorted flow table starting from book (default:
+    no state) and returns (results, book): one row per flow day, and the book advanced
+    past the last day. Brokers new to the book join at first appearance, exactly as
+    calculate_bps adds them to its state. price_df may also be a PriceStore.
+    snapshots, when given, collects (date, book copy) after every month-end day.
+    panel, when given, collects the per-broker panel of every day (see panel_frame):
+    one entry per broker on the days it trades or is a winner.
+    Plain runs (no snapshots / panel) use the compiled kernel when numba is installed
+    (bps_jit); the result is identical.
+    """
+    book = BrokerBook() if book is None else book
+    dates, day_bounds, pos, n_known = _index_flow(flow, book)
+    stock_id = flow['stock_id'].iloc[0]
+    vwaps = day_totals(flow)['vwap'].to_numpy()
+
+    closes, has_close = np.full(len(dates), np.nan), np.zeros(len(dates), dtype=bool)
+    store = price_df if isinstance(price_df, PriceStore) else PriceStore(price_df) if not price_df.empty else None
+    if store is not None:
+        closes, has_close = store.lookup(stock_id, dates)
+    prices = np.where(has_close, closes, vwaps)
+
+    net_qtys = flow['net_buy_qty'].to_numpy(dtype='float64')
+    avg_prices = flow['avg_price'].to_numpy(dtype='float64')
+    notionals = flow['notional'].to_numpy(dtype='float64')
+    if bps_jit.advance is not None and bps_jit.ENABLED and snapshots is None and panel is None:
+        return _run_compiled(dates, day_bounds, pos, n_known, prices, net_qtys, avg_prices, notionals, book, top_n), book
+
+    is_month_end = month_ends(dates)
+    ranking = TopNRanking(book, top_n)
+    winners = np.zeros(len(book), dtype=bool)
+    results = []
+
+    for day_idx, current_date in enumerate(pd.DatetimeIndex(dates)):
+        lo, hi = day_bounds[day_idx], day_bounds[day_idx + 1]
+        current_price = prices[day_idx]
+        n = n_known[day_idx]
+
+        top_winners_net_buy = 0
+        win_pos = np.zeros(0, dtype='int64')
+        if n > 0:
+            winners[:n] = ranking.top(current_price, n)
+            top_winners_net_buy = net_qtys[lo:hi][winners[pos[lo:hi]]].sum()
+            if panel is not None:
+                win_pos = np.flatnonzero(winners[:n])
+            winners[:n] = False
+
+        results.append({
+            'date': current_date.strftime('%Y-%m-%d'),
+            'price': current_price,
+            'bps_factor': top_winners_net_buy
+        })
+        if panel is not None:
+            day = _panel_rows(book, current_date, current_price, pos[lo:hi], net_qtys[lo:hi], win_pos)
+        book.apply(pos[lo:hi], net_qtys[lo:hi], avg_prices[lo:hi], notionals[lo:hi])
+        ranking.touch(pos[lo:hi])
+        if panel is not None:
+            rows = day['pos']
+            day.update(qty=book.qty[rows], avg_cost=book.avg_cost[rows], realized_pnl=book.realized_pnl[rows],
+                       unrealized_pnl=(current_price - book.avg_cost[rows]) * book.qty[rows], turnover=book.turnover[rows])
+            panel.append(day)
+        if snapshots is not None and is_month_end[day_idx]:
+            snapshots.append((current_date, book.copy(n_known[day_idx + 1])))
+
+    return pd.DataFrame(results), book
+
+def calculate_bps_matrix(df, price_df, top_n=TOP_N, snapshots=None, panel=None):
+    """
+    Vectorized calculate_bps: the flow is indexed once as broker positions per day
+    (a CSR-style broker x day layout), every day advances all of that day's brokers'
+    qty / avg_cost / realized PnL together, and the winners come from np.partition.
+    Output is identical to bps_strategy.calculate_bps. snapshots / panel: see run_bps.
+    """
+    if df.empty: return pd.DataFrame()
+
+    flow = df if is_flow(df) else build_flow(df)
+    print(f"Simulating BPS for {flow['stock_id'].iloc[0]} over {flow['date'].nunique()} days (matrix engine)...")
+    return run_bps(flow, price_df, top_n=top_n, snapshots=snapshots, panel=panel)[0]
+
+def _subset_winners(pnl, member, top_n=TOP_N, candidates=64):
+    """
+    Winners mask (k x n) of k broker subsets (member: k x n) from one ranking of pnl.
+    Only the `candidates` highest PnLs are sorted; a subset takes its first top_n members
+    in that order when its (top_n+1)-th member is also among them and ranks strictly
+    lower. Any other subset (few members near the top, a tie at its cut, NaN PnL) is
+    ranked on its own with top_n_mask.
+    """
+    winners = np.zeros_like(member)
+    resolved = np.zeros(len(member), dtype=bool)
+    if not np.isnan(pnl).any():
+        k = min(len(pnl), candidates)
+        top = np.argpartition(-pnl, k - 1)[:k] if k < len(pnl) else np.arange(len(pnl))
+        order = top[np.argsort(-pnl[top], kind='stable')]
+        ranked = member[:, order]
+        rank = np.cumsum(ranked, axis=1)
+        cut = rank[:, -1] > top_n
+        if cut.any():
+            sorted_pnl = pnl[order]
+            kth = np.argmax(ranked & (rank == top_n), axis=1)
+            nxt = np.argmax(ranked & (rank == top_n + 1), axis=1)
+            resolved = cut & (sorted_pnl[kth] > sorted_pnl[nxt])
+            winners[np.ix_(resolved, order)] = (ranked & (rank <= top_n))[resolved]
+    for i in np.flatnonzero(~resolved):
+        known = np.flatnonzero(member[i])
+        winners[i, known[top_n_mask(pnl[known], top_n)]] = True
+    return winners
+
+def calculate_bps_subsets(df, price_df, subsets, top_n=TOP_N):
+    """
+    BPS of several broker universes from one pass over the flow. subsets maps a name to
+    broker IDs (None = every broker); returns {name: result}, each identical to
+    calculate_bps on the flow filtered to that subset. Broker state depends only on each
+    broker's own trades, so one shared book serves every subset, and each day ranks the
+    brokers once for all subsets marked at the same price (_subset_winners).
+    """
+    names = list(subsets)
+    if df.empty: return {name: pd.DataFrame() for name in names}
+
+    flow = df if is_flow(df) else build_flow(df)
+    book = BrokerBook()
+    dates, day_bounds, pos, n_known = _index_flow(flow, book)
+    stock_id = flow['stock_id'].iloc[0]
+    net_qtys = flow['net_buy_qty'].to_numpy(dtype='float64')
+    avg_prices = flow['avg_price'].to_numpy(dtype='float64')
+    notionals = flow['notional'].to_numpy(dtype='float64')
+
+    closes, has_close = np.full(len(dates), np.nan), np.zeros(len(dates), dtype=bool)
+    store = price_df if isinstance(price_df, PriceStore) else PriceStore(price_df) if not price_df.empty else None
+    if store is not None:
+        closes, has_close = store.lookup(stock_id, dates)
+
+    # subsets x brokers membership (book order), subsets x days activity and price
+    member = np.stack([np.ones(len(book), dtype=bool) if subsets[name] is None else np.isin(book.codes, broker_codes(subsets[name])) for name in names])
+    active = np.zeros((len(names), len(dates)), dtype=bool)
+    prices = np.full((len(names), len(dates)), np.nan)
+    for i in range(len(names)):
+        rows = member[i][pos]
+        if rows.any():
+            # VWAP fallback from the subset's own rows, as calculate_bps on the filtered flow
+            totals = day_totals(flow[rows])
+            days = np.searchsorted(dates, totals['date'].to_numpy())
+            active[i, days] = True
+            prices[i, days] = np.where(has_close[days], closes[days], totals['vwap'].to_numpy())
+    bps = [[] for _ in names]
+
+    print(f"Simulating BPS for {stock_id} over {len(dates)} days ({len(names)} broker subsets)...")
+
+    for day_idx in range(len(dates)):
+        lo, hi = day_bounds[day_idx], day_bounds[day_idx + 1]
+        n = n_known[day_idx]
+        day_pos, day_net = pos[lo:hi], net_qtys[lo:hi]
+        today = np.flatnonzero(active[:, day_idx])
+        known = member[today, :n]
+        has_known = known.any(axis=1)
+
+        # One ranking per distinct price: the close for every subset, else each subset's VWAP
+        day_prices = prices[today, day_idx]
+        net_buy = np.zeros(len(today))
+        price_list, price_idx = np.unique(day_prices[has_known], return_inverse=True) # NaN prices form one group
+        for g, price in enumerate(price_list):
+            group = np.zeros(len(today), dtype=bool)
+            group[np.flatnonzero(has_known)[price_idx == g]] = True
+            winners = _subset_winners(book.total_pnl(price, n), known[group], top_n)
+            net_buy[group] = np.where(winners[:, day_pos[day_pos < n]], day_net[day_pos < n], 0).sum(axis=1)
+        for j, i in enumerate(today):
+            bps[i].append(net_buy[j] if has_known[j] else 0)
+
+        book.apply(day_pos, day_net, avg_prices[lo:hi], notionals[lo:hi])
+
+    date_strs = pd.DatetimeIndex(dates).strftime('%Y-%m-%d').tolist()
+    results = {}
+    for i, name in enumerate(names):
+        days = np.flatnonzero(active[i])
+        results[name] = pd.DataFrame([
+            {'date': date_strs[d], 'price': prices[i, d], 'bps_factor': b} for d, b in zip(days, bps[i])
+        ])
+    return results
+
+def variant_name(top_n, metric):
+    """Output column of one (top_n, metric) BPS variant, e.g. bps_top5_total_pnl."""
+    return f'bps_top{top_n}_{metric}'
+
+def calculate_bps_variants(df, price_df, specs):
+    """
+    Several BPS variants from one pass: specs lists (top_n, metric) pairs, metric one
+    of RANK_METRICS. The broker book evolves once; each day every metric is scored once
+    and all of its top_n cuts come from one partial sort (top_n_masks). Returns date,
+    price and one column per spec (variant_name); (TOP_N, RANK_METRIC) is identical to
+    calculate_bps's bps_factor.
+    """
+    if df.empty: return pd.DataFrame()
+    for _, metric in specs:
+        if metric not in RANK_METRICS:
+            raise ValueError(f"Unknown rank metric: {metric} (expected one of {RANK_METRICS})")
+
+    flow = df if is_flow(df) else build_flow(df)
+    book = BrokerBook()
+    dates, day_bounds, pos, n_known = _index_flow(flow, book)
+    stock_id = flow['stock_id'].iloc[0]
+    vwaps = day_totals(flow)['vwap'].to_numpy()
+
+    closes, has_close = np.full(len(dates), np.nan), np.zeros(len(dates), dtype=bool)
+    store = price_df if isinstance(price_df, PriceStore) else PriceStore(price_df) if not price_df.empty else None
+    if store is not None:
+        closes, has_close = store.lookup(stock_id, dates)
+    prices = np.where(has_close, closes, vwaps)
+
+    net_qtys = flow['net_buy_qty'].to_numpy(dtype='float64')
+    avg_prices = flow['avg_price'].to_numpy(dtype='float64')
+    notionals = flow['notional'].to_numpy(dtype='float64')
+    cuts = {metric: sorted({n for n, m in specs if m == metric}) for _, metric in specs}
+    winners = np.zeros(len(book), dtype=bool)
+    results = []
+
+    print(f"Simulating {len(specs)} BPS variants for {stock_id} over {len(dates)} days...")
+
+    for day_idx, current_date in enumerate(pd.DatetimeIndex(dates)):
+        lo, hi = day_bounds[day_idx], day_bounds[day_idx + 1]
+        current_price = prices[day_idx]
+        n = n_known[day_idx]
+        day_pos, day_net = pos[lo:hi], net_qtys[lo:hi]
+
+        row = {'date': current_date.strftime('%Y-%m-%d'), 'price': current_price}
+        for metric, top_ns in cuts.items():
+            masks = top_n_masks(book.scores(metric, current_price, n), top_ns) if n > 0 else {}
+            for top_n in top_ns:
+                top_winners_net_buy = 0
+                if n > 0:
+                    winners[:n] = masks[top_n]
+                    top_winners_net_buy = day_net[winners[day_pos]].sum()
+                    winners[:n] = False
+                row[variant_name(top_n, metric)] = top_winners_net_buy
+        results.append(row)
+        book.apply(day_pos, day_net, avg_prices[lo:hi], notionals[lo:hi])
+
+    return pd.DataFrame(results)[['date', 'price'] + [variant_name(n, m) for n, m in specs]]
+
+def calculate_bps_market(flow, price_df, top_n=TOP_N):
+    """
+    BPS of many stocks in one pass over a shared date axis. flow holds the flow rows of
+    several stocks (each stock date-sorted, as build_flow / load_flow return them);
+    price_df may be a PriceStore. Each stock's brokers take the slots of one row of a
+    padded stocks x brokers book in first-seen order, so a day ranks every active stock
+    at once: PnL is a 2-D array, np.partition along the broker axis gives each stock's
+    top_n-th value (stocks tied at the cut or with NaN PnL are ranked alone with
+    top_n_mask), winner net buys are one bincount over the day's rows and one apply
+    advances every stock. Returns stock_id, date, price and bps_factor, sorted by stock
+    then date; each stock's rows are identical to calculate_bps on its flow.
+    """
+    columns = ['stock_id', 'date', 'price', 'bps_factor']
+    if flow.empty: return pd.DataFrame(columns=columns)
+
+    # Stocks and (stock, broker) pairs in order of first appearance
+    stock_idx, stocks = pd.factorize(flow['stock_id'].astype(str).to_numpy())
+    stocks = pd.Index(stocks)
+    pair, _ = pd.factorize((stock_idx.astype('int64') << 32) | flow_broker_codes(flow).astype('int64'))
+    pair_stock = np.zeros(pair.max() + 1, dtype='int64')
+    pair_stock[pair] = stock_idx
+    pair_order = np.argsort(pair_stock, kind='stable')
+    group_start = np.searchsorted(pair_stock[pair_order], np.arange(len(stocks)))
+    pair_slot = np.empty(len(pair_stock), dtype='int64')
+    pair_slot[pair_order] = np.arange(len(pair_stock)) - group_start[pair_stock[pair_order]]
+    width = int(pair_slot.max()) + 1
+    slot = pair_slot[pair]
+
+    # Rows by date, then stock: each day is one contiguous block of per-stock segments
+    day_ns = flow['date'].to_numpy().astype('datetime64[ns]').view('int64')
+    dates = np.unique(day_ns)
+    day_idx = np.searchsorted(dates, day_ns)
+    order = np.lexsort((stock_idx, day_idx))
+    stock_idx, slot, day_idx = stock_idx[order], slot[order], day_idx[order]
+    flat = stock_idx * width + slot
+    net_qtys = flow['net_buy_qty'].to_numpy(dtype='float64')[order]
+    avg_prices = flow['avg_price'].to_numpy(dtype='float64')[order]
+    notionals = flow['notional'].to_numpy(dtype='float64')[order]
+    day_bounds = np.searchsorted(day_idx, np.arange(len(dates) + 1))
+
+    # stocks x days price: the close, else the stock's VWAP that day
+    prices = np.full((len(stocks), len(dates)), np.nan)
+    totals = day_totals(flow)
+    prices[stocks.get_indexer(totals['stock_id'].astype(str)), np.searchsorted(dates, totals['date'].to_numpy().astype('datetime64[ns]').view('int64'))] = totals['vwap'].to_numpy()
+    store = price_df if isinstance(price_df, PriceStore) else PriceStore(price_df) if not price_df.empty else None
+    if store is not None:
+        for s, stock_id in enumerate(stocks):
+            closes, has_close = store.lookup(stock_id, dates.view('datetime64[ns]'))
+            prices[s, has_close] = closes[has_close]
+
+    book = BrokerBook(np.arange(len(stocks) * width))
+    qty, avg_cost, realized = (a.reshape(len(stocks), width) for a in (book.qty, book.avg_cost, book.realized_pnl))
+    n_known = np.zeros(len(stocks), dtype='int64')
+    slots = np.arange(width)
+    out_stock, out_day, out_price, out_bps = [], [], [], []
+
+    print(f"Simulating BPS for {len(stocks)} stocks over {len(dates)} days (market engine)...")
+
+    for d in range(len(dates)):
+        lo, hi = day_bounds[d], day_bounds[d + 1]
+        if lo == hi: continue
+        day_stock, day_slot, day_net = stock_idx[lo:hi], slot[lo:hi], net_qtys[lo:hi]
+        starts = np.flatnonzero(np.r_[True, day_stock[1:] != day_stock[:-1]])
+        active = day_stock[starts]
+        seg = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, hi - lo]))
+        n = n_known[active]
+        price = prices[active, d]
+        w = int(n.max())
+
+        # Winners of every active stock: unknown slots pad with -inf below any PnL
+        winners = slots[:w] < n[:, None]
+        ranked = n > top_n
+        if ranked.any():
+            r = np.flatnonzero(ranked)
+            pnl = realized[active[r], :w] + (price[r, None] - avg_cost[active[r], :w]) * qty[active[r], :w]
+            pnl[~winners[r]] = -np.inf
+            kth = np.partition(pnl, w - top_n, axis=1)[:, w - top_n]
+            above = pnl > kth[:, None]
+            at = pnl == kth[:, None]
+            exact = ~np.isnan(kth) & (kth > -np.inf) & (above.sum(axis=1) + at.sum(axis=1) == top_n)
+            winners[r] = above | at
+            for i in r[~exact]: # Tie at the cut (or NaN): exact calculate_bps order
+                s = active[i]
+                winners[i, :n[i]] = top_n_mask(realized[s, :n[i]] + (price[i] - avg_cost[s, :n[i]]) * qty[s, :n[i]], top_n)
+
+        known_rows = day_slot < n[seg]
+        is_winner = np.zeros(hi - lo, dtype=bool)
+        is_winner[known_rows] = winners[seg[known_rows], day_slot[known_rows]]
+        bps = np.bincount(seg, weights=np.where(is_winner, day_net, 0.0), minlength=len(active))
+
+        out_stock.append(active)
+        out_day.append(np.full(len(active), d))
+        out_price.append(price)
+        out_bps.append(bps)
+
+        book.apply(flat[lo:hi], day_net, avg_prices[lo:hi], notionals[lo:hi])
+        n_known[active] = np.maximum(n, np.maximum.reduceat(day_slot, starts) + 1)
+
+    out_stock, out_day = np.concatenate(out_stock), np.concatenate(out_day)
+    out_order = np.lexsort((out_day, np.argsort(np.argsort(stocks))[out_stock]))
+    return pd.DataFrame({
+        'stock_id': stocks.to_numpy()[out_stock[out_order]],
+        'date': pd.DatetimeIndex(dates[out_day[out_order]]).strftime('%Y-%m-%d'),
+        'price': np.concatenate(out_price)[out_order],
+        'bps_factor': np.concatenate(out_bps)[out_order]
+    })
@@ -0,0 +1,82 @@
+import numpy as np
+import os
+
+try:
+    from numba import njit
+except ImportError: # Optional: pip install numba (bps_engine keeps its NumPy path otherwise)
+    njit = None
+
+# Configuration
+# BPS_JIT=0 keeps run_bps on the NumPy path even when numba is installed
+ENABLED = os.environ.get('BPS_JIT', '1') == '1'
+
+def _advance(start, day_bounds, pos, net_qtys, avg_prices, notionals, prices, n_known, top_n,
+             qty, avg_cost, realized_pnl, turnover, winners, bps):
+    """
+    The BPS state machine over days start.. of an indexed flow (see bps_engine._index_flow),
+    one tight loop per day: rank the n known brokers at the day's price, sum the winners'
+    net buys into bps[day], then advance every trading broker's qty / avg_cost / realized
+    PnL / turnover in place. Same arithmetic as BrokerBook.total_pnl / apply. Returns the
+    first day whose ranking is ambiguous (tie at the top_n cut or NaN PnL), before its
+    trades, so the caller can rank it with top_n_mask; len(prices) when all days are done.
+    """
+    top_pnl = np.empty(top_n + 1)
+    top_pos = np.empty(top_n + 1, dtype=np.int64)
+    for day in range(start, len(prices)):
+        lo, hi = day_bounds[day], day_bounds[day + 1]
+        n = n_known[day]
+        price = prices[day]
+
+        if n > top_n:
+            # The top_n + 1 highest PnLs, best first, by insertion
+            k = 0
+            for i in range(n):
+                pnl = realized_pnl[i] + (price - avg_cost[i]) * qty[i]
+                if pnl != pnl:
+                    return day
+                if k <= top_n:
+                    k += 1
+                elif not pnl > top_pnl[top_n]:
+                    continue
+                j = k - 1
+                while j > 0 and pnl > top_pnl[j - 1]:
+                    top_pnl[j] = top_pnl[j - 1]
+                    top_pos[j] = top_pos[j - 1]
+                    j -= 1
+                top_pnl[j] = pnl
+                top_pos[j] = i
+            if top_pnl[top_n - 1] == top_pnl[top_n]:
+                return day
+            for j in range(top_n):
+                winners[top_pos[j]] = True
+        else:
+            for i in range(n):
+                winners[i] = True
+
+        net_buy = 0.0
+        for r in range(lo, hi):
+            if winners[pos[r]]:
+                net_buy += net_qtys[r]
+        bps[day] = net_buy
+        if n > top_n:
+            for j in range(top_n):
+                winners[top_pos[j]] = False
+        else:
+            for i in range(n):
+                winners[i] = False
+
+        for r in range(lo, hi):
+            p = pos[r]
+            net = net_qtys[r]
+            turnover[p] += notionals[r]
+            q, cost = qty[p], avg_cost[p]
+            if net > 0:
+                avg_cost[p] = (q * cost + net * avg_prices[r]) / (q + net)
+                qty[p] = q + net
+            elif net < 0 and q > 0:
+                sold = abs(net)
+                realized_pnl[p] += (avg_prices[r] - cost) * min(sold, q)
+                qty[p] = max(0.0, q - sold)
+    return len(prices)
+
+advance = njit(cache=True)(_advance) if njit is not None else None
@@ -0,0 +1,374 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import json
+import os
+from bps_engine import BrokerBook, run_bps, replay, top_n_mask, panel_frame, TOP_N, RANK_METRIC
+from branch_data import standardize_branch, branch_date_range
+from broker_flow import is_flow, build_flow, select_brokers, load_flow, day_totals
+from factor_store import write_factors, append_factors
+from id_codes import get_id_codes, broker_codes
+from price_store import PriceStore, get_price_store
+
+# Configuration
+# One file per stock: the broker book after the last processed day, so the daily
+# update applies only the new day instead of replaying the whole history
+STATE_DIR = 'data/bps_state'
+STATE_KEY = 'bps_state'
+FACTOR = 'smart_bps'
+# Month-end snapshots of every broker's state, one file per stock (rows grouped by date,
+# in book order): runs resume from the nearest one instead of replaying from the first day
+CHECKPOINT_DIR = 'data/bps_checkpoints'
+CHECKPOINT_SCHEMA = pa.schema([('date', pa.timestamp('ns')), ('securities_trader_id', pa.string()),
+                               ('qty', pa.float64()), ('avg_cost', pa.float64()), ('realized_pnl', pa.float64()),
+                               ('turnover', pa.float64())])
+# Per-broker panel of a BPS series, stored sparsely: one row per broker on the days it trades
+# or ranks as a winner (state after that day), plus the day prices to mark it in between.
+# data/bps_panel/factor=smart_bps/stock_id=6215/{brokers,days}.parquet. Opt-in: BPS_PANEL=1
+# makes start_bps write it (update_bps extends any stored panel), or calculate_bps(panel=...)
+PANEL_DIR = 'data/bps_panel'
+PANEL = os.environ.get('BPS_PANEL') == '1'
+PANEL_SCHEMA = pa.schema([('date', pa.timestamp('ns')), ('securities_trader_id', pa.string()), ('rank', pa.int8()),
+                          ('score', pa.float64()), ('net_buy_qty', pa.float64()), ('qty', pa.float64()),
+                          ('avg_cost', pa.float64()), ('realized_pnl', pa.float64()), ('unrealized_pnl', pa.float64()),
+                          ('turnover', pa.float64())])
+PANEL_DAYS_SCHEMA = pa.schema([('date', pa.timestamp('ns')), ('price', pa.float64()), ('bps_factor', pa.float64())])
+
+def state_path(stock_id, root=STATE_DIR):
+    return os.path.join(root, f'{stock_id}.parquet')
+
+class BpsState:
+    """
+    Persisted BPS state of one stock: the broker book (qty / avg_cost / realized_pnl /
+    turnover per broker, in first-seen order), the last processed date and the broker subset the
+    series is restricted to (Smart BPS brokers; None = every broker).
+    """
+    def __init__(self, stock_id, book=None, last_date=None, broker_ids=None, top_n=TOP_N):
+        self.stock_id = str(stock_id)
+        self.book = BrokerBook() if book is None else book
+        self.last_date = None if last_date is None else pd.Timestamp(last_date)
+        self.broker_ids = None if broker_ids is None else [str(b) for b in broker_ids]
+        self.top_n = top_n
+
+    @classmethod
+    def load(cls, stock_id, root=STATE_DIR):
+        """The stored state of stock_id, or None when it has not been started."""
+        path = state_path(stock_id, root)
+        if not os.path.exists(path):
+            return None
+        table = pq.read_table(path)
+        meta = json.loads(table.schema.metadata[STATE_KEY.encode()])
+        df = table.to_pandas()
+        book = BrokerBook(broker_codes(df['securities_trader_id']), df['qty'], df['avg_cost'], df['realized_pnl'], df['turnover'])
+        return cls(stock_id, book, meta['last_date'], meta['broker_ids'], meta['top_n'])
+
+    def save(self, root=STATE_DIR):
+        # Broker IDs, not codes, on disk: the state stays valid for IDs the code dictionary has not persisted
+        table = pa.table({
+            'securities_trader_id': pa.array(get_id_codes().decode('broker', self.book.codes), pa.string()),
+            'qty': self.book.qty,
+            'avg_cost': self.book.avg_cost,
+            'realized_pnl': self.book.realized_pnl,
+            'turnover': self.book.turnover
+        })
+        meta = {'last_date': None if self.last_date is None else self.last_date.strftime('%Y-%m-%d'),
+                'broker_ids': self.broker_ids, 'top_n': self.top_n}
+        table = table.replace_schema_metadata({STATE_KEY: json.dumps(meta)})
+        path = state_path(self.stock_id, root)
+        os.makedirs(root, exist_ok=True)
+        tmp_path = os.path.join(root, f'.{os.path.basename(path)}.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+def _flow(stock_id, rows):
+    """Broker-day flow of stock_id from raw branch rows or a flow table (other stocks are dropped)."""
+    flow = rows if is_flow(rows) else build_flow(standardize_branch(rows))
+    return flow[flow['stock_id'].astype(str) == str(stock_id)].reset_index(drop=True)
+
+def start_bps(stock_id, rows, price_df, broker_ids=None, factor=FACTOR, root=STATE_DIR, panel=None):
+    """
+    Full-history BPS that also stores the final broker book, so later days can be added
+    with update_bps. Writes the series to the factor store and returns it.
+    panel: also store the per-broker panel (default: PANEL).
+    """
+    flow = _flow(stock_id, rows)
+    if broker_ids is not None:
+        flow = select_brokers(flow, broker_ids)
+    if flow.empty:
+        return pd.DataFrame()
+
+    days = [] if (PANEL if panel is None else panel) else None
+    results, book = run_bps(flow, price_df, panel=days)
+    BpsState(stock_id, book, flow['date'].iloc[-1], broker_ids).save(root)
+    write_factors(stock_id, results[['date', 'price', 'bps_factor']].rename(columns={'bps_factor': factor}))
+    if days is not None:
+        write_panel(stock_id, days, results, factor)
+    return results
+
+def update_bps(stock_id, new_day_rows, price_df=None, factor=FACTOR, root=STATE_DIR):
+    """
+    Applies only the new day(s) in new_day_rows (raw branch rows or a flow table) to the
+    stored broker book, appends the new factor rows and saves the advanced state. Days
+    on or before the last processed date are skipped, so re-running a day is a no-op.
+    price_df: DataFrame or PriceStore (default: the process-wide PriceStore).
+    """
+    state = BpsState.load(stock_id, root)
+    if state is None:
+        print(f"No BPS state for {stock_id}: run start_bps (run_smart_bps) first")
+        return pd.DataFrame()
+
+    flow = _flow(stock_id, new_day_rows)
+    if state.last_date is not None:
+        flow = flow[flow['date'] > state.last_date]
+    if flow.empty:
+        return pd.DataFrame()
+    last_date = flow['date'].iloc[-1]
+    if state.broker_ids is not None:
+        flow = select_brokers(flow, state.broker_ids)
+
+    results = pd.DataFrame()
+    if not flow.empty:
+        days = [] if has_panel(stock_id, factor) else None
+        results, state.book = run_bps(flow.reset_index(drop=True), get_price_store() if price_df is None else price_df, state.book, state.top_n, panel=days)
+        append_factors(stock_id, results[['date', 'price', 'bps_factor']].rename(columns={'bps_factor': factor}))
+        if days is not None:
+            write_panel(stock_id, days, results, factor, append=True)
+    state.last_date = last_date
+    state.save(root)
+    return results
+
+def update_all(new_day_rows, stock_ids=None, price_df=None, factor=FACTOR, root=STATE_DIR):
+    """
+    Daily update of every stock with a stored state (or stock_ids) from one market-wide
+    batch of branch rows: the flow is built once and each stock advances only its new day.
+    """
+    flow = new_day_rows if is_flow(new_day_rows) else build_flow(standardize_branch(new_day_rows))
+    store = get_price_store() if price_df is None else price_df
+    if stock_ids is None:
+        stock_ids = [f[:-len('.parquet')] for f in sorted(os.listdir(root)) if f.endswith('.parquet')] if os.path.isdir(root) else []
+
+    by_stock = dict(tuple(flow.groupby(flow['stock_id'].astype(str), sort=False)))
+    updated = 0
+    for stock_id in stock_ids:
+        if str(stock_id) in by_stock:
+            updated += not update_bps(stock_id, by_stock[str(stock_id)], store, factor, root).empty
+    print(f"Updated BPS for {updated} of {len(stock_ids)} stocks")
+    return updated
+
+def checkpoint_path(stock_id, root=CHECKPOINT_DIR):
+    return os.path.join(root, f'{stock_id}.parquet')
+
+def write_checkpoints(stock_id, snapshots, root=CHECKPOINT_DIR):
+    """
+    Stores (date, BrokerBook) snapshots of the stock's full broker book (every broker,
+    state accumulated from the first day), replacing stored checkpoints of the same dates.
+    """
+    if not snapshots:
+        return
+    ids = get_id_codes()
+    tables = [pa.table({
+        'date': pa.array(np.full(len(book), np.datetime64(date, 'ns')), pa.timestamp('ns')),
+        'securities_trader_id': pa.array(ids.decode('broker', book.codes), pa.string()),
+        'qty': book.qty, 'avg_cost': book.avg_cost, 'realized_pnl': book.realized_pnl, 'turnover': book.turnover
+    }, schema=CHECKPOINT_SCHEMA) for date, book in snapshots]
+    table = pa.concat_tables(tables)
+
+    path = checkpoint_path(stock_id, root)
+    if os.path.exists(path):
+        old = pq.read_table(path, schema=CHECKPOINT_SCHEMA)
+        keep = pc.invert(pc.is_in(old['date'], value_set=pa.array(pd.unique(table['date'].to_numpy()), pa.timestamp('ns'))))
+        table = pa.concat_tables([old.filter(keep), table])
+    # Stable sort keeps each date's rows in book order
+    order = np.argsort(table['date'].to_numpy(), kind='stable')
+    os.makedirs(root, exist_ok=True)
+    tmp_path = os.path.join(root, f'.{os.path.basename(path)}.tmp')
+    pq.write_table(table.take(order), tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+def checkpoint_dates(stock_id, root=CHECKPOINT_DIR):
+    """Sorted dates with a stored checkpoint (reads only the date column)."""
+    path = checkpoint_path(stock_id, root)
+    if not os.path.exists(path):
+        return pd.DatetimeIndex([])
+    return pd.DatetimeIndex(pd.unique(pq.read_table(path, columns=['date'])['date'].to_numpy())).sort_values()
+
+def load_checkpoint(stock_id, before, root=CHECKPOINT_DIR):
+    """(date, BrokerBook) of the latest checkpoint strictly before `before`, or (None, None)."""
+    dates = checkpoint_dates(stock_id, root)
+    idx = dates.searchsorted(pd.Timestamp(before), side='left') - 1
+    if idx < 0:
+        return None, None
+    date = dates[idx]
+    df = pq.read_table(checkpoint_path(stock_id, root), filters=[('date', '==', date)]).to_pandas()
+    return date, BrokerBook(broker_codes(df['securities_trader_id']), df['qty'], df['avg_cost'], df['realized_pnl'], df['turnover'])
+
+def build_checkpoints(stock_id, flow=None, root=CHECKPOINT_DIR):
+    """
+    Month-end checkpoints from the stock's full broker-day flow (default: load_flow).
+    Only state is replayed (no ranking or prices), so this is a fast single pass.
+    """
+    flow = load_flow(stock_id) if flow is None else flow
+    snapshots = []
+    replay(flow, snapshots=snapshots)
+    write_checkpoints(stock_id, snapshots, root)
+    return len(snapshots)
+
+def is_full_history(stock_id, flow):
+    """True when flow starts on the stock's first branch day (so its broker state is not reset mid-history)."""
+    first, _ = branch_date_range(stock_id)
+    return not flow.empty and first is not None and flow['date'].iloc[0] <= first
+
+def _start_book(stock_id, start_date, flow, root):
+    """Book to run from start_date: nearest checkpoint before it (built from flow when none exist) and its date."""
+    ckpt_date, book = load_checkpoint(stock_id, start_date, root)
+    if ckpt_date is None and flow is not None and is_full_history(stock_id, flow) and checkpoint_dates(stock_id, root).empty:
+        build_checkpoints(stock_id, flow, root)
+        ckpt_date, book = load_checkpoint(stock_id, start_date, root)
+    return ckpt_date, book
+
+def resume_bps(stock_id, price_df, start_date, end_date=None, broker_ids=None, flow=None, top_n=TOP_N, root=CHECKPOINT_DIR):
+    """
+    BPS from start_date with broker PnL carried over from the full history: the run starts
+    from the nearest checkpoint before start_date and replays only the days after it.
+    Equal to a full-history run filtered to [start_date, end_date] (not a flat restart).
+    flow: the stock's full flow if already loaded (else only the days after the checkpoint are read).
+    """
+    stock_id = str(stock_id)
+    ckpt_date, book = _start_book(stock_id, start_date, flow, root)
+    if flow is None:
+        flow = load_flow(stock_id, start_date=None if ckpt_date is None else ckpt_date + pd.Timedelta(days=1), end_date=end_date)
+    if flow.empty:
+        return pd.DataFrame()
+    if ckpt_date is not None:
+        flow = flow[flow['date'] > ckpt_date]
+    if end_date is not None:
+        flow = flow[flow['date'] <= pd.Timestamp(end_date)]
+    if broker_ids is not None:
+        flow = select_brokers(flow, broker_ids)
+        book = None if book is None else book.subset(broker_codes(broker_ids))
+    if flow.empty:
+        return pd.DataFrame()
+
+    results, _ = run_bps(flow.reset_index(drop=True), price_df, book, top_n)
+    return results[pd.to_datetime(results['date']) >= pd.Timestamp(start_date)].reset_index(drop=True)
+
+def top_winners(stock_id, date, n=TOP_N, broker_ids=None, price_df=None, metric=RANK_METRIC, root=CHECKPOINT_DIR):
+    """
+    The n brokers BPS ranks as winners on `date` (by metric, default total PnL, before
+    that day's trades, marked at that day's close, else its VWAP), from the nearest
+    checkpoint instead of a replay from the first day. Returns one row per broker, best first.
+    """
+    stock_id, date = str(stock_id), pd.Timestamp(date)
+    ckpt_date, book = _start_book(stock_id, date, None, root)
+    day_flow = load_flow(stock_id, start_date=None if ckpt_date is None else ckpt_date + pd.Timedelta(days=1), end_date=date)
+    if broker_ids is not None:
+        day_flow = select_brokers(day_flow, broker_ids) if not day_flow.empty else day_flow
+        book = None if book is None else book.subset(broker_codes(broker_ids))
+    history = day_flow[day_flow['date'] < date] if not day_flow.empty else day_flow
+    book = replay(history.reset_index(drop=True), book)
+    if len(book) == 0:
+        return pd.DataFrame(columns=['securities_trader_id', 'score', 'total_pnl', 'qty', 'avg_cost', 'realized_pnl', 'turnover'])
+
+    store = get_price_store() if price_df is None else price_df if isinstance(price_df, PriceStore) else PriceStore(price_df)
+    price = store.close(stock_id, date)
+    if price is None:
+        today = day_flow[day_flow['date'] == date] if not day_flow.empty else day_flow
+        price = day_totals(today)['vwap'].iloc[0] if not today.empty else None
+    if price is None: # Not a trading day: mark at the last close before it
+        last = store.history(stock_id, end=date)
+        price = last['close'].iloc[-1] if not last.empty else np.nan
+
+    scores = book.scores(metric, price)
+    mask = top_n_mask(scores, n)
+    winners = pd.DataFrame({
+        'securities_trader_id': get_id_codes().decode('broker', book.codes[mask]),
+        'score': scores[mask],
+        'total_pnl': book.total_pnl(price)[mask],
+        'qty': book.qty[mask],
+        'avg_cost': book.avg_cost[mask],
+        'realized_pnl': book.realized_pnl[mask],
+        'turnover': book.turnover[mask]
+    })
+    return winners.sort_values('score', ascending=False, kind='stable').reset_index(drop=True)
+
+def panel_path(stock_id, name, factor=FACTOR, root=PANEL_DIR):
+    return os.path.join(root, f'factor={factor}', f'stock_id={stock_id}', f'{name}.parquet')
+
+def has_panel(stock_id, factor=FACTOR, root=PANEL_DIR):
+    return os.path.exists(panel_path(str(stock_id), 'brokers', factor, root))
+
+def write_panel(stock_id, days, results, factor=FACTOR, root=PANEL_DIR, append=False):
+    """
+    Stores the broker panel collected by run_bps(panel=days) with the run's results
+    (date, price, bps_factor). append=True keeps the stored rows before the first new day.
+    """
+    stock_id = str(stock_id)
+    rows = panel_frame(days)
+    brokers = pa.table({
+        'date': pa.array(pd.to_datetime(rows['date']).astype('datetime64[ns]').to_numpy(), pa.timestamp('ns')),
+        'securities_trader_id': pa.array(get_id_codes().decode('broker', rows['broker_code'].to_numpy()), pa.string()),
+        **{col: rows[col].to_numpy() for col in PANEL_SCHEMA.names[2:]}
+    }, schema=PANEL_SCHEMA)
+    prices = pa.table({
+        'date': pa.array(pd.to_datetime(results['date']).astype('datetime64[ns]').to_numpy(), pa.timestamp('ns')),
+        'price': pd.to_numeric(results['price']).astype('float64').to_numpy(),
+        'bps_factor': pd.to_numeric(results['bps_factor']).astype('float64').to_numpy()
+    }, schema=PANEL_DAYS_SCHEMA)
+
+    for name, table in (('brokers', brokers), ('days', prices)):
+        path = panel_path(stock_id, name, factor, root)
+        if append and os.path.exists(path) and table.num_rows:
+            old = pq.read_table(path, schema=table.schema)
+            table = pa.concat_tables([old.filter(pc.less(old['date'], table['date'][0])), table])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), f'.{name}.parquet.tmp')
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+
+def load_panel(stock_id, start_date=None, end_date=None, broker_ids=None, factor=FACTOR, daily=False, root=PANEL_DIR):
+    """
+    Stored broker panel rows in [start_date, end_date]: per broker and day it traded or
+    ranked as a winner, its winner rank (1 = highest PnL, 0 = none), ranking PnL (score,
+    before the day's trades), net buy and its state after the day. daily=True carries each
+    broker's state to every day from its first row on, marked at that day's price.
+    """
+    stock_id = str(stock_id)
+    path = panel_path(stock_id, 'brokers', factor, root)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=PANEL_SCHEMA.names)
+    filters = []
+    if end_date is not None:
+        filters.append(('date', '<=', pd.Timestamp(end_date)))
+    if broker_ids is not None:
+        filters.append(('securities_trader_id', 'in', [str(b) for b in broker_ids]))
+    rows = pq.read_table(path, filters=filters or None).to_pandas()
+    if daily:
+        days = pq.read_table(panel_path(stock_id, 'days', factor, root), filters=filters[:1] or None).to_pandas()
+        if start_date is not None:
+            days = days[days['date'] >= pd.Timestamp(start_date)]
+        brokers = rows['securities_trader_id'].unique()
+        grid = pd.DataFrame({
+            'date': np.repeat(days['date'].to_numpy(), len(brokers)),
+            'securities_trader_id': np.tile(brokers, len(days)),
+            'price': np.repeat(days['price'].to_numpy(), len(brokers))
+        })
+        state = ['date', 'securities_trader_id', 'qty', 'avg_cost', 'realized_pnl', 'turnover']
+        grid = pd.merge_asof(grid, rows[state], on='date', by='securities_trader_id').dropna(subset=['qty'])
+        grid = grid.merge(rows[['date', 'securities_trader_id', 'rank', 'net_buy_qty']], on=['date', 'securities_trader_id'], how='left')
+        grid['rank'] = grid['rank'].fillna(0).astype('int8')
+        grid['net_buy_qty'] = grid['net_buy_qty'].fillna(0.0)
+        grid['unrealized_pnl'] = (grid['price'] - grid['avg_cost']) * grid['qty']
+        grid['total_pnl'] = grid['realized_pnl'] + grid['unrealized_pnl']
+        return grid.sort_values(['date', 'securities_trader_id'], kind='stable').reset_index(drop=True)
+    if start_date is not None:
+        rows = rows[rows['date'] >= pd.Timestamp(start_date)]
+    return rows.reset_index(drop=True)
+
+if __name__ == "__main__":
+    # python src/bps_state.py <branch rows .parquet/.csv for the new day(s)>
+    import sys
+    path = sys.argv[1]
+    rows = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+    update_all(rows)
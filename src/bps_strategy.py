@@ -1,53 +1,60 @@
 import pandas as pd
+import numpy as np
 import glob
 import os
+from branch_data import load_branch, standardize_branch, iter_branch_days, PARTITIONED_DIR
+from price_store import PriceStore, get_price_store
+from broker_flow import is_flow, build_flow, day_totals, flow_broker_codes
+from id_codes import broker_codes
+from bps_engine import calculate_bps_matrix
+from bps_state import write_checkpoints, is_full_history, write_panel
+import tick_cache
 
 # Configuration
 LOOKBACK_DAYS = 60 # Adjusted to 60 days as per user request
 DATA_DIR = 'data/'
 PRICE_DB_PATH = 'data/stock_price_history.parquet'
+# Opt-in: BPS_STREAMING=1 runs Smart BPS out-of-core (calculate_bps_streaming) for multi-year histories
+STREAMING = os.environ.get('BPS_STREAMING') == '1'
+# calculate_bps engine: 'matrix' (vectorized, bps_engine) or 'loop' (per-broker dict reference)
+ENGINE = os.environ.get('BPS_ENGINE', 'matrix')
 
 def load_price_data(stock_id):
-    """Loads OHLCV data for the specific stock."""
+    """Loads OHLCV data for the specific stock (sliced from the process-wide PriceStore)."""
     if not os.path.exists(PRICE_DB_PATH):
         print("Price DB not found.")
         return pd.DataFrame()
     
     try:
-        df = pd.read_parquet(PRICE_DB_PATH)
-        df = df[df['stock_id'] == str(stock_id)]
-        return df
+        if tick_cache.ENABLED:
+            return tick_cache.load_prices_cached(stock_id)
+        return get_price_store().history(stock_id)
     except Exception as e:
         print(f"Error loading price data: {e}")
         return pd.DataFrame()
 
-def load_data(stock_id):
-    """Loads transactions from consolidated StockBranch.parquet and filters for the specific stock."""
+def load_data(stock_id, df=None):
+    """
+    Loads transactions from consolidated StockBranch.parquet and filters for the specific stock.
+    Pass df (raw rows from branch_data.iter_branch_by_stock, or a broker-day flow table)
+    to reuse an already-loaded frame.
+    """
     file_path = os.path.join(DATA_DIR, 'StockBranch.parquet')
-    if not os.path.exists(file_path):
+    if df is None and not os.path.exists(file_path) and not os.path.isdir(PARTITIONED_DIR):
         print(f"File not found: {file_path}")
         return pd.DataFrame()
 
-    print(f"Reading from {file_path} for {stock_id}...")
     try:
-        df = pd.read_parquet(file_path, filters=[('CommodityId', '==', str(stock_id))])
+        if df is None:
+            print(f"Reading from {file_path} for {stock_id}...")
+        # Standardized names + compact dtypes (datetime64 date, categorical broker IDs)
+        if df is None or not is_flow(df):
+            df = load_branch(stock_id, df=df)
         
         if df.empty:
             print(f"No data found for stock {stock_id} in StockBranch.parquet")
             return pd.DataFrame()
 
-        # Standardize column names
-        df = df.rename(columns={
-            'Date': 'date',
-            'CommodityId': 'stock_id',
-            'SecuritiesTraderId': 'securities_trader_id',
-            'Price': 'price',
-            'Buy': 'buy',
-            'Sell': 'sell'
-        })
-        
-        # Ensure date is string and sorted
-        df['date'] = df['date'].astype(str)
         df = df.sort_values(['date', 'securities_trader_id'])
         
         print(f"Loaded {len(df)} transactions for {stock_id}")
@@ -56,23 +63,83 @@ def load_data(stock_id):
         print(f"Error loading StockBranch.parquet: {e}")
         return pd.DataFrame()
 
-def calculate_bps(df, price_df):
+def _top_winners_net_buy(broker_state, current_price, daily_ids, daily_net):
+    """Today's net buy of the 5 brokers with the highest total PnL (realized + marked at current_price) BEFORE today."""
+    broker_pnls = []
+    for bid, state in broker_state.items():
+        unrealized = (current_price - state['avg_cost']) * state['qty']
+        total_pnl = state['realized_pnl'] + unrealized
+        broker_pnls.append({'securities_trader_id': bid, 'total_pnl': total_pnl})
+
+    df_pnl = pd.DataFrame(broker_pnls)
+    top_winners_net_buy = 0
+
+    if not df_pnl.empty:
+        df_pnl = df_pnl.sort_values('total_pnl', ascending=False)
+        top_5_ids = df_pnl.head(5)['securities_trader_id'].tolist()
+        top_winners_net_buy = daily_net[np.isin(daily_ids, top_5_ids)].sum()
+    return top_winners_net_buy
+
+def _update_state(broker_state, daily_ids, daily_net, daily_avg):
+    """Applies one day's net buys at their VWAPs: average-cost buys, realized PnL on sells."""
+    for bid, net_qty, avg_p in zip(daily_ids, daily_net, daily_avg):
+        if bid not in broker_state:
+            broker_state[bid] = {'qty': 0, 'avg_cost': 0, 'realized_pnl': 0}
+
+        st = broker_state[bid]
+        if net_qty > 0:
+            new_cost = (st['qty'] * st['avg_cost'] + net_qty * avg_p) / (st['qty'] + net_qty)
+            st['qty'] += net_qty
+            st['avg_cost'] = new_cost
+        elif net_qty < 0:
+            sell_qty = abs(net_qty)
+            if st['qty'] > 0:
+                profit = (avg_p - st['avg_cost']) * min(sell_qty, st['qty'])
+                st['realized_pnl'] += profit
+                st['qty'] = max(0, st['qty'] - sell_qty)
+
+def calculate_bps(df, price_df, engine=None, checkpoints=False, panel=None):
     """
     Calculates Broker Profitability Score (BPS).
+    df: raw branch rows or a broker-day flow table (broker_flow.build_flow / load_flow).
+    engine: 'matrix' or 'loop' (default ENGINE); both return identical results.
+    checkpoints: also store month-end broker-state checkpoints (bps_state) for resume_bps /
+    top_winners. Only for the stock's full, all-broker history (not a window or subset).
+    panel: factor name (e.g. 'original_bps') to also store the per-broker panel under
+    (bps_state.load_panel): daily positions, PnL and winner ranks of this run.
     """
     if df.empty: return pd.DataFrame()
+    if checkpoints or panel:
+        flow = df if is_flow(df) else build_flow(df)
+        snapshots = [] if checkpoints else None
+        days = [] if panel else None
+        bps = calculate_bps_matrix(flow, price_df, snapshots=snapshots, panel=days)
+        stock_id = str(flow['stock_id'].iloc[0])
+        if panel:
+            write_panel(stock_id, days, bps, panel)
+        if checkpoints and is_full_history(stock_id, flow):
+            write_checkpoints(stock_id, snapshots)
+        elif checkpoints:
+            print(f"Skipped checkpoints for {stock_id}: df does not start on the stock's first day")
+        return bps
+    if (engine or ENGINE) == 'matrix':
+        return calculate_bps_matrix(df, price_df)
+
+    # Broker-day net buy + VWAP for every day at once (instead of a groupby-apply per day)
+    flow = df if is_flow(df) else build_flow(df)
+    dates = flow['date'].drop_duplicates().to_numpy()
+    stock_id = flow['stock_id'].iloc[0]
+    day_bounds = np.searchsorted(flow['date'].to_numpy(), dates, side='left').tolist() + [len(flow)]
+    vwaps = day_totals(flow)['vwap'].to_numpy()
     
-    # Sort by date
-    df = df.sort_values('date')
-    dates = sorted(df['date'].unique())
-    stock_id = df['stock_id'].iloc[0]
-    
-    # Create a map for fast price lookup: date -> close_price
-    price_map = {}
+    # Close for every simulated day in one indexed lookup (found=False -> VWAP fallback)
+    closes, has_close = np.full(len(dates), np.nan), np.zeros(len(dates), dtype=bool)
     if not price_df.empty:
-        price_map = price_df.set_index('date')['close'].to_dict()
-        # Convert index dates to string for matching if necessary
-        price_map = {str(k).split('T')[0]: v for k, v in price_map.items()}
+        closes, has_close = PriceStore(price_df).lookup(stock_id, dates)
+    
+    broker_ids = flow_broker_codes(flow) # int32 codes: per-day isin and state keys on integers
+    net_qtys = flow['net_buy_qty'].to_numpy(dtype='float64')
+    avg_prices = flow['avg_price'].to_numpy(dtype='float64')
     
     # State tracking
     broker_state = {}
@@ -80,72 +147,68 @@ def calculate_bps(df, price_df):
 
     print(f"Simulating BPS for {stock_id} over {len(dates)} days...")
 
-    for current_date in dates:
-        daily_tx = df[df['date'] == current_date]
-        
+    for day_idx, current_date in enumerate(pd.DatetimeIndex(dates)):
+        lo, hi = day_bounds[day_idx], day_bounds[day_idx + 1]
         # 1. Determine Current Price for Valuation
-        curr_date_str = str(current_date).split(' ')[0]
-        if curr_date_str in price_map:
-            current_price = price_map[curr_date_str]
-        else:
-            total_vol = daily_tx['buy'].sum() + daily_tx['sell'].sum()
-            total_amt = (daily_tx['price'] * (daily_tx['buy'] + daily_tx['sell'])).sum()
-            current_price = total_amt / total_vol if total_vol > 0 else 0
+        current_price = closes[day_idx] if has_close[day_idx] else vwaps[day_idx]
         
-        # 2. Calculate Daily Net Buy
-        daily_summary = daily_tx.groupby('securities_trader_id')[['buy', 'sell', 'price']].apply(
-            lambda x: pd.Series({
-                'net_buy_qty': x['buy'].sum() - x['sell'].sum(),
-                'avg_price': (x['price'] * (x['buy'] + x['sell'])).sum() / (x['buy'] + x['sell']).sum() if (x['buy'] + x['sell']).sum() > 0 else 0
-            }),
-            include_groups=False
-        ).reset_index()
+        # 2. Daily Net Buy per broker (rows lo:hi of the flow table, in broker order)
+        daily_ids = broker_ids[lo:hi]
+        daily_net = net_qtys[lo:hi]
         
         # 3. Calculate Historical Performance (BEFORE today)
-        broker_pnls = []
-        for bid, state in broker_state.items():
-            unrealized = (current_price - state['avg_cost']) * state['qty']
-            total_pnl = state['realized_pnl'] + unrealized
-            broker_pnls.append({'securities_trader_id': bid, 'total_pnl': total_pnl})
-        
-        df_pnl = pd.DataFrame(broker_pnls)
-        top_winners_net_buy = 0
-        
-        if not df_pnl.empty:
-            df_pnl = df_pnl.sort_values('total_pnl', ascending=False)
-            top_5_ids = df_pnl.head(5)['securities_trader_id'].tolist()
-            winners_today = daily_summary[daily_summary['securities_trader_id'].isin(top_5_ids)]
-            top_winners_net_buy = winners_today['net_buy_qty'].sum()
+        top_winners_net_buy = _top_winners_net_buy(broker_state, current_price, daily_ids, daily_net)
             
         results.append({
-            'date': current_date,
+            'date': current_date.strftime('%Y-%m-%d'),
             'price': current_price,
             'bps_factor': top_winners_net_buy
         })
 
         # 4. Update State
-        for idx, row in daily_summary.iterrows():
-            bid = row['securities_trader_id']
-            net_qty = row['net_buy_qty']
-            avg_p = row['avg_price'] 
-            
-            if bid not in broker_state:
-                broker_state[bid] = {'qty': 0, 'avg_cost': 0, 'realized_pnl': 0}
-            
-            st = broker_state[bid]
-            if net_qty > 0:
-                new_cost = (st['qty'] * st['avg_cost'] + net_qty * avg_p) / (st['qty'] + net_qty)
-                st['qty'] += net_qty
-                st['avg_cost'] = new_cost
-            elif net_qty < 0:
-                sell_qty = abs(net_qty)
-                if st['qty'] > 0:
-                    profit = (avg_p - st['avg_cost']) * min(sell_qty, st['qty'])
-                    st['realized_pnl'] += profit
-                    st['qty'] = max(0, st['qty'] - sell_qty)
+        _update_state(broker_state, daily_ids, daily_net, avg_prices[lo:hi])
 
     return pd.DataFrame(results)
 
+def calculate_bps_streaming(stock_id, price_df=None, broker_ids=None, start_date=None, end_date=None):
+    """
+    Out-of-core calculate_bps for multi-year histories: streams the stock's branch rows
+    one day at a time (branch_data.iter_branch_days) and carries only the per-broker
+    state, so memory depends on the number of brokers rather than the history length.
+    broker_ids restricts the flow to those brokers (Smart BPS). The output equals
+    calculate_bps on the same rows.
+    """
+    stock_id = str(stock_id)
+    price_df = load_price_data(stock_id) if price_df is None else price_df
+    store = PriceStore(price_df) if not price_df.empty else None
+    keep = None if broker_ids is None else broker_codes(broker_ids)
+
+    broker_state = {}
+    results = []
+
+    print(f"Streaming BPS for {stock_id}...")
+
+    for current_date, raw in iter_branch_days(stock_id, start_date, end_date):
+        flow = build_flow(standardize_branch(raw))
+        daily_ids = flow_broker_codes(flow)
+        if keep is not None:
+            mask = np.isin(daily_ids, keep)
+            flow, daily_ids = flow[mask], daily_ids[mask]
+        if flow.empty:
+            continue
+
+        close = store.close(stock_id, current_date) if store is not None else None
+        current_price = close if close is not None else day_totals(flow)['vwap'].iloc[0]
+        daily_net = flow['net_buy_qty'].to_numpy(dtype='float64')
+
+        results.append({
+            'date': current_date.strftime('%Y-%m-%d'),
+            'price': current_price,
+            'bps_factor': _top_winners_net_buy(broker_state, current_price, daily_ids, daily_net)
+        })
+        _update_state(broker_state, daily_ids, daily_net, flow['avg_price'].to_numpy(dtype='float64'))
+
+    print(f"Simulated {len(results)} days for {stock_id} ({len(broker_state)} brokers in state)")
     return pd.DataFrame(results)
 
 if __name__ == "__main__":
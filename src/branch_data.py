@@ -0,0 +1,453 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import os
+import shutil
+import time
+from id_codes import register_ids
+
+# Configuration
+DATA_DIR = 'data/'
+BRANCH_PATH = os.path.join(DATA_DIR, 'StockBranch.parquet')
+# Hive layout: data/StockBranch_by_stock/CommodityId=6215/part-0.parquet (sorted by Date)
+PARTITIONED_DIR = os.path.join(DATA_DIR, 'StockBranch_by_stock')
+ROW_GROUP_SIZE = 64 * 1024 # Small row groups -> date-range pruning via min/max statistics
+STOCKS_PER_PASS = 200 # Bounds memory while re-laying out an unsorted source file
+# Broker-major secondary copy: data/StockBranch_by_broker/SecuritiesTraderId=1360/part-0.parquet (sorted by stock, date)
+BROKER_DIR = os.path.join(DATA_DIR, 'StockBranch_by_broker')
+BROKERS_PER_PASS = 100
+
+# Raw StockBranch column -> standardized name used across src/
+BRANCH_COLUMNS = {
+    'Date': 'date',
+    'CommodityId': 'stock_id',
+    'SecuritiesTraderId': 'securities_trader_id',
+    'Price': 'price',
+    'Buy': 'buy',
+    'Sell': 'sell'
+}
+# Compact in-memory dtypes (broker/stock IDs as categorical codes)
+BRANCH_DTYPES = {
+    'date': 'datetime64[ns]',
+    'stock_id': 'category',
+    'securities_trader_id': 'category',
+    'price': 'float32',
+    'buy': 'int32',
+    'sell': 'int32'
+}
+
+def partition_dir(stock_id, out_dir=PARTITIONED_DIR):
+    """All files of one stock: part-0.parquet from the re-layout plus daily part-YYYYMMDD-N.parquet appends."""
+    return os.path.join(out_dir, f'CommodityId={stock_id}')
+
+def partition_path(stock_id, out_dir=PARTITIONED_DIR):
+    return os.path.join(partition_dir(stock_id, out_dir), 'part-0.parquet')
+
+def _as_timestamp(col):
+    """Normalizes the Date column (string or timestamp) to timestamp[ns]."""
+    if pa.types.is_string(col.type) or pa.types.is_large_string(col.type):
+        col = pc.strptime(pc.utf8_slice_codeunits(col, 0, 10), format='%Y-%m-%d', unit='ns')
+    return pc.cast(col, pa.timestamp('ns'))
+
+def _date_filters(date_type, start_date=None, end_date=None):
+    """Builds pyarrow filters on Date matching the physical type of the file."""
+    def as_value(d):
+        if pa.types.is_string(date_type) or pa.types.is_large_string(date_type):
+            return pd.Timestamp(d).strftime('%Y-%m-%d')
+        return pd.Timestamp(d)
+
+    filters = []
+    if start_date is not None:
+        filters.append(('Date', '>=', as_value(start_date)))
+    if end_date is not None:
+        filters.append(('Date', '<=', as_value(end_date)))
+    return filters
+
+def _stock_bounds(stock_col):
+    """Start/end row of each stock in a CommodityId-sorted column."""
+    bounds = [0] + (np.flatnonzero(stock_col[1:] != stock_col[:-1]) + 1).tolist() + [len(stock_col)]
+    return {str(stock_col[start]): (start, end) for start, end in zip(bounds[:-1], bounds[1:])}
+
+def relayout_branch_data(src_path=BRANCH_PATH, out_dir=PARTITIONED_DIR, row_group_size=ROW_GROUP_SIZE, stocks_per_pass=STOCKS_PER_PASS):
+    """
+    Rewrites the monolithic StockBranch.parquet as one Date-sorted file per stock.
+    Each file uses small row groups, min/max statistics and dictionary encoding,
+    so a per-stock load touches only that stock's bytes and date-range filters
+    skip row groups outside the window.
+    """
+    if not os.path.exists(src_path):
+        print(f"File not found: {src_path}")
+        return
+
+    stock_ids = pc.unique(pq.read_table(src_path, columns=['CommodityId'])['CommodityId']).to_pylist()
+    stock_ids = sorted(str(s) for s in stock_ids if s is not None)
+    print(f"Re-laying out {src_path} -> {out_dir} ({len(stock_ids)} stocks)...")
+    register_ids('stock', stock_ids)
+
+    tmp_dir = out_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    for i in range(0, len(stock_ids), stocks_per_pass):
+        group = stock_ids[i:i + stocks_per_pass]
+        table = pq.read_table(src_path, filters=[('CommodityId', 'in', group)])
+        table = table.set_column(table.schema.get_field_index('Date'), 'Date', _as_timestamp(table['Date']))
+        table = table.sort_by([('CommodityId', 'ascending'), ('Date', 'ascending'), ('SecuritiesTraderId', 'ascending')])
+        register_ids('broker', pc.unique(table['SecuritiesTraderId']).to_numpy(zero_copy_only=False))
+
+        # Sorted by stock -> each stock is one contiguous slice
+        for stock_id, (start, end) in _stock_bounds(table['CommodityId'].to_numpy()).items():
+            part = table.slice(start, end - start)
+            path = partition_path(stock_id, tmp_dir)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pq.write_table(
+                part.drop_columns(['CommodityId']), path,
+                row_group_size=row_group_size,
+                use_dictionary=True,
+                write_statistics=True,
+                compression='zstd'
+            )
+        print(f"  {min(i + stocks_per_pass, len(stock_ids))} / {len(stock_ids)} stocks written")
+
+    # Swap in the finished layout so readers never see a half-written directory
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    print("Done.")
+
+def broker_path(broker_id, out_dir=BROKER_DIR):
+    return os.path.join(out_dir, f'SecuritiesTraderId={broker_id}', 'part-0.parquet')
+
+def _branch_source():
+    """Current branch rows as a dataset: the per-stock layout (includes appended days) or the monolith."""
+    if os.path.isdir(PARTITIONED_DIR):
+        partitioning = ds.partitioning(pa.schema([('CommodityId', pa.string())]), flavor='hive')
+        return ds.dataset(PARTITIONED_DIR, format='parquet', partitioning=partitioning)
+    return ds.dataset(BRANCH_PATH, format='parquet')
+
+def build_broker_index(out_dir=BROKER_DIR, row_group_size=ROW_GROUP_SIZE, brokers_per_pass=BROKERS_PER_PASS):
+    """
+    Writes a broker-major copy of the branch data: one file per SecuritiesTraderId,
+    sorted by (CommodityId, Date) with min/max statistics, so one broker's history
+    across all stocks is a single small file read.
+    """
+    source = _branch_source()
+    broker_ids = pc.unique(source.to_table(columns=['SecuritiesTraderId'])['SecuritiesTraderId']).to_pylist()
+    broker_ids = sorted(str(b) for b in broker_ids if b is not None)
+    print(f"Building broker index -> {out_dir} ({len(broker_ids)} brokers)...")
+
+    tmp_dir = out_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    columns = ['SecuritiesTraderId', 'CommodityId', 'Date', 'Price', 'Buy', 'Sell']
+    for i in range(0, len(broker_ids), brokers_per_pass):
+        group = broker_ids[i:i + brokers_per_pass]
+        table = source.to_table(columns=columns, filter=ds.field('SecuritiesTraderId').isin(group))
+        table = table.set_column(table.schema.get_field_index('Date'), 'Date', _as_timestamp(table['Date']))
+        table = table.sort_by([('SecuritiesTraderId', 'ascending'), ('CommodityId', 'ascending'), ('Date', 'ascending')])
+
+        # Sorted by broker -> each broker is one contiguous slice
+        for broker_id, (start, end) in _stock_bounds(table['SecuritiesTraderId'].to_numpy()).items():
+            path = broker_path(broker_id, tmp_dir)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pq.write_table(
+                table.slice(start, end - start), path,
+                row_group_size=row_group_size,
+                use_dictionary=True,
+                write_statistics=True,
+                compression='zstd'
+            )
+        print(f"  {min(i + brokers_per_pass, len(broker_ids))} / {len(broker_ids)} brokers written")
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    print("Done.")
+
+def read_broker(broker_ids, stock_ids=None, start_date=None, end_date=None, columns=None):
+    """
+    Raw branch rows of one or more brokers across all (or the given) stocks, sorted by
+    broker, stock and date. Uses the broker index when present, otherwise scans the
+    branch data with a SecuritiesTraderId filter.
+    """
+    broker_ids = [str(broker_ids)] if isinstance(broker_ids, (str, int)) else [str(b) for b in broker_ids]
+    expr = ds.field('SecuritiesTraderId').isin(broker_ids)
+    if stock_ids is not None:
+        expr = expr & ds.field('CommodityId').isin([str(s) for s in stock_ids])
+
+    if os.path.isdir(BROKER_DIR):
+        paths = [p for p in (broker_path(b) for b in broker_ids) if os.path.exists(p)]
+        if not paths:
+            return pd.DataFrame()
+        dataset = ds.dataset(paths, format='parquet')
+        date_type = pa.timestamp('ns')
+    else:
+        dataset = _branch_source()
+        date_type = dataset.schema.field('Date').type
+
+    date_filters = _date_filters(date_type, start_date, end_date)
+    if date_filters:
+        expr = expr & pq.filters_to_expression(date_filters)
+    table = dataset.to_table(columns=columns, filter=expr)
+    if columns is None or {'SecuritiesTraderId', 'CommodityId', 'Date'} <= set(columns):
+        table = table.sort_by([('SecuritiesTraderId', 'ascending'), ('CommodityId', 'ascending'), ('Date', 'ascending')])
+    return table.to_pandas()
+
+def load_broker(broker_ids, stock_ids=None, start_date=None, end_date=None):
+    """read_broker() with standardized names and compact dtypes (see load_branch)."""
+    df = read_broker(broker_ids, stock_ids, start_date, end_date)
+    if df.empty:
+        return pd.DataFrame()
+    return standardize_branch(df)
+
+def read_branch(stock_id, start_date=None, end_date=None, columns=None):
+    """
+    Reads the raw branch rows for one stock, optionally restricted to [start_date, end_date]
+    and to the raw `columns` given. Uses the per-stock layout when present, otherwise falls
+    back to filtering StockBranch.parquet. Broker IDs come back as categoricals.
+    """
+    stock_id = str(stock_id)
+    path = partition_dir(stock_id)
+    if os.path.isdir(path):
+        file_columns = None if columns is None else [c for c in columns if c != 'CommodityId']
+        table = pq.read_table(
+            path, columns=file_columns,
+            filters=_date_filters(pa.timestamp('ns'), start_date, end_date) or None,
+            read_dictionary=['SecuritiesTraderId']
+        )
+        if columns is None or 'CommodityId' in columns:
+            table = table.add_column(min(1, table.num_columns), 'CommodityId', pa.array([stock_id] * table.num_rows, pa.string()))
+        return table.to_pandas()
+
+    if os.path.isdir(PARTITIONED_DIR):
+        # Layout exists but has no partition for this stock
+        return pd.DataFrame()
+
+    date_type = pq.read_schema(BRANCH_PATH).field('Date').type
+    filters = [('CommodityId', '==', stock_id)] + _date_filters(date_type, start_date, end_date)
+    table = pq.read_table(BRANCH_PATH, columns=columns, filters=filters, read_dictionary=['SecuritiesTraderId'])
+    return table.to_pandas()
+
+def standardize_branch(df, columns=None):
+    """Renames raw StockBranch columns and casts them to the compact BRANCH_DTYPES."""
+    df = df.rename(columns=BRANCH_COLUMNS)
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+
+    casts = {}
+    for col, dtype in BRANCH_DTYPES.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if col == 'date':
+            df = df.assign(date=pd.to_datetime(df['date']).astype(dtype))
+        else:
+            casts[col] = dtype
+    if casts:
+        df = df.astype(casts)
+
+    # Sorted, used-only categories keep groupby order identical to plain string IDs
+    for col in ['stock_id', 'securities_trader_id']:
+        if col in df.columns:
+            cats = df[col].cat.remove_unused_categories()
+            if not cats.cat.categories.is_monotonic_increasing:
+                cats = cats.cat.reorder_categories(cats.cat.categories.sort_values())
+            df = df.assign(**{col: cats})
+    return df
+
+def load_branch(stock_id, columns=None, start_date=None, end_date=None, df=None):
+    """
+    Shared StockBranch loader for all scripts. Reads only `columns` (standardized names,
+    default all) and returns compact dtypes: datetime64 dates, categorical IDs, int32
+    buy/sell and float32 price. Pass df (raw rows from iter_branch_by_stock) to skip the read.
+    """
+    raw_columns = None
+    if columns is not None:
+        raw_names = {v: k for k, v in BRANCH_COLUMNS.items()}
+        raw_columns = [raw_names[c] for c in columns]
+
+    if df is None:
+        import tick_cache # Lazy: tick_cache builds on this module
+        if tick_cache.ENABLED:
+            return tick_cache.load_branch_cached(stock_id, columns, start_date, end_date)
+        df = read_branch(stock_id, start_date, end_date, columns=raw_columns)
+    if df.empty:
+        return pd.DataFrame()
+    return standardize_branch(df, columns)
+
+def iter_branch_by_stock(stock_ids, start_date=None, end_date=None):
+    """
+    Yields (stock_id, raw branch rows) for each requested stock from a single scan.
+    On the monolithic file this is one CommodityId IN (...) read, sorted once and
+    sliced per stock. Stocks without data yield an empty DataFrame.
+    """
+    stock_ids = [str(s) for s in stock_ids]
+    if os.path.isdir(PARTITIONED_DIR):
+        # Each stock's partition is read exactly once
+        for stock_id in stock_ids:
+            yield stock_id, read_branch(stock_id, start_date, end_date)
+        return
+
+    date_type = pq.read_schema(BRANCH_PATH).field('Date').type
+    filters = [('CommodityId', 'in', stock_ids)] + _date_filters(date_type, start_date, end_date)
+    table = pq.read_table(BRANCH_PATH, filters=filters)
+    table = table.sort_by([('CommodityId', 'ascending'), ('Date', 'ascending'), ('SecuritiesTraderId', 'ascending')])
+    bounds = _stock_bounds(table['CommodityId'].to_numpy()) if table.num_rows else {}
+    # Dictionary-encode after sorting so each slice converts to categorical broker IDs
+    idx = table.schema.get_field_index('SecuritiesTraderId')
+    table = table.set_column(idx, 'SecuritiesTraderId', pc.dictionary_encode(table['SecuritiesTraderId']))
+
+    for stock_id in stock_ids:
+        if stock_id not in bounds:
+            yield stock_id, pd.DataFrame()
+            continue
+        # Convert one stock at a time to keep only one pandas copy alive
+        start, end = bounds[stock_id]
+        yield stock_id, table.slice(start, end - start).to_pandas()
+
+def branch_date_range(stock_id):
+    """(first, last) Date of one stock: footer statistics on the per-stock layout, a Date-only read otherwise."""
+    stock_id = str(stock_id)
+    path = partition_dir(stock_id)
+    if os.path.isdir(path):
+        first = last = None
+        for f in sorted(os.listdir(path)):
+            if not f.endswith('.parquet') or f.startswith('.'):
+                continue
+            meta = pq.read_metadata(os.path.join(path, f))
+            idx = meta.schema.to_arrow_schema().get_field_index('Date')
+            for rg in range(meta.num_row_groups):
+                stats = meta.row_group(rg).column(idx).statistics
+                if stats is None or not stats.has_min_max:
+                    continue
+                lo, hi = pd.Timestamp(stats.min), pd.Timestamp(stats.max)
+                first = lo if first is None else min(first, lo)
+                last = hi if last is None else max(last, hi)
+        return first, last
+    dates = read_branch(stock_id, columns=['Date'])
+    if dates.empty:
+        return None, None
+    dates = pd.to_datetime(dates['Date'])
+    return dates.min(), dates.max()
+
+def iter_branch_days(stock_id, start_date=None, end_date=None):
+    """
+    Yields (date, raw branch rows of that day) for one stock in date order. On the
+    per-stock layout (sorted by Date) the files are read one row group at a time and
+    row groups outside [start_date, end_date] are skipped by their Date statistics,
+    so peak memory is one row group plus one day however long the history is.
+    Without the layout the stock's rows are read once and split by day.
+    """
+    stock_id = str(stock_id)
+    path = partition_dir(stock_id)
+    if not os.path.isdir(path):
+        df = read_branch(stock_id, start_date, end_date)
+        if df.empty:
+            return
+        dates = pd.to_datetime(df['Date'])
+        for date, day in df.groupby(dates, sort=True):
+            yield date, day.reset_index(drop=True)
+        return
+
+    lo = pd.Timestamp(start_date) if start_date is not None else None
+    hi = pd.Timestamp(end_date) if end_date is not None else None
+    pending, current = [], None
+
+    def flush():
+        table = pa.concat_tables(pending)
+        table = table.add_column(min(1, table.num_columns), 'CommodityId', pa.array([stock_id] * table.num_rows, pa.string()))
+        return current, table.to_pandas()
+
+    files = sorted(f for f in os.listdir(path) if f.endswith('.parquet') and not f.startswith('.'))
+    for name in files:
+        pf = pq.ParquetFile(os.path.join(path, name), read_dictionary=['SecuritiesTraderId'])
+        idx = pf.schema_arrow.get_field_index('Date')
+        for rg in range(pf.num_row_groups):
+            stats = pf.metadata.row_group(rg).column(idx).statistics
+            if stats is not None and stats.has_min_max:
+                if (hi is not None and pd.Timestamp(stats.min) > hi) or (lo is not None and pd.Timestamp(stats.max) < lo):
+                    continue
+            table = pf.read_row_group(rg)
+            table = table.set_column(idx, 'Date', _as_timestamp(table['Date']))
+            if lo is not None or hi is not None:
+                mask = pc.and_(
+                    pc.greater_equal(table['Date'], pa.scalar(lo if lo is not None else pd.Timestamp.min, pa.timestamp('ns'))),
+                    pc.less_equal(table['Date'], pa.scalar(hi if hi is not None else pd.Timestamp.max, pa.timestamp('ns')))
+                )
+                table = table.filter(mask)
+            if table.num_rows == 0:
+                continue
+
+            day_ns = table['Date'].to_numpy().astype('datetime64[ns]').view('int64')
+            starts = [0] + (np.flatnonzero(day_ns[1:] != day_ns[:-1]) + 1).tolist()
+            for start, end in zip(starts, starts[1:] + [len(day_ns)]):
+                day = pd.Timestamp(day_ns[start])
+                if current is not None and day != current:
+                    yield flush()
+                    pending = []
+                current = day
+                pending.append(table.slice(start, end - start))
+    if pending:
+        yield flush()
+
+def benchmark_layout(stock_ids, repeat=1):
+    """Compares per-stock read time on the monolithic file vs the per-stock layout."""
+    if not os.path.isdir(PARTITIONED_DIR):
+        print(f"{PARTITIONED_DIR} not found. Run relayout_branch_data() first.")
+        return
+
+    def time_reads(read_fn, ids):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for sid in ids:
+                read_fn(sid)
+        return (time.perf_counter() - start) / repeat
+
+    def read_monolith(sid):
+        return pd.read_parquet(BRANCH_PATH, filters=[('CommodityId', '==', str(sid))])
+
+    results = []
+    for label, ids in [('single stock', stock_ids[:1]), (f'{len(stock_ids)}-stock batch', stock_ids)]:
+        before = time_reads(read_monolith, ids)
+        after = time_reads(read_branch, ids)
+        results.append({'case': label, 'monolith_s': before, 'partitioned_s': after, 'speedup': before / after if after > 0 else float('nan')})
+
+    print("\n--- StockBranch Read-Time Comparison ---")
+    print(pd.DataFrame(results).to_string(index=False))
+    return results
+
+def benchmark_broker_index(broker_ids):
+    """Per-broker history read time: filtered scan of the branch data vs the broker index."""
+    if not os.path.isdir(BROKER_DIR):
+        print(f"{BROKER_DIR} not found. Run build_broker_index() first.")
+        return
+
+    results = []
+    for broker_id in broker_ids:
+        start = time.perf_counter()
+        scanned = _branch_source().to_table(filter=ds.field('SecuritiesTraderId') == str(broker_id)).num_rows
+        scan_s = time.perf_counter() - start
+        start = time.perf_counter()
+        indexed = len(read_broker(broker_id))
+        index_s = time.perf_counter() - start
+        results.append({'broker': broker_id, 'rows': indexed, 'scan_rows': scanned, 'scan_s': scan_s, 'index_s': index_s, 'speedup': scan_s / index_s if index_s > 0 else float('nan')})
+
+    print("\n--- Broker History Read-Time Comparison ---")
+    print(pd.DataFrame(results).to_string(index=False))
+    return results
+
+if __name__ == "__main__":
+    relayout_branch_data()
+    build_broker_index()
+    benchmark_layout([
+        '3013', '2365', '3450', '6558', '1815', '8096', '2408', '4931', '1514', '6215',
+        '2486', '4510', '6140', '3047', '3312', '4909', '2615', '4979', '2359', '8054',
+        '3363', '4991', '3706', '3163', '8028', '2609', '6117', '1503', '2374', '4303',
+        '2543', '8064', '1540', '6148', '5426', '8111', '2363', '5443', '4562', '2464',
+        '2312', '3379', '5251', '3535', '1519', '3062', '6442', '6462', '2468', '3376'
+    ])
+    # Foreign branches that recur in the accumulator cluster of many stocks
+    benchmark_broker_index(['1360', '1380'])
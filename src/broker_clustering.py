@@ -5,24 +5,24 @@ import numpy as np
 from sklearn.preprocessing import RobustScaler
 from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans
+from branch_data import load_branch, standardize_branch, branch_date_range, iter_branch_days, PARTITIONED_DIR
+from broker_flow import is_flow, build_flow
 
 # Configuration
 STOCK_ID = '6215' # Changed to 6215 for better testing (denser data)
 DATA_DIR = 'data/'
 DEFAULT_LOOKBACK = 60 
 
-def load_data(stock_id):
-    """Loads transactions and applies an adaptive rolling window."""
+def load_data(stock_id, df=None):
+    """Loads transactions and applies an adaptive rolling window. Pass df (raw rows or a flow table) to skip the read."""
     file_path = os.path.join(DATA_DIR, 'StockBranch.parquet')
-    if not os.path.exists(file_path):
+    if df is None and not os.path.exists(file_path) and not os.path.isdir(PARTITIONED_DIR):
         return pd.DataFrame()
 
     try:
-        df = pd.read_parquet(file_path, filters=[('CommodityId', '==', str(stock_id))])
+        if df is None or not is_flow(df):
+            df = load_branch(stock_id, df=df)
         if df.empty: return pd.DataFrame()
-
-        df = df.rename(columns={'Date': 'date', 'CommodityId': 'stock_id', 'SecuritiesTraderId': 'securities_trader_id', 'Price': 'price', 'Buy': 'buy', 'Sell': 'sell'})
-        df['date'] = pd.to_datetime(df['date'])
         
         # [Optimization] Adaptive Window
         max_date = df['date'].max()
@@ -35,28 +35,16 @@ def load_data(stock_id):
             window = 180
             subset = df[df['date'] >= max_date - pd.Timedelta(days=window)]
             
-        subset = subset.copy()
-        subset['date'] = subset['date'].dt.strftime('%Y-%m-%d')
-        
         print(f"Loaded {len(subset)} transactions for {stock_id} (Adaptive Window: {window} days, {subset['date'].nunique()} trading days)")
         return subset
     except Exception as e:
         print(f"Error: {e}")
         return pd.DataFrame()
 
-def extract_features(df):
-    """Extracts behavioral features."""
-    print("Extracting behavioral features...")
-    broker_stats = df.groupby('securities_trader_id').apply(
-        lambda x: pd.Series({
-            'total_buy': x['buy'].sum(),
-            'total_sell': x['sell'].sum(),
-            'total_volume': x['buy'].sum() + x['sell'].sum(),
-            'transaction_days': x['date'].nunique(),
-            'total_days_in_period': df['date'].nunique(),
-        }),
-        include_groups=False # Silence future warning
-    ).reset_index()
+def _broker_features(broker_stats, total_days):
+    """Derived clustering features from per-broker total_buy / total_sell / transaction_days."""
+    broker_stats.insert(3, 'total_volume', broker_stats['total_buy'] + broker_stats['total_sell'])
+    broker_stats['total_days_in_period'] = total_days
     
     broker_stats['frequency'] = broker_stats['transaction_days'] / broker_stats['total_days_in_period']
     broker_stats['net_volume'] = broker_stats['total_buy'] - broker_stats['total_sell']
@@ -66,6 +54,65 @@ def extract_features(df):
 
     return broker_stats.fillna(0)
 
+def extract_features(df):
+    """Extracts behavioral features from raw branch rows or a broker-day flow table."""
+    print("Extracting behavioral features...")
+    # One row per broker-day, so transaction_days is a row count
+    flow = df if is_flow(df) else build_flow(df)
+    broker_stats = flow.groupby('securities_trader_id', observed=True).agg(
+        total_buy=('buy', 'sum'),
+        total_sell=('sell', 'sum'),
+        transaction_days=('date', 'size')
+    ).reset_index()
+    return _broker_features(broker_stats, flow['date'].nunique())
+
+def extract_features_streaming(stock_id):
+    """
+    load_data + extract_features without loading the history: streams the adaptive
+    window one day at a time and keeps running per-broker totals for both the default
+    and the expanded window, then keeps the one load_data would have chosen.
+    """
+    print("Extracting behavioral features (streaming)...")
+    _, max_date = branch_date_range(stock_id)
+    if max_date is None:
+        return pd.DataFrame()
+
+    windows = [DEFAULT_LOOKBACK, 180]
+    starts = [max_date - pd.Timedelta(days=w) for w in windows]
+    totals = [{} for _ in windows] # broker -> [total_buy, total_sell, transaction_days]
+    days = [0 for _ in windows]
+
+    for date, raw in iter_branch_days(stock_id, start_date=min(starts)):
+        flow = build_flow(standardize_branch(raw))
+        rows = list(zip(flow['securities_trader_id'].astype(str), flow['buy'].tolist(), flow['sell'].tolist()))
+        for i, start in enumerate(starts):
+            if date < start:
+                continue
+            days[i] += 1
+            acc = totals[i]
+            for bid, buy, sell in rows:
+                t = acc.setdefault(bid, [0, 0, 0])
+                t[0] += buy
+                t[1] += sell
+                t[2] += 1
+
+    i = 0
+    if days[0] < 5:
+        print(f"Warning: Only {days[0]} trading days in last {windows[0]} days. Expanding window to {windows[1]} days...")
+        i = 1
+    print(f"Streamed {days[i]} trading days for {stock_id} (Adaptive Window: {windows[i]} days)")
+    if not totals[i]:
+        return pd.DataFrame()
+
+    ids = sorted(totals[i])
+    broker_stats = pd.DataFrame({
+        'securities_trader_id': ids,
+        'total_buy': np.array([totals[i][b][0] for b in ids], dtype='int64'),
+        'total_sell': np.array([totals[i][b][1] for b in ids], dtype='int64'),
+        'transaction_days': np.array([totals[i][b][2] for b in ids], dtype='int64')
+    })
+    return _broker_features(broker_stats, days[i])
+
 def perform_clustering(features_df, k=4):
     print(f"Performing Optimized K-Means (PCA + RobustScaler)...")
     active_brokers = features_df[features_df['transaction_days'] >= 2].copy() # Relaxed to 2 days
@@ -92,12 +139,16 @@ def perform_clustering(features_df, k=4):
     
     return active_brokers
 
-def run_analysis(stock_id):
+def run_analysis(stock_id, df_raw=None, streaming=False):
+    """streaming=True extracts features out-of-core (extract_features_streaming); df_raw is then unused."""
     print(f"\n--- Model Update: {stock_id} ---")
-    df = load_data(stock_id)
-    if df.empty: return None
-    
-    features = extract_features(df)
+    if streaming:
+        features = extract_features_streaming(stock_id)
+        if features.empty: return None
+    else:
+        df = load_data(stock_id, df_raw)
+        if df.empty: return None
+        features = extract_features(df)
     clustered = perform_clustering(features)
     
     if 'cluster' in clustered.columns:
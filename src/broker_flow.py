@@ -0,0 +1,146 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import os
+import sys
+from branch_data import DATA_DIR, BRANCH_PATH, PARTITIONED_DIR, partition_dir, load_branch, standardize_branch, iter_branch_by_stock
+from tick_cache import _fingerprint as _source_fingerprint
+from id_codes import get_id_codes, broker_codes
+
+# Configuration
+# Derived layout: data/BrokerFlow_by_stock/CommodityId=6215/{flow,days}.parquet
+FLOW_DIR = os.path.join(DATA_DIR, 'BrokerFlow_by_stock')
+
+def is_flow(df):
+    """True for broker-day flow tables (build_flow output), False for raw branch rows."""
+    return 'net_buy_qty' in df.columns
+
+def build_flow(df):
+    """
+    Standardized branch rows (one per date, broker, price level) -> one row per
+    (stock_id, date, broker), sorted by date then broker ID: buy, sell, net_buy_qty,
+    traded notional (sum of price * (buy + sell)), VWAP (avg_price, 0 without volume)
+    and the broker's int32 broker_code (id_codes).
+    """
+    # int64 so per-day sums of the compact int32 buy/sell columns cannot overflow
+    buy, sell = df['buy'].astype('int64'), df['sell'].astype('int64')
+    df = df.assign(
+        date=pd.to_datetime(df['date']),
+        buy=buy,
+        sell=sell,
+        notional=df['price'].astype('float64') * (buy + sell)
+    )
+    flow = df.groupby(['stock_id', 'date', 'securities_trader_id'], observed=True, sort=True).agg(
+        buy=('buy', 'sum'),
+        sell=('sell', 'sum'),
+        notional=('notional', 'sum')
+    ).reset_index()
+
+    volume = flow['buy'] + flow['sell']
+    flow['net_buy_qty'] = flow['buy'] - flow['sell']
+    flow['avg_price'] = np.where(volume > 0, flow['notional'] / volume.where(volume > 0, 1), 0.0)
+    flow['broker_code'] = broker_codes(flow['securities_trader_id'])
+    return flow
+
+def flow_broker_codes(flow):
+    """int32 broker codes of a flow table (tables materialized before broker_code existed are encoded on the fly)."""
+    if 'broker_code' in flow.columns:
+        return flow['broker_code'].to_numpy()
+    return broker_codes(flow['securities_trader_id'])
+
+def select_brokers(flow, broker_ids):
+    """Rows of flow whose broker is in broker_ids (an isin on int32 broker codes)."""
+    return flow[np.isin(flow_broker_codes(flow), broker_codes(broker_ids))]
+
+def day_totals(flow):
+    """Per-(stock_id, date) totals of a flow table; vwap is the day's price fallback when no close exists."""
+    days = flow.groupby(['stock_id', 'date'], observed=True, sort=True).agg(
+        buy=('buy', 'sum'),
+        sell=('sell', 'sum'),
+        notional=('notional', 'sum')
+    ).reset_index()
+    volume = days['buy'] + days['sell']
+    days['vwap'] = np.where(volume > 0, days['notional'] / volume.where(volume > 0, 1), 0.0)
+    return days
+
+def _source(stock_id):
+    path = partition_dir(stock_id)
+    return path if os.path.isdir(path) else BRANCH_PATH
+
+def _fingerprint(stock_id):
+    return _source_fingerprint(_source(stock_id))
+
+def _write(df, path, fingerprint):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'source': fingerprint.encode()})
+    tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+def _all_stock_ids():
+    if os.path.isdir(PARTITIONED_DIR):
+        return sorted(d.split('=', 1)[1] for d in os.listdir(PARTITIONED_DIR) if d.startswith('CommodityId='))
+    ids = pc.unique(pq.read_table(BRANCH_PATH, columns=['CommodityId'])['CommodityId']).to_pylist()
+    return sorted(str(s) for s in ids if s is not None)
+
+def materialize_flow(stock_ids=None, out_dir=FLOW_DIR):
+    """Builds flow.parquet + days.parquet for each stock (default: all) from one StockBranch scan."""
+    stock_ids = _all_stock_ids() if stock_ids is None else [str(s) for s in stock_ids]
+    print(f"Materializing broker-day flow for {len(stock_ids)} stocks -> {out_dir}...")
+    rows_in = rows_out = 0
+    for stock_id, raw in iter_branch_by_stock(stock_ids):
+        if raw.empty:
+            continue
+        flow = build_flow(standardize_branch(raw))
+        stock_dir = os.path.join(out_dir, f'CommodityId={stock_id}')
+        os.makedirs(stock_dir, exist_ok=True)
+        fingerprint = _fingerprint(stock_id)
+        _write(flow, os.path.join(stock_dir, 'flow.parquet'), fingerprint)
+        _write(day_totals(flow), os.path.join(stock_dir, 'days.parquet'), fingerprint)
+        rows_in += len(raw)
+        rows_out += len(flow)
+    get_id_codes().save() # Stored broker_code values must stay resolvable
+    print(f"Done. {rows_in} branch rows -> {rows_out} broker-day rows.")
+
+def _read(stock_id, name, start_date=None, end_date=None, out_dir=FLOW_DIR):
+    """Materialized table, or None when missing or built from an older source."""
+    path = os.path.join(out_dir, f'CommodityId={stock_id}', f'{name}.parquet')
+    if not os.path.exists(path):
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    if metadata.get(b'source', b'').decode() != _fingerprint(stock_id):
+        return None
+    filters = []
+    if start_date is not None:
+        filters.append(('date', '>=', pd.Timestamp(start_date)))
+    if end_date is not None:
+        filters.append(('date', '<=', pd.Timestamp(end_date)))
+    return pd.read_parquet(path, filters=filters or None)
+
+def load_flow(stock_id, start_date=None, end_date=None, df=None):
+    """
+    Broker-day flow for one stock: the materialized table when fresh, else built from
+    the branch rows. Pass df (raw rows from iter_branch_by_stock) to build from it instead.
+    """
+    stock_id = str(stock_id)
+    if df is None:
+        flow = _read(stock_id, 'flow', start_date, end_date)
+        if flow is not None:
+            return flow
+    raw = load_branch(stock_id, start_date=start_date, end_date=end_date, df=df)
+    return build_flow(raw) if not raw.empty else pd.DataFrame()
+
+def load_day_totals(stock_id, start_date=None, end_date=None):
+    """Per-day totals (buy, sell, notional, vwap) for one stock."""
+    stock_id = str(stock_id)
+    days = _read(stock_id, 'days', start_date, end_date)
+    if days is not None:
+        return days
+    flow = load_flow(stock_id, start_date, end_date)
+    return day_totals(flow) if not flow.empty else pd.DataFrame()
+
+if __name__ == "__main__":
+    # python src/broker_flow.py [stock_id ...]
+    materialize_flow(sys.argv[1:] or None)
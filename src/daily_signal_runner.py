@@ -2,7 +2,9 @@ import pandas as pd
 import os
 import json
 from datetime import datetime, timedelta
-from bps_strategy import load_data, load_price_data, calculate_bps
+from bps_strategy import load_data, calculate_bps
+from price_store import get_price_store
+from factor_store import read_factor_frames
 from smart_bps import run_smart_bps
 from tqdm import tqdm
 
@@ -27,22 +29,24 @@ def generate_daily_report(today_date):
     
     # 1. SCAN FOR NEW ENTRIES
     print(">>> Scanning for New Entry Signals...")
+    # Smart BPS up to today for every target stock in one factor-store read
+    bps_frames = read_factor_frames(['smart_bps', 'price'], TARGET_STOCKS, end_date=today_date)
     
     for stock_id in tqdm(TARGET_STOCKS, desc="Scanning"):
         # In a real scenario, we would load data up to today_date
         # Here we assume the parquet files already contain data for this date
         
         # We perform a quick check using the cached Smart BPS result to save time
-        # In production, you would run_smart_bps(stock_id) daily
-        bps_path = f'data/smart_bps_result_{stock_id}.csv'
-        if not os.path.exists(bps_path):
+        # In production, bps_state.update_all(<today's branch rows>) appends today's Smart BPS
+        # to the stored series (run_smart_bps only when re-clustering)
+        if stock_id not in bps_frames:
              # Try to generate if missing (mocking the daily update)
              continue
         
-        df = pd.read_csv(bps_path)
+        df = bps_frames[stock_id]
         
         # Get data for 'today' and previous days
-        row_today = df[df['date'] == today_date]
+        row_today = df[df['date'] == pd.Timestamp(today_date)]
         if row_today.empty:
             continue
             
@@ -73,14 +77,11 @@ def generate_daily_report(today_date):
         '6215': {'entry_date': '2025-05-02', 'entry_price': 101.0, 'qty': 1000} 
     }
     
+    prices = get_price_store() # Loaded once, indexed by stock -> date
     for stock_id, pos in mock_portfolio.items():
         # Get current price
-        price_data = load_price_data(stock_id)
-        if price_data.empty: continue
-        
-        row = price_data[price_data['date'] == today_date]
-        if row.empty: continue
-        current_price = row.iloc[0]['close']
+        current_price = prices.close(stock_id, today_date)
+        if current_price is None: continue
         
         # Check Stop Loss (-7%)
         pnl_pct = (current_price - pos['entry_price']) / pos['entry_price']
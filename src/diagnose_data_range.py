@@ -1,76 +1,217 @@
 import pandas as pd
+import pyarrow.parquet as pq
+import json
 import os
-from tqdm import tqdm
+import time
+from branch_data import PARTITIONED_DIR, read_branch
+from factor_store import FACTOR_DIR
+from ingest import COVERAGE_KEY
+from trading_calendar import TradingCalendar
 
 TARGET_STOCKS = [
-    '3013', '2365', '3450', '6558', '1815', '8096', '2408', '4931', '1514', '6215', 
-    '2486', '4510', '6140', '3047', '3312', '4909', '2615', '4979', '2359', '8054', 
-    '3363', '4991', '3706', '3163', '8028', '2609', '6117', '1503', '2374', '4303', 
-    '2543', '8064', '1540', '6148', '5426', '8111', '2363', '5443', '4562', '2464', 
+    '3013', '2365', '3450', '6558', '1815', '8096', '2408', '4931', '1514', '6215',
+    '2486', '4510', '6140', '3047', '3312', '4909', '2615', '4979', '2359', '8054',
+    '3363', '4991', '3706', '3163', '8028', '2609', '6117', '1503', '2374', '4303',
+    '2543', '8064', '1540', '6148', '5426', '8111', '2363', '5443', '4562', '2464',
     '2312', '3379', '5251', '3535', '1519', '3062', '6442', '6462', '2468', '3376'
 ]
 
 PATHS = {
     'branch': 'data/StockBranch.parquet',
     'revenue': 'data/revenue_announcements.parquet',
-    'price': 'data/stock_price_history.parquet'
+    'price': 'data/stock_price_history.parquet',
+    'market': 'data/market_index.parquet'
 }
+# One row per stock and trading day, so rows vs. calendar days counts the gaps; factors
+# follow the stock's own branch dates (smart_bps is sparse on market days by design)
+DAILY_DATASETS = ('price', 'factor:')
+STOCK_DAY_DATASETS = ('factor:',)
+REPORT_COLUMNS = ['dataset', 'stock_id', 'first', 'last', 'rows', 'expected_days', 'missing_days']
 
-def diagnose():
-    print("--- Data Range Diagnosis (2024 Coverage Check) ---")
-    
-    # 1. Check Revenue Announcements
-    print("\n[1] Checking Revenue Announcements (2024)...")
-    if os.path.exists(PATHS['revenue']):
-        rev_df = pd.read_parquet(PATHS['revenue'])
-        rev_2024 = rev_df[
-            (rev_df['stock_id'].isin(TARGET_STOCKS)) & 
-            (rev_df['announcement_date'] >= '2024-01-01') & 
-            (rev_df['announcement_date'] < '2025-01-01')
-        ]
-        print(f"Total Revenue Events in 2024 for Target Stocks: {len(rev_2024)}")
-        if len(rev_2024) > 0:
-            print(f"Sample Dates: {rev_2024['announcement_date'].sample(5).tolist()}")
-        else:
-            print("WARNING: No revenue events found in 2024!")
-    
-    # 2. Check Price History
-    print("\n[2] Checking Price History (2024)...")
-    if os.path.exists(PATHS['price']):
-        price_df = pd.read_parquet(PATHS['price'])
-        price_df['date'] = pd.to_datetime(price_df['date'])
-        price_2024 = price_df[
-            (price_df['stock_id'].isin(TARGET_STOCKS)) & 
-            (price_df['date'] >= '2024-01-01') & 
-            (price_df['date'] < '2025-01-01')
-        ]
-        print(f"Total Price Records in 2024 for Target Stocks: {len(price_2024)}")
-        print(f"Coverage: {price_2024['stock_id'].nunique()} / {len(TARGET_STOCKS)} stocks have data.")
-    
-    # 3. Check Smart BPS Results (Generated Files)
-    print("\n[3] Checking Generated Smart BPS Results (2024)...")
-    missing_2024 = []
-    has_2024 = []
-    
-    for stock in tqdm(TARGET_STOCKS):
-        path = f'data/smart_bps_result_{stock}.csv'
-        if os.path.exists(path):
-            try:
-                df = pd.read_csv(path)
-                min_date = df['date'].min()
-                if min_date < '2025-01-01':
-                    has_2024.append(stock)
-                else:
-                    missing_2024.append(f"{stock} (Min: {min_date})")
-            except:
-                missing_2024.append(f"{stock} (Read Error)")
-        else:
-            missing_2024.append(f"{stock} (File Missing)")
-            
-    print(f"\nStocks with 2024 BPS Data: {len(has_2024)}")
-    print(f"Stocks MISSING 2024 BPS Data: {len(missing_2024)}")
-    if missing_2024:
-        print("Sample missing:", missing_2024[:10])
+def _parquet_files(path):
+    """A Parquet file, or the visible part files of a dataset directory."""
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.parquet') and not f.startswith('.'))
+    return [path] if os.path.exists(path) else []
+
+def _merge(coverage, stock_id, first, last, rows):
+    first, last = pd.Timestamp(first), pd.Timestamp(last)
+    if stock_id in coverage:
+        prev_first, prev_last, prev_rows = coverage[stock_id]
+        first, last, rows = min(prev_first, first), max(prev_last, last), prev_rows + rows
+    coverage[stock_id] = (first, last, rows)
+
+def _stats(meta, rg, idx):
+    stats = meta.row_group(rg).column(idx).statistics
+    return (stats.min, stats.max) if stats is not None and stats.has_min_max else (None, None)
+
+def _file_range(paths, date_col):
+    """(first, last, rows) over every row group of paths, from footer statistics."""
+    first = last = None
+    rows = 0
+    for path in paths:
+        meta = pq.read_metadata(path)
+        idx = meta.schema.to_arrow_schema().get_field_index(date_col)
+        for rg in range(meta.num_row_groups):
+            rows += meta.row_group(rg).num_rows
+            lo, hi = _stats(meta, rg, idx)
+            if lo is None:
+                continue
+            lo, hi = pd.Timestamp(lo), pd.Timestamp(hi)
+            first = lo if first is None else min(first, lo)
+            last = hi if last is None else max(last, hi)
+    return first, last, rows
+
+def _footer_coverage(path, date_col, stock_col='stock_id'):
+    """
+    Per-stock (first, last, rows) of a multi-stock file or dataset directory: the
+    stock_coverage summary ingest.py writes into the footer, else row groups that hold
+    a single stock, else a (stock, date) column read of the remaining row groups (files
+    written before ingest.py). Returns (coverage, rows resolved by the column read).
+    """
+    coverage = {}
+    scanned = 0
+    for path in _parquet_files(path):
+        meta = pq.read_metadata(path)
+        summary = (meta.metadata or {}).get(COVERAGE_KEY.encode())
+        if summary is not None:
+            for stock_id, (first, last, rows) in json.loads(summary).items():
+                _merge(coverage, stock_id, first, last, rows)
+            continue
+
+        schema = meta.schema.to_arrow_schema()
+        stock_idx, date_idx = schema.get_field_index(stock_col), schema.get_field_index(date_col)
+        mixed = []
+        for rg in range(meta.num_row_groups):
+            stock_lo, stock_hi = _stats(meta, rg, stock_idx)
+            date_lo, date_hi = _stats(meta, rg, date_idx)
+            if stock_lo is None or stock_lo != stock_hi or date_lo is None:
+                mixed.append(rg)
+                continue
+            _merge(coverage, str(stock_lo), date_lo, date_hi, meta.row_group(rg).num_rows)
+        if mixed:
+            df = pq.ParquetFile(path).read_row_groups(mixed, columns=[stock_col, date_col]).to_pandas()
+            df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
+            grouped = df.groupby(df[stock_col].astype(str), observed=True)[date_col].agg(['min', 'max', 'size'])
+            for stock_id, (first, last, rows) in grouped.iterrows():
+                if pd.notna(first):
+                    _merge(coverage, stock_id, first, last, rows)
+            scanned += len(df)
+    return coverage, scanned
+
+def _branch_days(stock_id):
+    """The stock's own trading days (distinct branch Dates): sparse factors are daily on these, not on the market calendar."""
+    dates = read_branch(stock_id, columns=['Date'])
+    return TradingCalendar(dates['Date']) if not dates.empty else None
+
+def _load_calendar(path):
+    """Market calendar, or None when neither market_index nor unique_dates.csv exists."""
+    try:
+        return TradingCalendar.load(path)
+    except FileNotFoundError:
+        return None
+
+def _partition_coverage(root, key, date_col, stock_ids=None):
+    """Per-stock ranges of a <key>=<stock_id>/ directory layout, one footer pass per stock."""
+    coverage = {}
+    if not os.path.isdir(root):
+        return coverage
+    wanted = None if stock_ids is None else set(stock_ids)
+    for name in os.listdir(root):
+        if not name.startswith(f'{key}='):
+            continue
+        stock_id = name.split('=', 1)[1]
+        if wanted is not None and stock_id not in wanted:
+            continue
+        first, last, rows = _file_range(_parquet_files(os.path.join(root, name)), date_col)
+        if first is not None:
+            coverage[stock_id] = (first, last, rows)
+    return coverage
+
+def coverage_report(stock_ids=None):
+    """
+    One row per (dataset, stock): first / last date, row count, trading days in that
+    span and, for daily datasets, missing trading days (factors: against the stock's
+    own branch dates; without a market calendar the other gap columns stay empty).
+    Built from Parquet footers and the factor-store layout, plus column reads for
+    files without a coverage summary and the branch Date column of factor stocks.
+    Returns (report, notes).
+    """
+    stock_ids = None if stock_ids is None else [str(s) for s in stock_ids]
+    notes = []
+    datasets = {}
+
+    if os.path.isdir(PARTITIONED_DIR):
+        datasets['branch'] = _partition_coverage(PARTITIONED_DIR, 'CommodityId', 'Date', stock_ids)
+    else:
+        datasets['branch'], scanned = _footer_coverage(PATHS['branch'], 'Date', 'CommodityId')
+        if scanned:
+            notes.append(f"branch: {scanned} rows read for per-stock ranges (run branch_data.py for the per-stock layout)")
+    for name, date_col in [('price', 'date'), ('revenue', 'announcement_date')]:
+        datasets[name], scanned = _footer_coverage(PATHS[name], date_col)
+        if scanned:
+            notes.append(f"{name}: {scanned} rows read for per-stock ranges, no coverage summary (re-run ingest.py {name})")
+    if os.path.isdir(FACTOR_DIR):
+        for name in sorted(os.listdir(FACTOR_DIR)):
+            if name.startswith('factor='):
+                datasets[f"factor:{name.split('=', 1)[1]}"] = _partition_coverage(os.path.join(FACTOR_DIR, name), 'stock_id', 'date', stock_ids)
+
+    calendar = _load_calendar(PATHS['market'])
+    if calendar is None:
+        notes.append(f"WARNING: no market calendar ({PATHS['market']} / unique_dates.csv); market trading-day gaps skipped")
+    market_first, market_last, _ = _file_range(_parquet_files(PATHS['market']), 'date')
+    if market_first is not None:
+        notes.append(f"market: {market_first.date()} ~ {market_last.date()} ({len(calendar)} trading days)")
+
+    branch_days = {}
+    rows = []
+    for dataset, coverage in datasets.items():
+        daily = dataset.startswith(DAILY_DATASETS)
+        for stock_id, (first, last, n) in coverage.items():
+            if stock_ids is not None and stock_id not in stock_ids:
+                continue
+            days = calendar
+            if dataset.startswith(STOCK_DAY_DATASETS):
+                if stock_id not in branch_days:
+                    branch_days[stock_id] = _branch_days(stock_id)
+                days = branch_days[stock_id]
+            expected = days.days_between(first, last) if days is not None else None
+            rows.append({
+                'dataset': dataset, 'stock_id': stock_id, 'first': first, 'last': last, 'rows': n,
+                'expected_days': expected, 'missing_days': max(expected - n, 0) if daily and expected is not None else None
+            })
+    report = pd.DataFrame(rows, columns=REPORT_COLUMNS)
+    return report.sort_values(['dataset', 'stock_id']).reset_index(drop=True), notes
+
+def diagnose(stock_ids=TARGET_STOCKS):
+    print("--- Data Coverage Diagnosis (Parquet metadata first) ---")
+    start = time.perf_counter()
+    report, notes = coverage_report(stock_ids)
+    elapsed = time.perf_counter() - start
+
+    universe = sorted(set(stock_ids) if stock_ids is not None else set(report['stock_id']))
+    for dataset in ['branch', 'price', 'revenue'] + sorted(d for d in report['dataset'].unique() if d.startswith('factor:')):
+        group = report[report['dataset'] == dataset]
+        covered = set(group['stock_id'])
+        missing = [s for s in universe if s not in covered]
+        print(f"\n[{dataset}] {len(covered)} / {len(universe)} stocks", end='')
+        if group.empty:
+            print()
+            continue
+        print(f", {group['first'].min().date()} ~ {group['last'].max().date()}")
+        if missing:
+            print(f"  Missing stocks ({len(missing)}): {missing[:10]}")
+        late = group[group['first'] >= pd.Timestamp('2025-01-01')]
+        if not late.empty:
+            print(f"  No 2024 data ({len(late)}): {[f'{s} (Min: {d.date()})' for s, d in zip(late['stock_id'], late['first'])][:10]}")
+        gaps = group[group['missing_days'].fillna(0) > 0].sort_values('missing_days', ascending=False)
+        if not gaps.empty:
+            print(f"  Trading-day gaps ({len(gaps)} stocks): {list(zip(gaps['stock_id'], gaps['missing_days'].astype(int)))[:10]}")
+
+    for note in notes:
+        print(f"Note: {note}")
+    print(f"\nCoverage report built in {elapsed:.3f}s")
+    return report
 
 if __name__ == "__main__":
     diagnose()
@@ -0,0 +1,126 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import glob
+import os
+
+# Configuration
+# Long format, one file per (factor, stock): data/factors/factor=smart_bps/stock_id=2330/part-0.parquet
+FACTOR_DIR = 'data/factors'
+FACTOR_SCHEMA = pa.schema([('date', pa.timestamp('ns')), ('value', pa.float64())])
+PARTITIONING = ds.partitioning(pa.schema([('factor', pa.string()), ('stock_id', pa.string())]), flavor='hive')
+LEGACY_CSV_PATTERN = 'data/smart_bps_result_*.csv'
+
+# Column names used by older result files -> canonical factor name
+FACTOR_ALIASES = {'bps_factor': 'smart_bps'}
+
+def factor_path(factor, stock_id, root=FACTOR_DIR):
+    return os.path.join(root, f'factor={factor}', f'stock_id={stock_id}', 'part-0.parquet')
+
+def _write_table(table, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), f'.part-0.parquet.{os.getpid()}.tmp')
+    pq.write_table(table.sort_by('date'), tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+def write_factors(stock_id, df, factors=None, root=FACTOR_DIR):
+    """
+    Stores each factor column of df (date + one column per factor) as the full series
+    for stock_id, replacing any previous series. Every file is written to a temp name
+    and renamed into place, so concurrent producers never leave a partial file.
+    """
+    stock_id = str(stock_id)
+    df = df.rename(columns=FACTOR_ALIASES)
+    factors = [c for c in df.columns if c != 'date'] if factors is None else list(factors)
+    dates = pd.to_datetime(df['date']).astype('datetime64[ns]').to_numpy()
+
+    for factor in factors:
+        table = pa.table({'date': dates, 'value': pd.to_numeric(df[factor], errors='coerce').astype('float64').to_numpy()}, schema=FACTOR_SCHEMA)
+        _write_table(table, factor_path(factor, stock_id, root))
+
+def append_factors(stock_id, df, factors=None, root=FACTOR_DIR):
+    """
+    Adds the rows of df to the stored series of each factor (a new date is appended, an
+    existing date is overwritten), for daily updates that must not recompute history.
+    """
+    stock_id = str(stock_id)
+    df = df.rename(columns=FACTOR_ALIASES)
+    factors = [c for c in df.columns if c != 'date'] if factors is None else list(factors)
+    dates = pa.array(pd.to_datetime(df['date']).astype('datetime64[ns]').to_numpy(), pa.timestamp('ns'))
+
+    for factor in factors:
+        table = pa.table({'date': dates, 'value': pd.to_numeric(df[factor], errors='coerce').astype('float64').to_numpy()}, schema=FACTOR_SCHEMA)
+        path = factor_path(factor, stock_id, root)
+        if os.path.exists(path):
+            old = pq.read_table(path, schema=FACTOR_SCHEMA)
+            table = pa.concat_tables([old.filter(pc.invert(pc.is_in(old['date'], value_set=dates))), table])
+        _write_table(table, path)
+
+def has_factors(stock_id, factors, root=FACTOR_DIR):
+    return all(os.path.exists(factor_path(f, str(stock_id), root)) for f in factors)
+
+def list_stocks(factor, root=FACTOR_DIR):
+    """Stock IDs that have a stored series for factor."""
+    factor_dir = os.path.join(root, f'factor={factor}')
+    if not os.path.isdir(factor_dir):
+        return []
+    return sorted(d.split('=', 1)[1] for d in os.listdir(factor_dir) if d.startswith('stock_id='))
+
+def read_factors(factors=None, stock_ids=None, start_date=None, end_date=None, root=FACTOR_DIR):
+    """
+    Multi-stock panel from a single dataset scan: one row per (stock_id, date) sorted
+    by stock then date, one column per factor (NaN where a factor has no value).
+    factors / stock_ids / the date window are pushed down as partition and row filters.
+    """
+    factors = None if factors is None else list(factors)
+    columns = ['stock_id', 'date'] + (factors or [])
+    if not os.path.isdir(root):
+        return pd.DataFrame(columns=columns)
+
+    dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+    expr = None
+    conditions = []
+    if factors is not None:
+        conditions.append(ds.field('factor').isin(factors))
+    if stock_ids is not None:
+        conditions.append(ds.field('stock_id').isin([str(s) for s in stock_ids]))
+    if start_date is not None:
+        conditions.append(ds.field('date') >= pa.scalar(pd.Timestamp(start_date), pa.timestamp('ns')))
+    if end_date is not None:
+        conditions.append(ds.field('date') <= pa.scalar(pd.Timestamp(end_date), pa.timestamp('ns')))
+    for cond in conditions:
+        expr = cond if expr is None else expr & cond
+
+    long = dataset.to_table(filter=expr).to_pandas()
+    if long.empty:
+        return pd.DataFrame(columns=columns)
+
+    panel = long.pivot(index=['stock_id', 'date'], columns='factor', values='value')
+    panel = panel.reset_index().sort_values(['stock_id', 'date']).reset_index(drop=True)
+    panel.columns.name = None
+    if factors is not None:
+        for factor in factors:
+            if factor not in panel.columns:
+                panel[factor] = float('nan')
+        panel = panel[columns]
+    return panel
+
+def read_factor_frames(factors=None, stock_ids=None, start_date=None, end_date=None, root=FACTOR_DIR):
+    """read_factors() split into {stock_id: date-sorted frame}, still from one scan."""
+    panel = read_factors(factors, stock_ids, start_date, end_date, root)
+    return {sid: g.drop(columns='stock_id').reset_index(drop=True) for sid, g in panel.groupby('stock_id', sort=False)}
+
+def import_legacy_csvs(pattern=LEGACY_CSV_PATTERN, root=FACTOR_DIR):
+    """One-off migration of data/smart_bps_result_{id}.csv files into the factor store."""
+    paths = sorted(glob.glob(pattern))
+    for path in paths:
+        stock_id = os.path.basename(path)[len('smart_bps_result_'):-len('.csv')]
+        df = pd.read_csv(path).drop_duplicates('date')
+        if not df.empty:
+            write_factors(stock_id, df, root=root)
+    print(f"Imported {len(paths)} result files into {root}")
+
+if __name__ == "__main__":
+    import_legacy_csvs()
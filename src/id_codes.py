@@ -0,0 +1,105 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import os
+
+# Configuration
+# One row per (kind, id): the int32 code of every broker / stock ID seen at ingest
+CODES_PATH = 'data/id_codes.parquet'
+KINDS = ('broker', 'stock')
+MISSING = -1
+
+def normalize_ids(values):
+    """IDs as stripped strings: 2330, 2330.0, ' 2330' and '2330' all become '2330' (nulls stay None)."""
+    s = pd.Series(values)
+    if s.dtype == 'category':
+        s = s.astype(object)
+    if pd.api.types.is_float_dtype(s.dtype):
+        s = s.astype('Int64')
+    ids = s.astype(str).str.strip().str.replace(r'\.0+$', '', regex=True)
+    return ids.where(s.notna(), None).to_numpy(dtype=object)
+
+class IdCodes:
+    """
+    Append-only dictionary from broker / stock ID strings to stable int32 codes: a code
+    is assigned the first time an ID is registered and never changes, so code columns
+    written to different files at different times join directly.
+    """
+    def __init__(self, ids=None):
+        ids = ids or {}
+        self.ids = {kind: list(ids.get(kind, [])) for kind in KINDS}
+        self._index = {kind: pd.Index(self.ids[kind], dtype=object) for kind in KINDS}
+
+    @classmethod
+    def load(cls, path=CODES_PATH):
+        if not os.path.exists(path):
+            return cls()
+        df = pd.read_parquet(path).sort_values(['kind', 'code'])
+        return cls({kind: g['id'].tolist() for kind, g in df.groupby('kind', sort=False)})
+
+    def save(self, path=CODES_PATH):
+        kinds, ids, codes = [], [], []
+        for kind in KINDS:
+            kinds += [kind] * len(self.ids[kind])
+            ids += self.ids[kind]
+            codes += range(len(self.ids[kind]))
+        table = pa.table({'kind': pa.array(kinds, pa.string()), 'id': pa.array(ids, pa.string()), 'code': pa.array(codes, pa.int32())})
+        tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def encode(self, kind, values, add=True):
+        """
+        int32 codes for values (any ID dtype; categoricals are encoded per category).
+        New IDs are registered when add=True, else coded MISSING (as are nulls).
+        """
+        if isinstance(values, pd.Series) and values.dtype == 'category':
+            cat_codes = self.encode(kind, values.cat.categories, add)
+            codes = values.cat.codes.to_numpy()
+            return np.where(codes >= 0, cat_codes[codes], MISSING).astype('int32')
+
+        ids = normalize_ids(values)
+        codes = self._index[kind].get_indexer(ids)
+        unknown = (codes < 0) & pd.notna(ids)
+        if add and unknown.any():
+            new = pd.unique(ids[unknown])
+            self.ids[kind].extend(new.tolist())
+            self._index[kind] = self._index[kind].append(pd.Index(new, dtype=object))
+            codes = self._index[kind].get_indexer(ids)
+        return codes.astype('int32')
+
+    def decode(self, kind, codes):
+        """ID strings for codes (None for MISSING)."""
+        lookup = np.array(self.ids[kind] + [None], dtype=object)
+        codes = np.asarray(codes, dtype='int64')
+        return lookup[np.where(codes >= 0, codes, len(self.ids[kind]))]
+
+_CODES = None
+
+def get_id_codes():
+    """Process-wide dictionary, loaded from CODES_PATH on first use."""
+    global _CODES
+    if _CODES is None:
+        _CODES = IdCodes.load()
+    return _CODES
+
+def register_ids(kind, values, path=CODES_PATH):
+    """
+    Ingest hook: assigns codes to any new IDs, persists the dictionary and returns the
+    codes. Ingest is the only writer, so codes handed out stay valid across processes.
+    """
+    codes = get_id_codes()
+    n = len(codes.ids[kind])
+    out = codes.encode(kind, values, add=True)
+    if len(codes.ids[kind]) > n or not os.path.exists(path):
+        codes.save(path)
+    return out
+
+def stock_codes(values):
+    """int32 stock codes (IDs not yet ingested get process-local codes)."""
+    return get_id_codes().encode('stock', values)
+
+def broker_codes(values):
+    """int32 broker codes (IDs not yet ingested get process-local codes)."""
+    return get_id_codes().encode('broker', values)
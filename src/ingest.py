@@ -0,0 +1,485 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from id_codes import get_id_codes, register_ids
+from branch_data import PARTITIONED_DIR, ROW_GROUP_SIZE as BRANCH_ROW_GROUP_SIZE, partition_dir, _as_timestamp, _stock_bounds
+
+# Configuration
+PRICE_CSV = 'data/price.csv'
+REVENUE_CSV = 'data/announcement.csv'
+MARKET_CSV = 'data/market.csv'
+PRICE_PARQUET = 'data/stock_price_history.parquet'
+REVENUE_PARQUET = 'data/revenue_announcements.parquet'
+MARKET_PARQUET = 'data/market_index.parquet'
+
+BLOCK_SIZE = 16 << 20 # Bytes of CSV per streamed batch (bounds peak memory)
+ROW_GROUP_SIZE = 128 * 1024
+NULL_VALUES = ['', '-', '--', 'NA', 'N/A', 'nan', 'NaN']
+REVENUE_YEARS = [2024, 2025]
+COVERAGE_KEY = 'stock_coverage' # Footer key-value entry: {stock_id: [first_date, last_date, rows]}
+REVENUE_COLUMNS = ['公司', '年月', '營收發布日', '單月營收成長率％', '創新高/低(歷史)', '創新高/低(近一年)']
+
+PRICE_COLUMNS = {
+    '開盤價(元)': 'open',
+    '最高價(元)': 'high',
+    '最低價(元)': 'low',
+    '收盤價(元)': 'close',
+    '成交值(千元)': 'volume_value_1k'
+}
+
+def _open_csv(csv_path, columns, inferred=()):
+    """Streaming, multithreaded CSV reader; requested columns stay text unless listed in inferred."""
+    return pacsv.open_csv(
+        csv_path,
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=BLOCK_SIZE),
+        parse_options=pacsv.ParseOptions(invalid_row_handler=lambda row: 'skip'),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=columns,
+            column_types={c: pa.string() for c in columns if c not in inferred},
+            null_values=NULL_VALUES,
+            strings_can_be_null=True
+        )
+    )
+
+def _stock_id(col):
+    """'1101 台泥' -> '1101' (vectorized)."""
+    return pc.list_element(pc.utf8_split_whitespace(pc.utf8_trim_whitespace(col), max_splits=1), 0)
+
+def _to_float(col):
+    """Text -> float64 with thousands separators removed; unparsable values become null."""
+    col = pc.replace_substring(col, ',', '')
+    try:
+        return pc.cast(col, pa.float64())
+    except pa.ArrowInvalid:
+        return pa.array(pd.to_numeric(col.to_pandas(), errors='coerce'), pa.float64())
+
+def _yyyymmdd(col):
+    """20150105 -> '2015-01-05' (null when unparsable)."""
+    ts = pc.strptime(pc.utf8_trim_whitespace(col), format='%Y%m%d', unit='s', error_is_null=True)
+    return ts, pc.strftime(ts, format='%Y-%m-%d')
+
+def _write_atomic(out_path, write_fn):
+    """Writes to a hidden temp file next to out_path and renames it into place."""
+    tmp_path = os.path.join(os.path.dirname(out_path), '.' + os.path.basename(out_path) + '.tmp')
+    write_fn(tmp_path)
+    _replace(tmp_path, out_path)
+
+def _replace(tmp_path, out_path):
+    """os.replace that also supersedes a dataset directory left by append_*."""
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+    os.replace(tmp_path, out_path)
+
+def _stock_coverage(table, date_col, coverage=None):
+    """
+    Merges each stock's first/last date and row count in table into coverage. Written to
+    the file footer so diagnose_data_range can report per-stock coverage without data pages.
+    """
+    coverage = {} if coverage is None else coverage
+    if table.num_rows == 0:
+        return coverage
+    grouped = table.group_by('stock_id').aggregate([(date_col, 'min'), (date_col, 'max'), (date_col, 'count')])
+    columns = ['stock_id', f'{date_col}_min', f'{date_col}_max', f'{date_col}_count']
+    for stock_id, first, last, rows in zip(*(grouped[c].to_pylist() for c in columns)):
+        first, last = str(first)[:10], str(last)[:10]
+        if stock_id in coverage:
+            prev_first, prev_last, prev_rows = coverage[stock_id]
+            first, last, rows = min(prev_first, first), max(prev_last, last), prev_rows + rows
+        coverage[stock_id] = [first, last, rows]
+    return coverage
+
+def _with_coverage(table, date_col):
+    """table with its stock coverage attached as schema (footer) metadata."""
+    metadata = {**(table.schema.metadata or {}), COVERAGE_KEY.encode(): json.dumps(_stock_coverage(table, date_col)).encode()}
+    return table.replace_schema_metadata(metadata)
+
+def _clean_price_batch(batch):
+    _, date = _yyyymmdd(batch.column('年月日'))
+    cols = {'date': date, 'stock_id': _stock_id(batch.column('證券代碼'))}
+    for raw, name in PRICE_COLUMNS.items():
+        cols[name] = _to_float(batch.column(raw))
+    table = pa.table(cols)
+
+    valid = pc.and_(pc.and_(pc.is_valid(table['date']), pc.is_valid(table['close'])),
+                    pc.and_(pc.is_valid(table['stock_id']), pc.not_equal(table['stock_id'], '')))
+    return _with_stock_code(table.filter(valid))
+
+def _with_stock_code(table):
+    """Adds the int32 stock_code (id_codes dictionary) after stock_id; new stocks are registered."""
+    codes = get_id_codes().encode('stock', table['stock_id'].to_numpy(zero_copy_only=False))
+    return table.add_column(table.schema.get_field_index('stock_id') + 1, 'stock_code', pa.array(codes, pa.int32()))
+
+def _write_bucketed(tables, out_path, date_col, tmp_prefix):
+    """
+    Writes cleaned batches to out_path sorted by (stock_id, date_col), with the stock
+    coverage footer. Pass 1 streams them into buckets keyed by the stock ID's first two
+    characters; pass 2 sorts one bucket at a time and appends it as row groups, so peak
+    memory is one CSV block plus the largest bucket. Returns rows written (0: no file).
+    """
+    tmp_dir = tempfile.mkdtemp(prefix=tmp_prefix, dir=os.path.dirname(out_path) or '.')
+    writers = {}
+    bucket_files = {}
+    sort_keys = [('stock_id', 'ascending'), (date_col, 'ascending')]
+
+    try:
+        for table in tables:
+            if table.num_rows == 0:
+                continue
+            buckets = pc.utf8_slice_codeunits(table['stock_id'], 0, 2)
+            for key in pc.unique(buckets).to_pylist():
+                part = table.filter(pc.equal(buckets, key))
+                if key not in writers:
+                    bucket_files[key] = os.path.join(tmp_dir, f'{len(writers)}.parquet')
+                    writers[key] = pq.ParquetWriter(bucket_files[key], part.schema)
+                writers[key].write_table(part)
+
+        for w in writers.values():
+            w.close()
+        if not writers:
+            return 0
+
+        coverage = {}
+        def write_sorted(path):
+            writer = None
+            for key in sorted(bucket_files):
+                table = pq.read_table(bucket_files[key]).sort_by(sort_keys)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema, compression='zstd')
+                writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+                _stock_coverage(table, date_col, coverage)
+            writer.add_key_value_metadata({COVERAGE_KEY: json.dumps(coverage)})
+            writer.close()
+
+        _write_atomic(out_path, write_sorted)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return sum(rows for _, _, rows in coverage.values())
+
+def ingest_price(csv_path=PRICE_CSV, out_path=PRICE_PARQUET):
+    """TEJ price.csv -> stock_price_history.parquet, sorted by (stock_id, date) (see _write_bucketed)."""
+    print(f"Ingesting {csv_path} -> {out_path}...")
+    rows_in = 0
+
+    def cleaned():
+        nonlocal rows_in
+        for batch in _open_csv(csv_path, ['證券代碼', '年月日'] + list(PRICE_COLUMNS)):
+            rows_in += batch.num_rows
+            yield _clean_price_batch(batch)
+
+    _write_bucketed(cleaned(), out_path, 'date', 'ingest_price_')
+    get_id_codes().save()
+    print(f"Done. {rows_in} rows read.")
+    return rows_in
+
+def _clean_revenue_batch(batch, years=None):
+    """Announcement batch -> revenue table (sorted by the writer); None if no rows are kept."""
+    # Announcement dates come as YYYY/M/D; pandas parses the whole column at once
+    ann = pd.to_datetime(batch.column('營收發布日').to_pandas(), errors='coerce')
+    keep = ann.notna() if years is None else ann.notna() & ann.dt.year.isin(years)
+    if not keep.any():
+        return None
+    mask = pa.array(keep.to_numpy())
+    return _with_stock_code(pa.table({
+        'stock_id': _stock_id(batch.column('公司')).filter(mask),
+        'announcement_date': pa.array(ann[keep].dt.strftime('%Y-%m-%d').to_numpy(), pa.string()),
+        'report_month': batch.column('年月').filter(mask),
+        'revenue_growth_pct': _to_float(batch.column('單月營收成長率％')).filter(mask),
+        '創新高/低(歷史)': batch.column('創新高/低(歷史)').filter(mask),
+        '創新高/低(近一年)': batch.column('創新高/低(近一年)').filter(mask)
+    }))
+
+def ingest_revenue(csv_path=REVENUE_CSV, out_path=REVENUE_PARQUET, years=REVENUE_YEARS):
+    """
+    TEJ announcement.csv -> revenue_announcements.parquet (same schema as convert_revenue_csv),
+    sorted by (stock_id, announcement_date) like ingest_price (see _write_bucketed).
+    """
+    print(f"Ingesting {csv_path} -> {out_path}...")
+    rows_in = 0
+
+    def cleaned():
+        nonlocal rows_in
+        for batch in _open_csv(csv_path, REVENUE_COLUMNS, inferred=['年月']):
+            rows_in += batch.num_rows
+            table = _clean_revenue_batch(batch, years)
+            if table is not None:
+                yield table
+
+    if not _write_bucketed(cleaned(), out_path, 'announcement_date', 'ingest_revenue_'):
+        print("No rows in the requested years.")
+        return rows_in
+    get_id_codes().save()
+    print(f"Done. {rows_in} rows read.")
+    return rows_in
+
+def _read_market(csv_path):
+    """market.csv -> (date-sorted table of 證券代碼, date, close; rows read)."""
+    rows_in = 0
+    parts = []
+    for batch in _open_csv(csv_path, ['證券代碼', '年月日', '收盤價(元)']):
+        rows_in += batch.num_rows
+        ts, _ = _yyyymmdd(batch.column('年月日'))
+        parts.append(pa.table({
+            '證券代碼': batch.column('證券代碼'),
+            'date': pc.cast(ts, pa.timestamp('ns')),
+            'close': _to_float(batch.column('收盤價(元)'))
+        }))
+    # A single index series is small: sort once, then compute returns across batch boundaries
+    return pa.concat_tables(parts).sort_by('date'), rows_in
+
+def _with_market_ret(table, prev_close=None):
+    """Adds market_ret; the first row uses prev_close (the last stored close) or 0 when there is none."""
+    close = table['close'].to_numpy(zero_copy_only=False)
+    market_ret = np.zeros(len(close))
+    market_ret[1:] = close[1:] / close[:-1] - 1
+    if prev_close is not None and len(close):
+        market_ret[0] = close[0] / prev_close - 1
+    return table.append_column('market_ret', pa.array(market_ret))
+
+def ingest_market(csv_path=MARKET_CSV, out_path=MARKET_PARQUET):
+    """TEJ market.csv -> market_index.parquet with daily market_ret."""
+    print(f"Ingesting {csv_path} -> {out_path}...")
+    table, rows_in = _read_market(csv_path)
+    table = _with_market_ret(table)
+
+    _write_atomic(out_path, lambda path: pq.write_table(table, path))
+    print(f"Done. {rows_in} rows read.")
+    return rows_in
+
+# --- Incremental append ---
+# A dataset is the single Parquet file written by ingest_* or, after its first append,
+# a directory of the same name holding part-0.parquet plus one part-YYYYMMDD-N.parquet
+# per appended batch (its newest date plus a sequence number, so same-day batches never
+# overwrite each other). pd.read_parquet / pq.read_table read both forms unchanged.
+
+def _dataset_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.parquet') and not f.startswith('.'))
+    return [path] if os.path.exists(path) else []
+
+def _as_dataset_dir(path):
+    """Moves a single-file dataset to path/part-0.parquet so new days can be added as files."""
+    if os.path.isfile(path):
+        tmp_dir = path + '.tmp'
+        os.makedirs(tmp_dir, exist_ok=True)
+        os.replace(path, os.path.join(tmp_dir, 'part-0.parquet'))
+        os.rename(tmp_dir, path)
+    os.makedirs(path, exist_ok=True)
+
+def _max_stat(files, column):
+    """Largest stored value of column, from footer statistics only (None if any row group lacks them)."""
+    newest = None
+    for f in files:
+        meta = pq.ParquetFile(f).metadata
+        idx = meta.schema.to_arrow_schema().get_field_index(column)
+        for rg in range(meta.num_row_groups):
+            stats = meta.row_group(rg).column(idx).statistics
+            if stats is None or not stats.has_min_max:
+                return None
+            newest = stats.max if newest is None else max(newest, stats.max)
+    return newest
+
+def _new_part_path(path, last):
+    """First unused part-YYYYMMDD-N.parquet for a batch whose newest date is last (parts are never overwritten)."""
+    stem = f"part-{last.strftime('%Y%m%d')}"
+    seq = 0
+    while os.path.exists(os.path.join(path, f'{stem}-{seq}.parquet')):
+        seq += 1
+    return os.path.join(path, f'{stem}-{seq}.parquet')
+
+def _conform(path, table):
+    """Casts table to the stored schema so new parts read back as one dataset."""
+    files = _dataset_files(path)
+    if not files:
+        return table
+    fields = [f for f in pq.read_schema(files[0]) if f.name in table.column_names]
+    return table.select([f.name for f in fields]).cast(pa.schema(fields))
+
+def _drop_existing(path, table, keys, date_col):
+    """Removes rows of table whose keys are already stored at path."""
+    files = _dataset_files(path)
+    if not files or table.num_rows == 0:
+        return table
+    newest = _max_stat(files, date_col)
+    if newest is not None and pc.min(table[date_col]).as_py() > newest:
+        return table # Only newer days: nothing to scan
+    # Overlap: read just the keys on the incoming dates
+    dates = pc.unique(table[date_col]).to_pylist()
+    existing = pq.read_table(path, columns=keys, filters=[(date_col, 'in', dates)])
+    return table.join(existing, keys, join_type='left anti')
+
+def _append_part(path, table, keys, date_col, sort_keys):
+    """Appends the rows of table not yet stored at path as one new part file. Returns rows written."""
+    table = _drop_existing(path, _conform(path, table), keys, date_col)
+    if table.num_rows == 0:
+        return 0
+    _as_dataset_dir(path)
+    table = table.sort_by([(k, 'ascending') for k in sort_keys])
+    if 'stock_id' in table.column_names:
+        table = _with_coverage(table, date_col)
+    last = pd.Timestamp(pc.max(table[date_col]).as_py())
+    part_path = _new_part_path(path, last)
+    _write_atomic(part_path, lambda p: pq.write_table(table, p, compression='zstd', write_statistics=True))
+    return table.num_rows
+
+def append_price_day(csv_path, out_path=PRICE_PARQUET):
+    """Appends the (stock_id, date) rows of a price export that are not yet in stock_price_history."""
+    print(f"Appending {csv_path} -> {out_path}...")
+    parts = [_clean_price_batch(b) for b in _open_csv(csv_path, ['證券代碼', '年月日'] + list(PRICE_COLUMNS))]
+    written = _append_part(out_path, pa.concat_tables(parts), ['stock_id', 'date'], 'date', ['stock_id', 'date']) if parts else 0
+    get_id_codes().save()
+    print(f"Done. {written} new rows.")
+    return written
+
+def append_revenue(csv_path, out_path=REVENUE_PARQUET):
+    """Appends announcements (any year) whose (stock_id, announcement_date) is not yet stored."""
+    print(f"Appending {csv_path} -> {out_path}...")
+    parts = [t for t in (_clean_revenue_batch(b) for b in _open_csv(csv_path, REVENUE_COLUMNS, inferred=['年月'])) if t is not None]
+    keys = ['stock_id', 'announcement_date']
+    written = _append_part(out_path, pa.concat_tables(parts), keys, 'announcement_date', keys) if parts else 0
+    get_id_codes().save()
+    print(f"Done. {written} new rows.")
+    return written
+
+def append_market_day(csv_path, out_path=MARKET_PARQUET):
+    """Appends new index days; market_ret of the first new day is taken against the last stored close."""
+    print(f"Appending {csv_path} -> {out_path}...")
+    table, _ = _read_market(csv_path)
+    table = _drop_existing(out_path, _conform(out_path, table), ['date'], 'date')
+    if table.num_rows == 0:
+        print("Done. 0 new rows.")
+        return 0
+
+    prev_close = None
+    if _dataset_files(out_path):
+        before = pq.read_table(out_path, columns=['date', 'close'], filters=[('date', '<', pc.min(table['date']).as_py())])
+        if before.num_rows:
+            prev_close = before.sort_by('date')['close'][-1].as_py()
+    written = _append_part(out_path, _with_market_ret(table, prev_close), ['date'], 'date', ['date'])
+    print(f"Done. {written} new rows.")
+    return written
+
+def append_branch_day(path, out_dir=PARTITIONED_DIR):
+    """
+    Appends a daily StockBranch export (Parquet or CSV, raw columns) to the per-stock
+    layout: each stock gets one new part file holding only dates it does not have yet.
+    """
+    if not os.path.isdir(out_dir):
+        print(f"{out_dir} not found. Run branch_data.relayout_branch_data() first.")
+        return 0
+    print(f"Appending {path} -> {out_dir}...")
+    if path.endswith('.parquet'):
+        table = pq.read_table(path)
+    else:
+        table = pacsv.read_csv(path, convert_options=pacsv.ConvertOptions(
+            column_types={'CommodityId': pa.string(), 'SecuritiesTraderId': pa.string()}))
+    table = table.set_column(table.schema.get_field_index('Date'), 'Date', _as_timestamp(table['Date']))
+    table = table.set_column(table.schema.get_field_index('CommodityId'), 'CommodityId', pc.cast(table['CommodityId'], pa.string()))
+    table = table.sort_by([('CommodityId', 'ascending'), ('Date', 'ascending'), ('SecuritiesTraderId', 'ascending')])
+    register_ids('stock', pc.unique(table['CommodityId']).to_numpy(zero_copy_only=False))
+    register_ids('broker', pc.unique(table['SecuritiesTraderId']).to_numpy(zero_copy_only=False))
+
+    written = 0
+    for stock_id, (start, end) in _stock_bounds(table['CommodityId'].to_numpy()).items():
+        part = table.slice(start, end - start).drop_columns(['CommodityId'])
+        written += _append_part(partition_dir(stock_id, out_dir), part, ['Date'], 'Date', ['Date', 'SecuritiesTraderId'])
+    print(f"Done. {written} new rows.")
+    return written
+
+def compact_dataset(path, sort_keys, row_group_size=ROW_GROUP_SIZE, coverage_date=None):
+    """Merges a dataset directory's appended parts back into one sorted part-0.parquet."""
+    if len(_dataset_files(path)) <= 1:
+        return
+    table = pq.read_table(path).sort_by([(k, 'ascending') for k in sort_keys])
+    if coverage_date is not None:
+        table = _with_coverage(table, coverage_date)
+    tmp_dir = path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    pq.write_table(table, os.path.join(tmp_dir, 'part-0.parquet'), row_group_size=row_group_size,
+                   use_dictionary=True, write_statistics=True, compression='zstd')
+    # Move the old parts aside before swapping in the merged file, so path is never missing its rows
+    old_dir = path.rstrip('/') + '.old'
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    os.rename(path, old_dir)
+    os.rename(tmp_dir, path)
+    shutil.rmtree(old_dir)
+
+def compact_all():
+    """Compacts every appended dataset, including each stock of the branch layout."""
+    compact_dataset(PRICE_PARQUET, ['stock_id', 'date'], coverage_date='date')
+    compact_dataset(REVENUE_PARQUET, ['stock_id', 'announcement_date'], coverage_date='announcement_date')
+    compact_dataset(MARKET_PARQUET, ['date'])
+    if os.path.isdir(PARTITIONED_DIR):
+        for name in sorted(os.listdir(PARTITIONED_DIR)):
+            compact_dataset(os.path.join(PARTITIONED_DIR, name), ['Date', 'SecuritiesTraderId'], BRANCH_ROW_GROUP_SIZE)
+
+def benchmark_ingest():
+    """Rows/second of the pandas scripts vs the streaming ingest on the same CSVs."""
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import convert_revenue_csv
+    import process_market_data
+    from archive import clean_price_data
+
+    out_dir = tempfile.mkdtemp(prefix='ingest_bench_')
+    jobs = [
+        ('price', PRICE_CSV, clean_price_data, 'INPUT_CSV', 'OUTPUT_PARQUET', clean_price_data.clean_price_data, ingest_price),
+        ('revenue', REVENUE_CSV, convert_revenue_csv, 'CSV_PATH', 'PARQUET_PATH', convert_revenue_csv.process_revenue_data, ingest_revenue),
+        ('market', MARKET_CSV, process_market_data, 'CSV_PATH', 'PARQUET_PATH', process_market_data.process_market_index, ingest_market)
+    ]
+    results = []
+    try:
+        for name, csv_path, module, in_attr, out_attr, legacy_fn, new_fn in jobs:
+            if not os.path.exists(csv_path):
+                print(f"{csv_path} not found. Skipping {name}.")
+                continue
+            setattr(module, in_attr, csv_path)
+            setattr(module, out_attr, os.path.join(out_dir, f'{name}_legacy.parquet'))
+            start = time.perf_counter()
+            legacy_fn()
+            legacy_s = time.perf_counter() - start
+
+            start = time.perf_counter()
+            rows = new_fn(csv_path, os.path.join(out_dir, f'{name}_stream.parquet'))
+            stream_s = time.perf_counter() - start
+            results.append({'file': name, 'rows': rows, 'legacy_rows_per_s': rows / legacy_s, 'stream_rows_per_s': rows / stream_s, 'speedup': legacy_s / stream_s})
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    print("\n--- Ingestion Throughput ---")
+    print(pd.DataFrame(results).to_string(index=False))
+    return results
+
+APPENDERS = {
+    'price': append_price_day,
+    'revenue': append_revenue,
+    'market': append_market_day,
+    'branch': append_branch_day
+}
+
+if __name__ == "__main__":
+    # python src/ingest.py [price|revenue|market|all|benchmark|compact]
+    # python src/ingest.py append [price|revenue|market|branch] <file>
+    target = sys.argv[1] if len(sys.argv) > 1 else 'all'
+    if target == 'append':
+        APPENDERS[sys.argv[2]](sys.argv[3])
+    if target == 'compact':
+        compact_all()
+    if target in ('price', 'all'):
+        ingest_price()
+    if target in ('revenue', 'all'):
+        ingest_revenue()
+    if target in ('market', 'all'):
+        ingest_market()
+    if target == 'benchmark':
+        benchmark_ingest()
@@ -0,0 +1,170 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import os
+from branch_data import _branch_source, _as_timestamp
+from price_store import PRICE_DB_PATH, _to_ns
+from tick_cache import _fingerprint as _source_fingerprint
+
+# Configuration
+# Long format, one row per (date, stock) active in the longest window, sorted by date then stock
+LIQUIDITY_PATH = 'data/liquidity_rank.parquet'
+WINDOWS = [20, 60, 120] # Trading days, ending on (and including) each date
+METRICS = [f'{kind}_{w}' for kind in ('value', 'rows') for w in WINDOWS]
+DEFAULT_METRIC = 'value_60'
+SOURCE_KEY = 'source_fingerprint' # Footer entry: fingerprint of the price dataset the table was built from
+
+def _daily_value(price_path=PRICE_DB_PATH):
+    """Per-(stock_id, date) traded value in thousand NTD, rounded to int64 so rolling sums are exact."""
+    df = pq.read_table(price_path, columns=['stock_id', 'date', 'volume_value_1k']).to_pandas()
+    df = df.assign(stock_id=df['stock_id'].astype(str), date=pd.to_datetime(df['date']))
+    value = df['volume_value_1k'].fillna(0).round().astype('int64')
+    return df.assign(value=value).groupby(['stock_id', 'date'], sort=False)['value'].sum().reset_index()
+
+def _daily_branch_rows():
+    """Per-(stock_id, date) StockBranch row counts from a two-column scan of the current branch source."""
+    parts = []
+    for batch in _branch_source().scanner(columns=['CommodityId', 'Date']).to_batches():
+        if batch.num_rows == 0:
+            continue
+        table = pa.table({'stock_id': pc.cast(batch.column('CommodityId'), pa.string()), 'date': _as_timestamp(batch.column('Date'))})
+        parts.append(table.group_by(['stock_id', 'date']).aggregate([('stock_id', 'count')]))
+    if not parts:
+        return pd.DataFrame({'stock_id': pd.Series(dtype=str), 'date': pd.Series(dtype='datetime64[ns]'), 'rows': pd.Series(dtype='int64')})
+    counts = pa.concat_tables(parts).group_by(['stock_id', 'date']).aggregate([('stock_id_count', 'sum')])
+    return counts.rename_columns(['stock_id', 'date', 'rows']).to_pandas()
+
+def _dense(df, column, day_ns, stocks):
+    """(n_days, n_stocks) int64 matrix of df[column]; days or stocks without a row are 0."""
+    mat = np.zeros((len(day_ns), len(stocks)), dtype='int64')
+    mat[np.searchsorted(day_ns, _to_ns(df['date'])), np.searchsorted(stocks, df['stock_id'].to_numpy(dtype=object))] = df[column].to_numpy()
+    return mat
+
+def _rolling(mat, window):
+    """Trailing window sums along the day axis (exact: integer cumsum differences)."""
+    cs = np.cumsum(mat, axis=0)
+    out = cs.copy()
+    out[window:] -= cs[:-window]
+    return out
+
+def _ranks(mat):
+    """1-based descending rank per day (ties by stock ID); 0 where the value is 0."""
+    order = np.argsort(-mat, axis=1, kind='stable')
+    ranks = np.empty_like(order, dtype='int32')
+    np.put_along_axis(ranks, order, np.arange(1, mat.shape[1] + 1, dtype='int32')[None, :].repeat(mat.shape[0], axis=0), axis=1)
+    ranks[mat <= 0] = 0
+    return ranks
+
+def build_liquidity_table(out_path=LIQUIDITY_PATH, price_path=PRICE_DB_PATH):
+    """
+    Rolling 20/60/120-day traded value and branch-row counts, with each metric's
+    cross-sectional rank, for every stock and trading day. Every value uses data up
+    to and including its own date only, so rankings carry no look-ahead.
+    """
+    print(f"Building liquidity ranking table -> {out_path}...")
+    daily = {'value': _daily_value(price_path), 'rows': _daily_branch_rows()}
+    day_ns = np.unique(np.concatenate([_to_ns(df['date']) for df in daily.values() if not df.empty] or [np.array([], dtype='int64')]))
+    stocks = np.unique(np.concatenate([df['stock_id'].to_numpy(dtype=object) for df in daily.values()]).astype(str)).astype(object)
+
+    columns = {}
+    for kind, df in daily.items():
+        mat = _dense(df, kind, day_ns, stocks)
+        for w in WINDOWS:
+            columns[f'{kind}_{w}'] = _rolling(mat, w)
+
+    longest = [f'{kind}_{max(WINDOWS)}' for kind in daily]
+    day_idx, stock_idx = np.nonzero(np.logical_or.reduce([columns[c] > 0 for c in longest]))
+    arrays = {
+        'date': pa.array(day_ns[day_idx].astype('datetime64[ns]')),
+        'stock_id': pa.array(stocks[stock_idx], pa.string())
+    }
+    for metric in METRICS:
+        arrays[metric] = pa.array(columns[metric][day_idx, stock_idx])
+    for metric in METRICS:
+        rank = _ranks(columns[metric])[day_idx, stock_idx]
+        arrays[f'rank_{metric}'] = pa.array(rank, mask=rank == 0)
+
+    table = pa.table(arrays).replace_schema_metadata({SOURCE_KEY: _source_fingerprint(price_path)})
+    tmp_path = os.path.join(os.path.dirname(out_path), f'.{os.path.basename(out_path)}.tmp')
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, out_path)
+    print(f"Done. {len(day_ns)} days x {len(stocks)} stocks -> {table.num_rows} rows.")
+
+class LiquidityRanking:
+    """
+    Top-N universe lookups over the liquidity table. Per metric, a (n_days, max_rank)
+    array holds the stock codes in rank order, so top(date, n) is one searchsorted
+    for the date plus a slice of n codes.
+    """
+    def __init__(self, df):
+        self.day_ns = np.unique(_to_ns(df['date']))
+        self.date_pos = np.searchsorted(self.day_ns, _to_ns(df['date']))
+        codes, self.stocks = pd.factorize(df['stock_id'].astype(str))
+        self.stock_codes = codes.astype('int32')
+        self.stocks = np.asarray(self.stocks, dtype=object)
+        self.frame = df
+        self._by_rank = {}
+        self.source = None
+
+    @classmethod
+    def load(cls, path=LIQUIDITY_PATH):
+        ranking = cls(pd.read_parquet(path))
+        ranking.source = _table_source(path)
+        return ranking
+
+    def _rank_table(self, metric):
+        if metric not in self._by_rank:
+            if metric not in METRICS:
+                raise ValueError(f"Unknown liquidity metric {metric!r}; expected one of {METRICS}")
+            rank = self.frame[f'rank_{metric}'].to_numpy(dtype='float64', na_value=0).astype('int64')
+            valid = rank > 0
+            table = np.full((len(self.day_ns), int(rank.max(initial=0))), -1, dtype='int32')
+            table[self.date_pos[valid], rank[valid] - 1] = self.stock_codes[valid]
+            self._by_rank[metric] = table
+        return self._by_rank[metric]
+
+    def top(self, date=None, n=50, metric=DEFAULT_METRIC):
+        """
+        Top n stock IDs by metric as of the last table date <= date (default: latest).
+        Stocks with no activity in the window are never returned.
+        """
+        table = self._rank_table(metric)
+        pos = len(self.day_ns) - 1 if date is None else np.searchsorted(self.day_ns, _to_ns(date), side='right') - 1
+        if pos < 0:
+            return []
+        codes = table[pos, :n]
+        return self.stocks[codes[codes >= 0]].tolist()
+
+    def last_date(self):
+        return pd.Timestamp(self.day_ns[-1]) if len(self.day_ns) else None
+
+def _table_source(path):
+    """Price-dataset fingerprint stored in the table's footer ('' for tables built before it was recorded)."""
+    return (pq.read_metadata(path).metadata or {}).get(SOURCE_KEY.encode(), b'').decode()
+
+_RANKING = None
+
+def get_liquidity_ranking(path=LIQUIDITY_PATH, price_path=PRICE_DB_PATH):
+    """
+    Process-wide LiquidityRanking. The table is (re)built when it does not exist or
+    when the price dataset changed since it was built (e.g. after ingest append_*),
+    so the latest date always follows the newest ingested day.
+    """
+    global _RANKING
+    # Without the price dataset an existing table is used as is
+    source = _source_fingerprint(price_path) if os.path.exists(price_path) else None
+    if _RANKING is None or source not in (None, _RANKING.source):
+        if not os.path.exists(path) or source not in (None, _table_source(path)):
+            build_liquidity_table(path, price_path)
+        _RANKING = LiquidityRanking.load(path)
+    return _RANKING
+
+def get_top_stocks(n=50, date=None, metric=DEFAULT_METRIC):
+    """Top n liquid stocks as of date (no look-ahead); see LiquidityRanking.top."""
+    return get_liquidity_ranking().top(date, n, metric)
+
+if __name__ == "__main__":
+    # Rebuild after ingest.py appends new days
+    build_liquidity_table()
@@ -0,0 +1,111 @@
+import pandas as pd
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from branch_data import PARTITIONED_DIR, iter_branch_by_stock
+from broker_flow import load_flow, select_brokers, _all_stock_ids
+from broker_clustering import run_analysis
+from batch_clustering import identify_accumulator_cluster
+from bps_engine import calculate_bps_market
+from price_store import PriceStore, PRICE_DB_PATH
+from factor_store import write_factors, has_factors
+
+# Configuration
+BATCH_SIZE = 200 # Stocks per kernel call: bounds the padded stocks x brokers book and the batch's flow in memory
+WORKERS = os.cpu_count() or 1 # Batches run in parallel processes (1 = in this process)
+RESULT_FACTORS = ['price', 'original_bps', 'smart_bps']
+
+def _iter_raw(stock_ids):
+    """(stock_id, raw rows) per stock: None on the partitioned layout (load_flow reads it), one scan of the monolithic file otherwise."""
+    if os.path.isdir(PARTITIONED_DIR):
+        return ((s, None) for s in stock_ids)
+    return iter_branch_by_stock(stock_ids)
+
+def smart_broker_ids(stock_id, flow):
+    """Brokers of the accumulator cluster (re-clusters, writing data/broker_clusters_{id}.csv), or None."""
+    clustered_df = run_analysis(stock_id, flow)
+    best_cluster_id, _ = identify_accumulator_cluster(clustered_df)
+    if best_cluster_id is None:
+        return None
+    return clustered_df[clustered_df['cluster'] == best_cluster_id]['securities_trader_id'].tolist()
+
+def _bps_panel(originals, smarts, prices):
+    """Original + Smart BPS of {stock_id: flow} from two kernel runs, as one stock_id/date panel."""
+    original = calculate_bps_market(pd.concat(originals.values(), ignore_index=True), prices)
+    smart = calculate_bps_market(pd.concat(smarts.values(), ignore_index=True), prices)
+    # Same panel as run_full_market_scan.process_stock: smart_bps is 0 on days the smart brokers did not trade
+    return original.rename(columns={'bps_factor': 'original_bps'}).merge(
+        smart[['stock_id', 'date', 'bps_factor']].rename(columns={'bps_factor': 'smart_bps'}), on=['stock_id', 'date'], how='left'
+    ).fillna(0)
+
+def run_batch(stock_ids, start_date=None):
+    """
+    Clustering (on each stock's full flow) + Original/Smart BPS from start_date for a batch
+    of stocks, from two kernel runs. A stock that fails is logged and skipped; the rest of
+    the batch is still written. Returns the number of stocks written.
+    """
+    originals, smarts = {}, {}
+    for stock_id, raw in _iter_raw(stock_ids):
+        try:
+            flow = load_flow(stock_id, df=raw)
+            if flow.empty:
+                continue
+            broker_ids = smart_broker_ids(stock_id, flow)
+            if start_date is not None:
+                flow = flow[flow['date'] >= start_date]
+            smart_flow = select_brokers(flow, broker_ids) if broker_ids else flow.iloc[:0]
+            if not smart_flow.empty:
+                originals[stock_id] = flow
+                smarts[stock_id] = smart_flow
+        except Exception as e:
+            print(f"Failed on {stock_id}: {e}")
+    if not originals:
+        return 0
+
+    prices = PriceStore.load(stock_ids=stock_ids) if os.path.exists(PRICE_DB_PATH) else pd.DataFrame()
+    try:
+        panels = [_bps_panel(originals, smarts, prices)]
+    except Exception:
+        # Isolate the failing stock(s): rerun the kernel one stock at a time
+        panels = []
+        for stock_id in originals:
+            try:
+                panels.append(_bps_panel({stock_id: originals[stock_id]}, {stock_id: smarts[stock_id]}, prices))
+            except Exception as e:
+                print(f"Failed on {stock_id}: {e}")
+
+    written = 0
+    for panel in panels:
+        for stock_id, comparison in panel.groupby('stock_id', sort=False):
+            try:
+                write_factors(stock_id, comparison.drop(columns='stock_id'), RESULT_FACTORS)
+                written += 1
+            except Exception as e:
+                print(f"Failed on {stock_id}: {e}")
+    return written
+
+def run_market_bps(stock_ids=None, start_date=None, batch_size=BATCH_SIZE, workers=WORKERS, force=False):
+    """
+    Full-market Original/Smart BPS panel in one run: stocks (default: all) are split into
+    batches of batch_size, each batch is one pair of calculate_bps_market calls, and
+    batches run in parallel worker processes. Each stock's factors are identical to
+    run_full_market_scan.process_stock with the same start date. Stocks that already
+    have every RESULT_FACTORS are skipped unless force=True.
+    """
+    stock_ids = _all_stock_ids() if stock_ids is None else [str(s) for s in stock_ids]
+    pending = stock_ids if force else [s for s in stock_ids if not has_factors(s, RESULT_FACTORS)]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    print(f"Market BPS for {len(pending)} / {len(stock_ids)} stocks in {len(batches)} batches ({workers} workers)...")
+
+    if workers <= 1:
+        written = sum(run_batch(batch, start_date) for batch in tqdm(batches))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            written = sum(tqdm(pool.map(run_batch, batches, [start_date] * len(batches)), total=len(batches)))
+    print(f"Done. Saved {RESULT_FACTORS} for {written} / {len(pending)} stocks to the factor store.")
+
+if __name__ == "__main__":
+    # python src/market_bps.py [start_date] [--force]  (--force recomputes stocks that already have results)
+    args = [a for a in sys.argv[1:] if a != '--force']
+    run_market_bps(start_date=args[0] if args else None, force='--force' in sys.argv[1:])
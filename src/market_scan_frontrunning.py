@@ -1,8 +1,8 @@
 import pandas as pd
-import os
 from tqdm import tqdm
 from smart_bps import run_smart_bps
 from bps_strategy import load_data
+from factor_store import has_factors, read_factor_frames
 
 # Configuration
 # Original + New Top 10 Active Stocks
@@ -24,14 +24,14 @@ def calculate_front_run_score(stock_id):
         return None
 
     # Load Smart BPS
-    output_path = f'data/smart_bps_result_{stock_id}.csv'
-    if not os.path.exists(output_path):
+    if not has_factors(stock_id, ['smart_bps']):
         run_smart_bps(stock_id)
         
-    if not os.path.exists(output_path):
+    bps_frames = read_factor_frames(['smart_bps'], [stock_id])
+    if stock_id not in bps_frames:
         return None
         
-    bps_df = pd.read_csv(output_path)
+    bps_df = bps_frames[stock_id]
     
     # 2. Analyze each event
     results = []
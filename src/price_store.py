@@ -0,0 +1,78 @@
+import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+
+# Configuration
+PRICE_DB_PATH = 'data/stock_price_history.parquet'
+
+def _to_ns(dates):
+    """Dates (str / Timestamp / datetime64, scalar or array) -> int64 nanoseconds."""
+    if np.ndim(dates) == 0:
+        return pd.Timestamp(dates).value
+    return pd.to_datetime(dates).values.astype('datetime64[ns]').view('int64')
+
+class PriceStore:
+    """
+    In-memory OHLCV index: rows sorted by (stock_id, date), so each stock is one
+    contiguous slice and date lookups are a searchsorted on int64 day stamps.
+    """
+    def __init__(self, df):
+        df = df.assign(stock_id=df['stock_id'].astype(str))
+        day_ns = _to_ns(df['date'])
+        order = np.lexsort((day_ns, df['stock_id'].to_numpy()))
+
+        self.frame = df.iloc[order].reset_index(drop=True)
+        self.day_ns = day_ns[order]
+        self.closes = self.frame['close'].to_numpy(dtype='float64')
+
+        stock_col = self.frame['stock_id'].to_numpy()
+        bounds = [0] + (np.flatnonzero(stock_col[1:] != stock_col[:-1]) + 1).tolist() + [len(stock_col)]
+        self.bounds = {stock_col[start]: (start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start}
+
+    @classmethod
+    def load(cls, path=PRICE_DB_PATH, stock_ids=None):
+        """Reads the price DB once; stock_ids pushes a stock filter down to the Parquet reader."""
+        filters = [('stock_id', 'in', [str(s) for s in stock_ids])] if stock_ids is not None else None
+        return cls(pq.read_table(path, filters=filters).to_pandas())
+
+    def _range(self, stock_id, start=None, end=None):
+        base, stop = self.bounds.get(str(stock_id), (0, 0))
+        days = self.day_ns[base:stop]
+        lo = base + (np.searchsorted(days, _to_ns(start), side='left') if start is not None else 0)
+        hi = base + (np.searchsorted(days, _to_ns(end), side='right') if end is not None else len(days))
+        return lo, hi
+
+    def history(self, stock_id, start=None, end=None):
+        """Rows for stock_id with start <= date <= end (both optional), in date order."""
+        lo, hi = self._range(stock_id, start, end)
+        return self.frame.iloc[lo:hi].reset_index(drop=True)
+
+    def lookup(self, stock_id, dates):
+        """Vectorized exact-date close lookup. Returns (closes, found) aligned with dates."""
+        lo, hi = self.bounds.get(str(stock_id), (0, 0))
+        days = self.day_ns[lo:hi]
+        keys = _to_ns(np.asarray(dates))
+        pos = np.searchsorted(days, keys)
+        found = pos < len(days)
+        found[found] = days[pos[found]] == keys[found]
+        closes = np.full(len(keys), np.nan)
+        closes[found] = self.closes[lo + pos[found]]
+        return closes, found
+
+    def close(self, stock_id, date, default=None):
+        """Close on exactly `date`, or default when the stock did not trade that day."""
+        lo, hi = self.bounds.get(str(stock_id), (0, 0))
+        key = _to_ns(date)
+        pos = lo + np.searchsorted(self.day_ns[lo:hi], key)
+        if pos < hi and self.day_ns[pos] == key:
+            return self.closes[pos]
+        return default
+
+_STORE = None
+
+def get_price_store():
+    """Process-wide PriceStore, loaded from PRICE_DB_PATH on first use."""
+    global _STORE
+    if _STORE is None:
+        _STORE = PriceStore.load()
+    return _STORE
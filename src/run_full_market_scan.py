@@ -1,11 +1,14 @@
-import pandas as pd
-import os
 import glob
 from tqdm import tqdm
 from broker_clustering import run_analysis as run_clustering
 from smart_bps import run_smart_bps
-from bps_strategy import load_price_data, load_data, calculate_bps
+from bps_strategy import load_price_data, load_data
+from bps_engine import calculate_bps_subsets
 from batch_clustering import identify_accumulator_cluster
+from branch_data import iter_branch_by_stock
+from factor_store import has_factors, write_factors
+from broker_flow import load_flow
+from bps_state import resume_bps
 
 # Top 50 Stocks from scan
 TARGET_STOCKS = [
@@ -16,16 +19,27 @@ TARGET_STOCKS = [
     '2312', '3379', '5251', '3535', '1519', '3062', '6442', '6462', '2468', '3376'
 ]
 
-def process_stock(stock_id):
-    output_path = f'data/smart_bps_result_{stock_id}.csv'
-    if os.path.exists(output_path) and os.path.getsize(output_path) > 1024:
+RESULT_FACTORS = ['price', 'original_bps', 'smart_bps']
+BACKTEST_START = '2024-01-01'
+# False: every broker starts flat on BACKTEST_START. True: broker PnL is carried into the
+# window from the month-end checkpoint before it (bps_state.resume_bps), without a full replay
+CARRY_STATE = False
+
+def result_exists(stock_id):
+    return has_factors(stock_id, RESULT_FACTORS)
+
+def process_stock(stock_id, df=None):
+    """Clustering + Original/Smart BPS for one stock. df (raw StockBranch rows) is shared by all stages."""
+    if result_exists(stock_id):
         return
 
     print(f"\nProcessing {stock_id}...")
+    # Broker-day flow (materialized table when fresh) shared by every stage
+    df = load_flow(stock_id, df=df)
     
     # 2. Run Clustering (using optimized Rolling Window + PCA)
     # This will generate data/broker_clusters_{stock_id}.csv
-    clustered_df = run_clustering(stock_id)
+    clustered_df = run_clustering(stock_id, df)
     if clustered_df is None:
         return
         
@@ -42,13 +56,10 @@ def process_stock(stock_id):
     price_df = load_price_data(stock_id)
     
     # Load Transactions (Full History for Backtest)
-    file_path = 'data/StockBranch.parquet'
     try:
-        df_raw = pd.read_parquet(file_path, filters=[('CommodityId', '==', str(stock_id))])
-        df_raw = df_raw.rename(columns={'Date': 'date', 'CommodityId': 'stock_id', 'SecuritiesTraderId': 'securities_trader_id', 'Price': 'price', 'Buy': 'buy', 'Sell': 'sell'})
-        df_raw['date'] = df_raw['date'].astype(str) # Ensure string format
+        if df.empty: return
         # Filter for 2024-2025
-        df_raw = df_raw[df_raw['date'] >= '2024-01-01']
+        df_raw = df[df['date'] >= BACKTEST_START]
     except Exception as e:
         print(f"Error loading data: {e}")
         return
@@ -56,28 +67,30 @@ def process_stock(stock_id):
     if df_raw.empty: return
 
     # Calculate BPS
-    # Original
-    original_bps = calculate_bps(df_raw, price_df)
-    
-    # Smart (Filtered by Smart Brokers)
-    df_smart = df_raw[df_raw['securities_trader_id'].isin(smart_broker_ids)]
-    smart_bps = calculate_bps(df_smart, price_df)
+    if CARRY_STATE:
+        original_bps = resume_bps(stock_id, price_df, BACKTEST_START, flow=df)
+        smart_bps = resume_bps(stock_id, price_df, BACKTEST_START, broker_ids=smart_broker_ids, flow=df)
+    else:
+        # Original (all brokers) and Smart (smart-cluster brokers) from one pass over the flow
+        bps = calculate_bps_subsets(df_raw, price_df, {'original': None, 'smart': smart_broker_ids})
+        original_bps, smart_bps = bps['original'], bps['smart']
     
     # Merge and Save
     if not original_bps.empty and not smart_bps.empty:
         comparison = original_bps[['date', 'price', 'bps_factor']].rename(columns={'bps_factor': 'original_bps'})
         comparison = comparison.merge(smart_bps[['date', 'bps_factor']].rename(columns={'bps_factor': 'smart_bps'}), on='date', how='left').fillna(0)
         
-        comparison.to_csv(output_path, index=False)
-        print(f"Saved Smart BPS to {output_path}")
+        write_factors(stock_id, comparison, RESULT_FACTORS)
+        print(f"Saved Smart BPS for {stock_id} to the factor store")
 
 def run_full_scan():
     print(f"Starting Full Market Scan for {len(TARGET_STOCKS)} stocks...")
     
-    # Use tqdm
-    for stock in tqdm(TARGET_STOCKS):
+    # One scan of StockBranch for every pending stock instead of two reads per stock
+    pending = [s for s in TARGET_STOCKS if not result_exists(s)]
+    for stock, df in tqdm(iter_branch_by_stock(pending), total=len(pending)):
         try:
-            process_stock(stock)
+            process_stock(stock, df)
         except Exception as e:
             print(f"Failed on {stock}: {e}")
 
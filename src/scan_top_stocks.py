@@ -1,24 +1,13 @@
 import pandas as pd
-import os
+import liquidity_rank
 
-DATA_PATH = 'data/StockBranch.parquet'
+def get_top_stocks(n=50, date=None, metric='rows_120'):
+    """liquidity_rank.get_top_stocks (same arguments) with a printout; ranks by rolling branch-row count by default."""
+    as_of = liquidity_rank.get_liquidity_ranking().last_date() if date is None else pd.Timestamp(date)
+    print(f"Top {n} active stocks by {metric} as of {as_of.date() if as_of is not None else 'N/A'}...")
 
-def get_top_stocks(n=50):
-    print(f"Scanning {DATA_PATH} for top {n} active stocks...")
-    if not os.path.exists(DATA_PATH):
-        print("Data file not found.")
-        return []
+    stock_list = liquidity_rank.get_top_stocks(n, date, metric)
 
-    # Read only CommodityId column for speed
-    df = pd.read_parquet(DATA_PATH, columns=['CommodityId'])
-    
-    # Count occurrences
-    top_stocks = df['CommodityId'].value_counts().head(n)
-    
-    print("\n--- Top Active Stocks ---")
-    print(top_stocks)
-    
-    stock_list = top_stocks.index.tolist()
     print(f"\nStock List ({len(stock_list)}):")
     print(stock_list)
     
@@ -26,4 +15,3 @@ def get_top_stocks(n=50):
 
 if __name__ == "__main__":
     get_top_stocks(50)
-
@@ -1,18 +1,31 @@
 import pandas as pd
 import os
 import glob
-from src.bps_strategy import load_price_data, load_data, calculate_bps
+from src.bps_strategy import load_price_data, load_data, calculate_bps_streaming, STREAMING
 from src.broker_clustering import run_analysis
 from src.batch_clustering import identify_accumulator_cluster
+from src.factor_store import write_factors
+from src.broker_flow import load_flow
+from src.bps_state import start_bps
 
-def run_smart_bps(stock_id):
+def run_smart_bps(stock_id, df_raw=None, streaming=None):
+    """
+    Clusters brokers and computes Smart BPS. Pass df_raw (raw StockBranch rows) so both stages share one copy.
+    streaming=True (default: BPS_STREAMING=1) runs both stages out-of-core, one day of branch rows at a time.
+    """
     print(f"\n{'='*40}")
     print(f"🚀 Running SMART BPS for Stock: {stock_id}")
     print(f"{'='*40}")
 
+    if STREAMING if streaming is None else streaming:
+        return run_smart_bps_streaming(stock_id)
+
+    # Broker-day flow (materialized table when fresh) shared by clustering and BPS
+    df_raw = load_flow(stock_id, df=df_raw)
+
     # 1. Step 1: Run Clustering to find the 'Smart' brokers
     # Note: run_analysis in broker_clustering uses its own internal window for feature extraction.
-    clustered_df = run_analysis(stock_id)
+    clustered_df = run_analysis(stock_id, df_raw)
     if clustered_df is None or 'cluster' not in clustered_df.columns:
         print(f"Clustering failed for {stock_id}")
         return
@@ -24,7 +37,7 @@ def run_smart_bps(stock_id):
 
     # 2. Step 2: Load FULL Transaction Data (Not just the clustering window)
     # We load everything from StockBranch.parquet for this stock
-    df_raw = load_data(stock_id)
+    df_raw = load_data(stock_id, df_raw)
     price_df = load_price_data(stock_id)
     
     if df_raw.empty:
@@ -32,19 +45,36 @@ def run_smart_bps(stock_id):
         return
 
     # 3. Step 3: Calculate Smart BPS over the FULL available period
+    # start_bps also stores the final broker book: later days go through bps_state.update_bps
     print(f"Calculating Smart BPS for {len(df_raw['date'].unique())} days...")
-    df_smart = df_raw[df_raw['securities_trader_id'].isin(smart_broker_ids)]
-    smart_bps = calculate_bps(df_smart, price_df)
+    smart_bps = start_bps(stock_id, df_raw, price_df, smart_broker_ids)
 
     # 4. Merge results
     if smart_bps.empty:
         print("BPS calculation resulted in empty dataframe.")
         return
         
-    # SAVE TO CSV
-    output_path = f'data/smart_bps_result_{stock_id}.csv'
-    smart_bps.to_csv(output_path, index=False)
-    print(f"✅ Results saved to {output_path} ({len(smart_bps)} rows)")
+    # Saved to the factor store by start_bps (bps_factor is stored as smart_bps)
+    print(f"✅ Results saved to the factor store for {stock_id} ({len(smart_bps)} rows)")
+
+def run_smart_bps_streaming(stock_id):
+    """run_smart_bps with streaming feature extraction and BPS: memory scales with brokers, not history."""
+    clustered_df = run_analysis(stock_id, streaming=True)
+    if clustered_df is None or 'cluster' not in clustered_df.columns:
+        print(f"Clustering failed for {stock_id}")
+        return
+
+    best_cluster_id, _ = identify_accumulator_cluster(clustered_df)
+    smart_broker_ids = clustered_df[clustered_df['cluster'] == best_cluster_id]['securities_trader_id'].tolist()
+    print(f"\nFound {len(smart_broker_ids)} smart brokers in Cluster {best_cluster_id}")
+
+    smart_bps = calculate_bps_streaming(stock_id, load_price_data(stock_id), smart_broker_ids)
+    if smart_bps.empty:
+        print("BPS calculation resulted in empty dataframe.")
+        return
+
+    write_factors(stock_id, smart_bps[['date', 'price', 'bps_factor']])
+    print(f"✅ Results saved to the factor store for {stock_id} ({len(smart_bps)} rows)")
 
 if __name__ == "__main__":
     run_smart_bps('2330')
@@ -0,0 +1,178 @@
+import glob
+import os
+import sys
+from branch_data import BRANCH_PATH, PARTITIONED_DIR, BRANCH_COLUMNS
+from factor_store import FACTOR_DIR
+from broker_flow import FLOW_DIR
+from liquidity_rank import LIQUIDITY_PATH
+
+try:
+    import duckdb
+except ImportError: # Optional: pip install duckdb
+    duckdb = None
+
+# Configuration
+PRICE_PATH = 'data/stock_price_history.parquet'
+MARKET_PATH = 'data/market_index.parquet'
+REVENUE_PATH = 'data/revenue_announcements.parquet'
+WARRANT_TRADES_PATH = 'data/分點進出.parquet'
+WARRANT_SPECS_PATH = 'data/權證條件.parquet'
+CLUSTER_CSV_PATTERN = 'data/broker_clusters_*.csv'
+SPILL_DIR = 'data/.duckdb_tmp' # Operators larger than memory_limit spill here instead of failing
+# Date columns stored as text or timestamps -> exposed as DATE so views join on equal types
+DATE_COLUMNS = {'price': ['date'], 'market': ['date'], 'revenue': ['announcement_date'], 'liquidity': ['date']}
+
+def _quote(s):
+    return "'" + str(s).replace("'", "''") + "'"
+
+def _parquet_source(path):
+    """read_parquet() over a file or an appended dataset directory (part-*.parquet)."""
+    target = os.path.join(path, '*.parquet') if os.path.isdir(path) else path
+    return f"read_parquet({_quote(target)}, union_by_name = true)"
+
+def _branch_view():
+    # Standardized column names (branch_data.BRANCH_COLUMNS); the per-stock layout prunes on stock_id
+    if os.path.isdir(PARTITIONED_DIR):
+        source = (f"read_parquet({_quote(os.path.join(PARTITIONED_DIR, '*', '*.parquet'))}, "
+                  "hive_partitioning = true, hive_types = {'CommodityId': VARCHAR}, union_by_name = true)")
+    else:
+        source = _parquet_source(BRANCH_PATH)
+    cols = ', '.join(
+        f"CAST({raw} AS DATE) AS {std}" if std == 'date' else f"CAST({raw} AS VARCHAR) AS {std}" if std.endswith('_id') else f"{raw} AS {std}"
+        for raw, std in BRANCH_COLUMNS.items()
+    )
+    return f"SELECT {cols} FROM {source}"
+
+def view_definitions():
+    """{view name: SELECT ...} for every source that exists under data/."""
+    views = {}
+    if os.path.isdir(PARTITIONED_DIR) or os.path.exists(BRANCH_PATH):
+        views['branch'] = _branch_view()
+    for name, path in [('price', PRICE_PATH), ('market', MARKET_PATH), ('revenue', REVENUE_PATH),
+                       ('warrant_trades', WARRANT_TRADES_PATH), ('warrant_specs', WARRANT_SPECS_PATH),
+                       ('liquidity', LIQUIDITY_PATH)]:
+        if os.path.exists(path):
+            dates = ', '.join(f"CAST({c} AS DATE) AS {c}" for c in DATE_COLUMNS.get(name, []))
+            views[name] = f"SELECT * {f'REPLACE ({dates}) ' if dates else ''}FROM {_parquet_source(path)}"
+    if os.path.isdir(FACTOR_DIR):
+        # Long format (factor, stock_id, date, value), one row per stored factor value
+        views['factors'] = (f"SELECT factor, stock_id, date, value FROM read_parquet({_quote(os.path.join(FACTOR_DIR, '*', '*', '*.parquet'))}, "
+                            "hive_partitioning = true, hive_types = {'factor': VARCHAR, 'stock_id': VARCHAR})")
+    if glob.glob(os.path.join(FLOW_DIR, '*', 'flow.parquet')):
+        views['broker_flow'] = f"SELECT * FROM read_parquet({_quote(os.path.join(FLOW_DIR, '*', 'flow.parquet'))}, union_by_name = true)"
+    if glob.glob(CLUSTER_CSV_PATTERN):
+        views['broker_clusters'] = (f"SELECT regexp_extract(filename, 'broker_clusters_(.+)\\.csv', 1) AS stock_id, * EXCLUDE (filename) "
+                                    f"FROM read_csv_auto({_quote(CLUSTER_CSV_PATTERN)}, filename = true, types = {{'securities_trader_id': 'VARCHAR'}})")
+    return views
+
+def connect(database=':memory:', threads=None, memory_limit=None):
+    """
+    In-process DuckDB connection with every data/ source registered as a view. Views
+    read the Parquet files lazily, so each query scans only the columns, partitions
+    and row groups it needs; scans and aggregations run on all cores (or threads).
+    """
+    if duckdb is None:
+        raise ImportError("sql_views requires duckdb (pip install duckdb)")
+    con = duckdb.connect(database)
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    con.execute(f"SET temp_directory = {_quote(SPILL_DIR)}")
+    if threads is not None:
+        con.execute(f"SET threads = {int(threads)}")
+    if memory_limit is not None:
+        con.execute(f"SET memory_limit = {_quote(memory_limit)}")
+    for name, select in view_definitions().items():
+        con.execute(f"CREATE OR REPLACE VIEW {name} AS {select}")
+    return con
+
+_CON = None
+
+def get_connection():
+    """Process-wide connection, created on first use."""
+    global _CON
+    if _CON is None:
+        _CON = connect()
+    return _CON
+
+def query(sql, params=None, con=None):
+    """Runs sql (named parameters as $name) and returns a DataFrame."""
+    con = get_connection() if con is None else con
+    return con.execute(sql, params or {}).df()
+
+# Canned research queries; named parameters are listed next to each
+QUERIES = {
+    # $stock_id, $start, $end -> daily net buy per broker
+    'broker_daily_net': """
+        SELECT date, securities_trader_id, SUM(buy) AS buy, SUM(sell) AS sell, SUM(buy) - SUM(sell) AS net_buy_qty,
+               SUM(price * (buy + sell)) / NULLIF(SUM(buy + sell), 0) AS avg_price
+        FROM branch
+        WHERE stock_id = $stock_id AND date BETWEEN CAST($start AS DATE) AND CAST($end AS DATE)
+        GROUP BY ALL ORDER BY date, securities_trader_id
+    """,
+    # $stock_id, $start, $end, $n -> brokers with the largest net buy over the window
+    'top_net_buyers': """
+        SELECT securities_trader_id, SUM(buy) - SUM(sell) AS net_buy_qty, COUNT(DISTINCT date) AS active_days
+        FROM branch
+        WHERE stock_id = $stock_id AND date BETWEEN CAST($start AS DATE) AND CAST($end AS DATE)
+        GROUP BY ALL ORDER BY net_buy_qty DESC LIMIT $n
+    """,
+    # $broker_id, $start, $end -> one broker's net buy across every stock
+    'broker_footprint': """
+        SELECT stock_id, SUM(buy) - SUM(sell) AS net_buy_qty, SUM(price * (buy + sell)) AS notional, COUNT(DISTINCT date) AS active_days
+        FROM branch
+        WHERE securities_trader_id = $broker_id AND date BETWEEN CAST($start AS DATE) AND CAST($end AS DATE)
+        GROUP BY ALL ORDER BY notional DESC
+    """,
+    # $stock_id -> daily return, market return and alpha
+    'stock_alpha': """
+        SELECT p.date, p.close, p.close / LAG(p.close) OVER (ORDER BY p.date) - 1 AS stock_ret, m.market_ret,
+               p.close / LAG(p.close) OVER (ORDER BY p.date) - 1 - m.market_ret AS alpha
+        FROM price p LEFT JOIN market m ON p.date = m.date
+        WHERE p.stock_id = $stock_id
+        ORDER BY p.date
+    """,
+    # $start, $end -> revenue announcements with the close on / before the announcement and 5 trading days later
+    'revenue_event_returns': """
+        WITH px AS (
+            SELECT stock_id, date, close, LEAD(close, 5) OVER (PARTITION BY stock_id ORDER BY date) AS close_t5
+            FROM price
+        )
+        SELECT r.stock_id, r.announcement_date, r.revenue_growth_pct, contains(coalesce(r."創新高/低(歷史)", ''), 'H') AS is_high, px.date AS t0, px.close, px.close_t5 / px.close - 1 AS ret_t5
+        FROM revenue r ASOF JOIN px ON r.stock_id = px.stock_id AND r.announcement_date >= px.date
+        WHERE r.announcement_date BETWEEN CAST($start AS DATE) AND CAST($end AS DATE)
+        ORDER BY r.announcement_date, r.stock_id
+    """,
+    # $factor, $start, $end -> factor values joined with close and market return, every stock
+    'factor_panel': """
+        SELECT f.stock_id, f.date, f.value AS factor_value, p.close, m.market_ret
+        FROM factors f
+        LEFT JOIN price p ON p.stock_id = f.stock_id AND p.date = f.date
+        LEFT JOIN market m ON m.date = f.date
+        WHERE f.factor = $factor AND f.date BETWEEN CAST($start AS DATE) AND CAST($end AS DATE)
+        ORDER BY f.stock_id, f.date
+    """,
+    # $date, $n -> most liquid stocks by 60-day traded value as of date
+    'top_liquid': """
+        SELECT stock_id, value_60, rank_value_60
+        FROM liquidity
+        WHERE date = (SELECT MAX(date) FROM liquidity WHERE date <= CAST($date AS DATE)) AND rank_value_60 <= $n
+        ORDER BY rank_value_60
+    """
+}
+
+def run(name, con=None, **params):
+    """Runs canned query `name` from QUERIES with its named parameters."""
+    return query(QUERIES[name], params, con)
+
+if __name__ == "__main__":
+    # python src/sql_views.py "<SQL>"   or   python src/sql_views.py <query name> key=value ...
+    args = sys.argv[1:]
+    if not args:
+        print("Views:", ', '.join(view_definitions()))
+        print("Queries:", ', '.join(QUERIES))
+    elif args[0] in QUERIES:
+        params = dict(a.split('=', 1) for a in args[1:])
+        if 'n' in params:
+            params['n'] = int(params['n'])
+        print(run(args[0], **params).to_string())
+    else:
+        print(query(' '.join(args)).to_string())
@@ -0,0 +1,151 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import shutil
+import time
+from branch_data import read_branch, standardize_branch, partition_dir, BRANCH_PATH
+from price_store import PRICE_DB_PATH, get_price_store
+
+# Configuration
+CACHE_DIR = 'data/cache/ticks/'
+# Opt-in: TICK_CACHE=1 python src/... routes load_branch / load_price_data through the cache
+ENABLED = os.environ.get('TICK_CACHE') == '1'
+POINTER = 'CURRENT' # <cache>/<stock>/CURRENT names the published version directory
+
+def _fingerprint(path):
+    """Size + mtime of the source Parquet (every file of a dataset directory); any rewrite or append invalidates the cache."""
+    files = sorted(os.path.join(path, f) for f in os.listdir(path)) if os.path.isdir(path) else [path]
+    return ';'.join(f'{os.path.basename(f)}:{os.stat(f).st_size}:{os.stat(f).st_mtime_ns}' for f in files)
+
+def _write_columns(out_dir, columns, fingerprint, dtypes=None):
+    """
+    Writes one fixed-width .npy file per column into a new version directory, then
+    publishes it by os.replace of the out_dir/CURRENT pointer, so readers see either
+    the previous or the new version, never a partial one. dtypes (column -> pandas
+    dtype) is kept in meta.json for readers that restore non-NumPy dtypes.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    version = f'v{time.time_ns()}.{os.getpid()}'
+    version_dir = os.path.join(out_dir, version)
+    os.makedirs(version_dir)
+
+    for name, values in columns.items():
+        np.save(os.path.join(version_dir, f'{name}.npy'), values)
+    with open(os.path.join(version_dir, 'meta.json'), 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'columns': list(columns), 'dtypes': dtypes or {}}, f)
+
+    tmp_pointer = os.path.join(out_dir, f'.{POINTER}.{os.getpid()}.tmp')
+    with open(tmp_pointer, 'w') as f:
+        f.write(version)
+    os.replace(tmp_pointer, os.path.join(out_dir, POINTER))
+
+    # Superseded versions: unlinking keeps any reader's existing memory maps valid
+    for name in os.listdir(out_dir):
+        if name.startswith('v') and name < version:
+            shutil.rmtree(os.path.join(out_dir, name), ignore_errors=True)
+
+def _read_columns(out_dir, fingerprint):
+    """Memory-maps the published columns -> (columns, dtypes), or (None, None) if missing or stale."""
+    try:
+        with open(os.path.join(out_dir, POINTER)) as f:
+            version_dir = os.path.join(out_dir, f.read().strip())
+        with open(os.path.join(version_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['fingerprint'] != fingerprint:
+            return None, None
+        cols = {name: np.load(os.path.join(version_dir, f'{name}.npy'), mmap_mode='r') for name in meta['columns']}
+    except FileNotFoundError:
+        # Not built yet, or the version was superseded while we read it
+        return None, None
+    return cols, meta.get('dtypes', {})
+
+def _branch_columns(stock_id):
+    df = read_branch(stock_id)
+    if df.empty:
+        return None
+    df = standardize_branch(df).sort_values(['date', 'securities_trader_id'])
+    brokers = df['securities_trader_id'].cat
+    return {
+        'date': df['date'].to_numpy(dtype='datetime64[ns]'),
+        'broker_code': brokers.codes.to_numpy().astype('int32'),
+        'brokers': np.asarray(brokers.categories.astype(str), dtype='U'),
+        'price': df['price'].to_numpy(),
+        'buy': df['buy'].to_numpy(),
+        'sell': df['sell'].to_numpy()
+    }
+
+def load_branch_cached(stock_id, columns=None, start_date=None, end_date=None):
+    """
+    load_branch() equivalent backed by memory-mapped per-stock column files.
+    The first call for a stock (or after its source changes) builds the cache.
+    """
+    stock_id = str(stock_id)
+    source = partition_dir(stock_id) if os.path.isdir(partition_dir(stock_id)) else BRANCH_PATH
+    if not os.path.exists(source):
+        return pd.DataFrame()
+
+    fingerprint = _fingerprint(source)
+    out_dir = os.path.join(CACHE_DIR, 'branch', stock_id)
+    cols, _ = _read_columns(out_dir, fingerprint)
+    if cols is None:
+        columns_data = _branch_columns(stock_id)
+        if columns_data is None:
+            return pd.DataFrame()
+        _write_columns(out_dir, columns_data, fingerprint)
+        cols, _ = _read_columns(out_dir, fingerprint)
+
+    # Rows are date-sorted, so the window is a zero-copy slice of the mapped arrays
+    dates = cols['date']
+    lo = np.searchsorted(dates, pd.Timestamp(start_date).to_datetime64()) if start_date is not None else 0
+    hi = np.searchsorted(dates, pd.Timestamp(end_date).to_datetime64(), side='right') if end_date is not None else len(dates)
+    if hi <= lo:
+        return pd.DataFrame()
+
+    df = pd.DataFrame({
+        'date': dates[lo:hi],
+        'stock_id': pd.Categorical.from_codes(np.zeros(hi - lo, dtype='int8'), [stock_id]),
+        'securities_trader_id': pd.Categorical.from_codes(cols['broker_code'][lo:hi], cols['brokers'].tolist()),
+        'price': cols['price'][lo:hi],
+        'buy': cols['buy'][lo:hi],
+        'sell': cols['sell'][lo:hi]
+    }, copy=False)
+    return df if columns is None else df[list(columns)]
+
+def _price_columns(df):
+    """Datetimes as int64 ns, other numerics as-is, text (date strings, stock_id) as fixed-width unicode."""
+    columns = {}
+    for c in df.columns:
+        if pd.api.types.is_datetime64_dtype(df[c]):
+            columns[c] = df[c].to_numpy(dtype='datetime64[ns]').view('int64')
+        elif pd.api.types.is_numeric_dtype(df[c]):
+            columns[c] = df[c].to_numpy()
+        else:
+            columns[c] = np.asarray(df[c].astype(str), dtype='U')
+    return columns
+
+def _restore(values, dtype):
+    """A cached column back to its source dtype (numeric columns stay zero-copy maps)."""
+    if dtype is None or dtype == str(values.dtype):
+        return values
+    if dtype.startswith('datetime64'):
+        return pd.Series(values.view('datetime64[ns]')).astype(dtype)
+    return pd.Series(values.astype(object) if values.dtype.kind == 'U' else values).astype(dtype)
+
+def load_prices_cached(stock_id):
+    """load_price_data() equivalent backed by memory-mapped per-stock column files."""
+    stock_id = str(stock_id)
+    if not os.path.exists(PRICE_DB_PATH):
+        return pd.DataFrame()
+
+    fingerprint = _fingerprint(PRICE_DB_PATH)
+    out_dir = os.path.join(CACHE_DIR, 'price', stock_id)
+    cols, dtypes = _read_columns(out_dir, fingerprint)
+    if cols is None:
+        df = get_price_store().history(stock_id)
+        if df.empty:
+            return df
+        _write_columns(out_dir, _price_columns(df), fingerprint, {c: str(t) for c, t in df.dtypes.items()})
+        cols, dtypes = _read_columns(out_dir, fingerprint)
+
+    return pd.DataFrame({c: _restore(v, dtypes.get(c)) for c, v in cols.items()}, copy=False)
@@ -0,0 +1,66 @@
+import pandas as pd
+import numpy as np
+import os
+from price_store import _to_ns
+
+# Configuration
+MARKET_INDEX_PATH = 'data/market_index.parquet'
+UNIQUE_DATES_PATH = 'unique_dates.csv' # Fallback: one date per line, unsorted
+DAY_NS = 24 * 3600 * 10**9
+
+class TradingCalendar:
+    """
+    Sorted, de-duplicated trading days as int64 nanoseconds. Every alignment
+    (on-or-before, T-k / T+k, days between) is a searchsorted, so positions
+    also index any frame that has exactly one row per calendar day.
+    """
+    def __init__(self, dates):
+        self.day_ns = np.unique(_to_ns(np.asarray(dates)))
+
+    @classmethod
+    def load(cls, path=MARKET_INDEX_PATH, fallback=UNIQUE_DATES_PATH):
+        """Market-wide calendar from market_index (or the unique_dates.csv list)."""
+        if os.path.exists(path):
+            return cls(pd.read_parquet(path, columns=['date'])['date'])
+        return cls(pd.read_csv(fallback, header=0).iloc[:, 0])
+
+    def __len__(self):
+        return len(self.day_ns)
+
+    def date(self, pos):
+        return pd.Timestamp(self.day_ns[pos])
+
+    def index_on_or_before(self, date, max_gap_days=None):
+        """
+        Position of the last trading day <= date, or None if there is none (or it lies
+        more than max_gap_days calendar days before date).
+        """
+        key = _to_ns(date)
+        pos = np.searchsorted(self.day_ns, key, side='right') - 1
+        if pos < 0:
+            return None
+        if max_gap_days is not None and key - self.day_ns[pos] > max_gap_days * DAY_NS:
+            return None
+        return int(pos)
+
+    def on_or_before(self, date, max_gap_days=None):
+        pos = self.index_on_or_before(date, max_gap_days)
+        return None if pos is None else self.date(pos)
+
+    def shift(self, date, k):
+        """T+k (k > 0) or T-k (k < 0) counted from the trading day on or before date; None when out of range."""
+        pos = self.index_on_or_before(date)
+        if pos is None or not 0 <= pos + k < len(self.day_ns):
+            return None
+        return self.date(pos + k)
+
+    def range(self, start=None, end=None):
+        """(lo, hi) positions of the trading days with start <= day <= end (both optional)."""
+        lo = np.searchsorted(self.day_ns, _to_ns(start), side='left') if start is not None else 0
+        hi = np.searchsorted(self.day_ns, _to_ns(end), side='right') if end is not None else len(self.day_ns)
+        return int(lo), int(max(lo, hi))
+
+    def days_between(self, start, end):
+        """Number of trading days in [start, end]."""
+        lo, hi = self.range(start, end)
+        return hi - lo
@@ -1,5 +1,16 @@
 import pandas as pd
+import numpy as np
 import os
+import sys
+
+# Add src to sys.path and import its modules by bare name, as they import each other:
+# a second copy under src.* would hold its own IdCodes dictionary
+sys.path.append(os.path.join(os.getcwd(), 'src'))
+
+from liquidity_rank import get_top_stocks
+from id_codes import stock_codes
+
+ANALYSIS_START = '2025-01-01'
 
 def analyze_warrant_hedging_impact():
     print("--- 🛡️ Warrant Hedging & Market Impact Analysis (Full Period 2025) ---")
@@ -16,31 +27,31 @@ def analyze_warrant_hedging_impact():
     # Load Data
     df_trades = pd.read_parquet(warrant_trades_path)
     df_specs = pd.read_parquet(warrant_specs_path)
-    df_prices = pd.read_parquet(stock_history_path)
+    # Top 50 Stocks by rolling 120-day Volume Value as of the day before the analysis period
+    # (the ranking only uses data up to that day, so the universe has no look-ahead)
+    top_stocks = get_top_stocks(n=50, date=pd.Timestamp(ANALYSIS_START) - pd.Timedelta(days=1), metric='value_120')
+    df_prices = pd.read_parquet(stock_history_path, filters=[('stock_id', 'in', top_stocks)])
     
-    # Standardize Stock ID to String
-    df_specs['標的代號'] = df_specs['標的代號'].astype(str)
-    df_prices['stock_id'] = df_prices['stock_id'].astype(str)
+    # Stock IDs as int32 codes (specs store them as numbers, prices as text); ingest writes stock_code
+    df_specs['stock_code'] = stock_codes(df_specs['標的代號'])
+    if 'stock_code' not in df_prices.columns:
+        df_prices['stock_code'] = stock_codes(df_prices['stock_id'])
+    top_codes = stock_codes(top_stocks)
     
     df_trades['日期'] = pd.to_datetime(df_trades['日期'])
     df_specs['日期'] = pd.to_datetime(df_specs['日期'])
     df_prices['date'] = pd.to_datetime(df_prices['date'])
     
-    # Identify Top 50 Stocks by Volume Value in the Full Period (Jan - Aug 2025)
-    # Increasing to 50 stocks to get a larger sample size
-    valid_prices = df_prices[df_prices['date'].between('2025-01-01', '2025-08-31')]
-    top_stocks = valid_prices.groupby('stock_id')['volume_value_1k'].sum().sort_values(ascending=False).head(50).index.tolist()
-    
     print(f"Analyzing Top 50 Stocks over Jan-Aug 2025...")
     
     # 2. Process Warrant Data
     df_trades['net_buy_warrant'] = df_trades['買張'] - df_trades['賣張']
-    df_specs_filtered = df_specs[df_specs['標的代號'].isin(top_stocks)]
+    df_specs_filtered = df_specs[np.isin(df_specs['stock_code'], top_codes)]
     
     # Merge Trades with Specs
     merged = pd.merge(
         df_trades, 
-        df_specs_filtered[['日期', '權證代號', '標的代號', '最新執行比例', 'IVDelta值', 'IVGamma值', '標的收盤價']], 
+        df_specs_filtered[['日期', '權證代號', '標的代號', 'stock_code', '最新執行比例', 'IVDelta值', 'IVGamma值', '標的收盤價']], 
         on=['日期', '權證代號'], 
         how='inner'
     )
@@ -57,7 +68,8 @@ def analyze_warrant_hedging_impact():
     ) / 1000.0
     
     # 4. Aggregate across ALL branches per stock and date
-    market_impact = merged.groupby(['日期', '標的代號']).agg({
+    market_impact = merged.groupby(['日期', 'stock_code']).agg({
+        '標的代號': 'first',
         'implied_stock_buy_vol': 'sum',
         'net_buy_warrant': 'sum',
         '標的收盤價': 'mean',
@@ -65,15 +77,15 @@ def analyze_warrant_hedging_impact():
     }).reset_index()
     
     # Get daily returns
-    df_prices_filtered = df_prices[df_prices['stock_id'].isin(top_stocks)].sort_values(['stock_id', 'date'])
-    df_prices_filtered['stock_ret'] = df_prices_filtered.groupby('stock_id')['close'].pct_change()
+    df_prices_filtered = df_prices[np.isin(df_prices['stock_code'], top_codes)].sort_values(['stock_code', 'date'])
+    df_prices_filtered['stock_ret'] = df_prices_filtered.groupby('stock_code')['close'].pct_change()
     
     # Final Merge with Returns
     final_df = pd.merge(
         market_impact, 
-        df_prices_filtered[['date', 'stock_id', 'stock_ret', 'volume_value_1k']], 
-        left_on=['日期', '標的代號'], 
-        right_on=['date', 'stock_id'], 
+        df_prices_filtered[['date', 'stock_id', 'stock_code', 'stock_ret', 'volume_value_1k']], 
+        left_on=['日期', 'stock_code'], 
+        right_on=['date', 'stock_code'], 
         how='inner'
     )
     
@@ -1,9 +1,14 @@
 import pandas as pd
 import os
-import glob
+import sys
 from scipy import stats
 import numpy as np
 
+# Add root to sys.path to allow importing from src
+sys.path.append(os.getcwd())
+
+from src.factor_store import read_factors
+
 def run_combined_analysis():
     print("--- 🧠 Combined Strategy: Smart BPS + Warrant Hedging (Significance Test) ---")
     
@@ -24,25 +29,12 @@ def run_combined_analysis():
     mkt_df['date'] = pd.to_datetime(mkt_df['date'])
     mkt_df = mkt_df[['date', 'market_ret']].rename(columns={'market_ret': 'mkt_ret'})
     
-    stocks = w_df['stock_id'].unique()
-    bps_data_list = []
+    # Multi-stock Smart BPS panel in one factor-store read (one row per stock and date)
+    bps_all = read_factors(['smart_bps'], w_df['stock_id'].unique())
     
-    for sid in stocks:
-        bps_path = f'data/smart_bps_result_{sid}.csv'
-        if os.path.exists(bps_path):
-            tmp = pd.read_csv(bps_path)
-            tmp['date'] = pd.to_datetime(tmp['date'])
-            tmp['stock_id'] = str(sid)
-            if 'bps_factor' in tmp.columns:
-                tmp = tmp.rename(columns={'bps_factor': 'smart_bps'})
-            tmp = tmp.drop_duplicates('date')
-            bps_data_list.append(tmp[['date', 'stock_id', 'smart_bps']])
-    
-    if not bps_data_list:
+    if bps_all.empty:
         print("No Smart BPS data found.")
         return
-        
-    bps_all = pd.concat(bps_data_list)
     
     # Merge Warrant + BPS
     combined = pd.merge(w_df, bps_all, on=['date', 'stock_id'], how='inner')
@@ -0,0 +1,55 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import bps_state
+from bps_engine import calculate_bps_matrix
+from bps_strategy import calculate_bps, calculate_bps_streaming, load_data
+from broker_flow import select_brokers
+
+STOCK_ID = '9001'
+
+def _write_market(n_days=80, n_brokers=30, seed=0):
+    """Synthetic StockBranch rows for one stock, plus closes with holes (VWAP fallback days)."""
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range('2024-01-02', periods=n_days)
+    rows = []
+    for day in days:
+        for broker in rng.choice(n_brokers, size=rng.integers(3, 12), replace=False):
+            for _ in range(rng.integers(1, 3)):
+                rows.append((day, STOCK_ID, f'B{broker:03d}', round(float(rng.uniform(90, 110)), 2),
+                             int(rng.integers(0, 5)) * 1000, int(rng.integers(0, 5)) * 1000))
+    pd.DataFrame(rows, columns=['Date', 'CommodityId', 'SecuritiesTraderId', 'Price', 'Buy', 'Sell']).to_parquet('data/StockBranch.parquet')
+
+    kept = days[rng.random(n_days) > 0.2]
+    return pd.DataFrame({'date': kept.strftime('%Y-%m-%d'), 'stock_id': STOCK_ID, 'close': rng.uniform(90, 110, len(kept)).round(2)})
+
+def _eq(a, b):
+    pd.testing.assert_frame_equal(a.reset_index(drop=True), b.reset_index(drop=True), check_exact=True)
+
+def test_engines_agree(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    prices = _write_market()
+    df = load_data(STOCK_ID)
+
+    loop = calculate_bps(df, prices, engine='loop')
+    assert len(loop) > 0
+    _eq(calculate_bps_matrix(df, prices), loop)
+    _eq(calculate_bps_streaming(STOCK_ID, prices), loop)
+
+    # Smart-BPS style broker subset
+    brokers = sorted(df['securities_trader_id'].astype(str).unique())[::3]
+    subset = calculate_bps(select_brokers(df, brokers), prices, engine='loop')
+    _eq(calculate_bps_matrix(select_brokers(df, brokers), prices), subset)
+    _eq(calculate_bps_streaming(STOCK_ID, prices, brokers), subset)
+
+    # Resume from month-end checkpoints == the full run from that date on
+    _eq(calculate_bps(df, prices, checkpoints=True), loop)
+    assert len(bps_state.checkpoint_dates(STOCK_ID)) >= 2
+    dates = pd.to_datetime(loop['date'])
+    for start in ['2024-02-01', '2024-03-15']:
+        _eq(bps_state.resume_bps(STOCK_ID, prices, start), loop[dates >= start])
+        _eq(bps_state.resume_bps(STOCK_ID, prices, start, broker_ids=brokers), subset[pd.to_datetime(subset['date']) >= start])
@@ -0,0 +1,47 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import bps_jit
+from bps_engine import calculate_bps_matrix
+from bps_strategy import calculate_bps
+from broker_flow import build_flow
+
+def _case(seed, n_days=120, n_brokers=40):
+    """Branch rows with integer prices (PnL ties at the top-5 cut) and closes with NaN / 0 / missing days."""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2020-01-01', periods=n_days)
+    rows = []
+    for d in dates:
+        b = rng.choice(n_brokers, 12, replace=False)
+        rows.append(pd.DataFrame({'stock_id': '9998', 'date': d, 'securities_trader_id': (1000 + b).astype(str),
+                                  'price': rng.integers(95, 105, 12).astype(float),
+                                  'buy': rng.integers(0, 3, 12) * 1000, 'sell': rng.integers(0, 3, 12) * 1000}))
+    close = np.round(100 * np.exp(np.cumsum(rng.normal(0, 0.05, n_days))))
+    close[rng.random(n_days) < 0.05] = np.nan
+    close[rng.random(n_days) < 0.03] = 0.0
+    kept = rng.random(n_days) > 0.1
+    prices = pd.DataFrame({'stock_id': '9998', 'date': dates[kept], 'close': close[kept]})
+    return build_flow(pd.concat(rows, ignore_index=True)), prices
+
+def _check(monkeypatch, advance):
+    for seed in range(3):
+        flow, prices = _case(seed)
+        monkeypatch.setattr(bps_jit, 'ENABLED', False)
+        expected = calculate_bps_matrix(flow, prices)
+        pd.testing.assert_frame_equal(expected, calculate_bps(flow, prices, engine='loop'), check_exact=True)
+
+        monkeypatch.setattr(bps_jit, 'ENABLED', True)
+        monkeypatch.setattr(bps_jit, 'advance', advance)
+        pd.testing.assert_frame_equal(calculate_bps_matrix(flow, prices), expected, check_exact=True)
+
+def test_kernel_matches_numpy_path(monkeypatch):
+    # The kernel's Python source, uncompiled: same arithmetic as the njit build
+    _check(monkeypatch, bps_jit._advance)
+
+def test_compiled_kernel_matches_numpy_path(monkeypatch):
+    pytest.importorskip('numba')
+    _check(monkeypatch, bps_jit.advance)
@@ -0,0 +1,37 @@
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import ingest
+
+HEADER = '證券代碼,年月日,開盤價(元),最高價(元),最低價(元),收盤價(元),成交值(千元)\n'
+
+def _price_csv(path, rows):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(HEADER)
+        for stock, day, close in rows:
+            f.write(f'{stock},{day},{close},{close},{close},{close},1000\n')
+    return str(path)
+
+def test_same_day_appends_keep_every_stock(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    out_path = 'data/stock_price_history.parquet'
+    ingest.ingest_price(_price_csv(tmp_path / 'base.csv', [('1101 台泥', 20250102, 40.0), ('2330 台積電', 20250102, 1000.0)]), out_path)
+
+    # Two exports with the same newest date but different stocks must land in separate parts
+    ingest.append_price_day(_price_csv(tmp_path / 'a.csv', [('1101 台泥', 20250103, 41.0)]), out_path)
+    ingest.append_price_day(_price_csv(tmp_path / 'b.csv', [('2330 台積電', 20250103, 1010.0)]), out_path)
+
+    rows = pd.read_parquet(out_path).sort_values(['stock_id', 'date'])
+    assert list(zip(rows['stock_id'], rows['date'], rows['close'])) == [
+        ('1101', '2025-01-02', 40.0), ('1101', '2025-01-03', 41.0),
+        ('2330', '2025-01-02', 1000.0), ('2330', '2025-01-03', 1010.0)
+    ]
+
+    # Re-appending a stored day writes nothing; compaction keeps every row
+    assert ingest.append_price_day(str(tmp_path / 'a.csv'), out_path) == 0
+    ingest.compact_dataset(out_path, ['stock_id', 'date'], coverage_date='date')
+    assert ingest._dataset_files(out_path) == [os.path.join(out_path, 'part-0.parquet')]
+    assert len(pd.read_parquet(out_path)) == 4
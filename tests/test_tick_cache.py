@@ -0,0 +1,29 @@
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import price_store
+import tick_cache
+
+def test_cached_prices_equal_price_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    pd.DataFrame({
+        'date': pd.to_datetime(['2025-01-02', '2025-01-03', '2025-01-02']),
+        'stock_id': ['2330', '2330', '1101'],
+        'close': [1000.0, 1010.0, 40.0]
+    }).to_parquet(price_store.PRICE_DB_PATH)
+    monkeypatch.setattr(price_store, '_STORE', None)
+
+    expected = price_store.get_price_store().history('2330')
+    built = tick_cache.load_prices_cached('2330') # builds the cache
+    cached = tick_cache.load_prices_cached('2330') # reads the published version
+    pd.testing.assert_frame_equal(built, expected)
+    pd.testing.assert_frame_equal(cached, expected)
+
+    # A source rewrite publishes a new version and drops the old one
+    os.utime(price_store.PRICE_DB_PATH, ns=(0, 0))
+    tick_cache.load_prices_cached('2330')
+    out_dir = os.path.join(tick_cache.CACHE_DIR, 'price', '2330')
+    assert sorted(os.listdir(out_dir))[0] == tick_cache.POINTER and len(os.listdir(out_dir)) == 2